@@ -1,16 +1,28 @@
 import os
 import json
+import socket
+import sys
+import shutil
+import tempfile
 import requests
+import requests.adapters
+import urllib3
 
 from nmtwizard.framework import Framework
 from nmtwizard.logger import get_logger
-from nmtwizard import utils, serving
+from nmtwizard import utils, serving, ipc
 
 logger = get_logger(__name__)
 
 _MODEL_NAME = "model.pt"
 _RELEASED_MODEL_NAME = "model_released.pt"
 
+# Number of connection attempts to the server before failing a request.
+_CONNECT_RETRIES = 2
+
+# Script serving the model on a Unix socket (see the backend_transport option).
+_IPC_BACKEND = "ipc_backend.py"
+
 
 class OpenNMTPYFramework(Framework):
     def train(
@@ -96,6 +108,35 @@ class OpenNMTPYFramework(Framework):
                 },
                 server_config_file,
             )
+        serving_config = config.get("serving", {})
+        num_connections = serving_config.get("backend_connections", 8)
+        transport = serving_config.get("backend_transport", "http")
+        if transport == "ipc":
+            socket_path = _make_socket_path()
+            process = utils.run_cmd(
+                [
+                    sys.executable,
+                    os.path.join(
+                        os.path.dirname(os.path.abspath(__file__)), _IPC_BACKEND
+                    ),
+                    "--config",
+                    server_config_path,
+                    "--socket",
+                    socket_path,
+                ],
+                background=True,
+            )
+            client = ipc.IPCClient(socket_path, max_connections=num_connections)
+
+            def _close():
+                client.close()
+                shutil.rmtree(os.path.dirname(socket_path), ignore_errors=True)
+
+            return process, {"ipc_client": client, "close": _close}
+        if transport != "http":
+            raise ValueError(
+                "Invalid backend_transport '%s', expected http or ipc" % transport
+            )
         port = serving.pick_free_port()
         process = utils.run_cmd(
             [
@@ -111,7 +152,8 @@ class OpenNMTPYFramework(Framework):
             ],
             background=True,
         )
-        return process, {"port": port}
+        session = _make_session(num_connections)
+        return process, {"port": port, "session": session, "close": session.close}
 
     def release(self, config, model_path, gpuid=0):
         model = os.path.join(model_path, _MODEL_NAME)
@@ -122,20 +164,28 @@ class OpenNMTPYFramework(Framework):
     def forward_request(self, model_info, inputs, outputs=None, options=None):
         if options is None:
             options = {}
+        if "ipc_client" in model_info:
+            return _forward_ipc(model_info["ipc_client"], inputs, options)
         data = [{"src": " ".join(tokens), "id": 0} for tokens in inputs]
         try:
-            result = requests.post(
+            response = model_info["session"].post(
                 "http://127.0.0.1:%d/translator-backend/translate" % model_info["port"],
                 json=data,
                 timeout=options.get("timeout"),
             )
-            return [
-                [serving.TranslationOutput(r["tgt"].split(), score=r["pred_score"])]
-                for r in result.json()[0]
-            ]
-        except requests.exceptions.Timeout as e:
-            logger.error("%s", e)
+        except requests.exceptions.ConnectTimeout as e:
+            raise serving.BackendUnavailable(
+                "connection to the OpenNMT-py server timed out: %s" % e
+            )
+        except requests.exceptions.ReadTimeout as e:
+            logger.error("The OpenNMT-py server did not respond in time: %s", e)
             return None
+        except requests.exceptions.ConnectionError as e:
+            raise serving.BackendUnavailable(
+                "cannot connect to the OpenNMT-py server: %s" % e
+            )
+        response.raise_for_status()
+        return _parse_translations(response.json(), len(inputs))
 
     def _map_vocab_entry(self, index, token, vocab):
         if index == 0:
@@ -146,6 +196,72 @@ class OpenNMTPYFramework(Framework):
         vocab.write("%s\n" % token)
 
 
+def _make_session(num_connections):
+    """Returns a HTTP session keeping up to num_connections connections alive."""
+    session = requests.Session()
+    # Only the connection errors are retried: the request was not sent in this case.
+    retries = urllib3.util.Retry(
+        total=_CONNECT_RETRIES, connect=_CONNECT_RETRIES, read=0, redirect=0, status=0
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=num_connections,
+        pool_block=False,
+        max_retries=retries,
+    )
+    session.mount("http://", adapter)
+    return session
+
+
+def _make_socket_path():
+    """Returns the path to a Unix socket in a new private directory.
+
+    Only the current user can connect to the socket as the directory is created
+    with the mode 0700. Unix socket paths are limited to about 100 characters.
+    """
+    return os.path.join(tempfile.mkdtemp(prefix="onmt-py-"), "backend.sock")
+
+
+def _forward_ipc(client, inputs, options):
+    """Translates a batch with the server listening on a Unix socket."""
+    try:
+        hypotheses, scores = client.translate(inputs, timeout=options.get("timeout"))
+    except socket.timeout as e:
+        logger.error("The OpenNMT-py server did not respond in time: %s", e)
+        return None
+    except ConnectionError as e:
+        raise serving.BackendUnavailable(
+            "cannot connect to the OpenNMT-py server: %s" % e
+        )
+    except ipc.BackendError as e:
+        raise RuntimeError("the OpenNMT-py server failed: %s" % e)
+    if len(hypotheses) != len(inputs):
+        raise RuntimeError(
+            "the OpenNMT-py server returned %d translations for %d inputs"
+            % (len(hypotheses), len(inputs))
+        )
+    return [
+        [serving.TranslationOutput(tokens, score=score)]
+        for tokens, score in zip(hypotheses, scores)
+    ]
+
+
+def _parse_translations(result, num_inputs):
+    """Converts the response of the OpenNMT-py server to TranslationOutput."""
+    if isinstance(result, dict) and "error" in result:
+        raise RuntimeError("the OpenNMT-py server failed: %s" % result["error"])
+    best = result[0] if result else []
+    if len(best) != num_inputs:
+        raise RuntimeError(
+            "the OpenNMT-py server returned %d translations for %d inputs"
+            % (len(best), num_inputs)
+        )
+    return [
+        [serving.TranslationOutput(r["tgt"].split(), score=r["pred_score"])]
+        for r in best
+    ]
+
+
 def _trans_options(config, gpuid):
     options = config["options"].get("config", {})
     opt = options.get("trans", {}).copy()
@@ -0,0 +1,43 @@
+"""OpenNMT-py translation server listening on a Unix socket.
+
+This is an alternative to onmt_server that receives the batches with the binary
+framing of nmtwizard.ipc instead of JSON over HTTP.
+"""
+
+import argparse
+
+from onmt.translate.translation_server import TranslationServer
+
+from nmtwizard import ipc
+from nmtwizard.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", required=True, help="Translation server config.")
+    parser.add_argument("--socket", required=True, help="Path to the Unix socket.")
+    args = parser.parse_args()
+
+    translation_server = TranslationServer()
+    translation_server.start(args.config)
+
+    def _translate(batch, options):
+        inputs = [{"src": " ".join(tokens), "id": 0} for tokens in batch]
+        translations, scores, n_best = translation_server.run(inputs)[:3]
+        return (
+            [translation.split() for translation in translations[::n_best]],
+            [float(score) for score in scores[::n_best]],
+        )
+
+    server = ipc.IPCServer(args.socket, _translate)
+    logger.info("Serving the OpenNMT-py model on %s", args.socket)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""Asyncio HTTP frontend for the serving service."""
+
+import asyncio
+import concurrent.futures
+import functools
+import http
+import threading
+
+from nmtwizard.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Maximum number of header lines in a request.
+_MAX_HEADERS = 100
+
+
+class AsyncHTTPServer(object):
+    """A minimal HTTP/1.1 server running in an asyncio event loop.
+
+    Connections are handled in the event loop and can be kept alive between
+    requests. The requests are processed by a synchronous handler running in a
+    bounded thread pool. When more than max_queue_size requests are pending, new
+    requests are rejected with the status 503. A request with a streamed response
+    is pending until the last chunk is sent.
+
+    The memory used by a connection is bounded: the request headers should be
+    received within keep_alive_timeout seconds and fit in the stream buffer (status
+    431 otherwise), and the body cannot exceed max_body_size bytes (status 413).
+
+    The server exposes the same methods as socketserver.TCPServer that are used by
+    the serving service: serve_forever, shutdown, and server_close.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        handler,
+        max_workers=None,
+        max_queue_size=None,
+        keep_alive_timeout=5,
+        max_body_size=None,
+    ):
+        """Initializes and binds the server.
+
+        Args:
+          host: The hostname of the service.
+          port: The port used by the service.
+          handler: A callable taking the method, path, headers, and body of a
+            request and returning a tuple (status, headers, body). The body is
+            either bytes or an iterator of bytes that is sent with the chunked
+            transfer encoding. The handler also receives an is_cancelled keyword
+            argument: a callable returning True when the client closed the
+            connection.
+          max_workers: The number of threads running the handler.
+          max_queue_size: The maximum number of requests that are processed or
+            waiting for a thread. If None, the requests are never rejected.
+          keep_alive_timeout: Close idle connections after this number of seconds.
+            It is also the maximum time to receive the request headers.
+          max_body_size: The maximum size of a request body in bytes. If None, the
+            size is not limited.
+        """
+        self._handler = handler
+        self._max_queue_size = max_queue_size
+        self._keep_alive_timeout = keep_alive_timeout
+        self._max_body_size = max_body_size
+        self._num_pending = 0
+        self._connections = set()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._loop = asyncio.new_event_loop()
+        self._stopped = threading.Event()
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._on_connection, host, port)
+        )
+
+    @property
+    def num_pending(self):
+        """Number of requests that are processed or waiting for a thread."""
+        return self._num_pending
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_forever()
+        finally:
+            self._stopped.set()
+
+    def shutdown(self):
+        """Stops serve_forever and waits for the loop to stop."""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._stopped.wait()
+
+    def server_close(self):
+        self._server.close()
+        if self._connections:
+            for task in self._connections:
+                task.cancel()
+            self._loop.run_until_complete(
+                asyncio.gather(*self._connections, return_exceptions=True)
+            )
+        self._loop.run_until_complete(self._server.wait_closed())
+        self._loop.close()
+        self._executor.shutdown(wait=False)
+
+    def _on_connection(self, reader, writer):
+        task = self._loop.create_task(self._handle_connection(reader, writer))
+        self._connections.add(task)
+        task.add_done_callback(self._connections.discard)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(
+                        reader.readline(), self._keep_alive_timeout
+                    )
+                except asyncio.TimeoutError:
+                    break
+                except ValueError:
+                    # The line exceeds the stream buffer limit.
+                    await self._write_response(writer, 400, {}, b"", keep_alive=False)
+                    break
+                if not request_line:
+                    break
+                try:
+                    method, path, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self._write_response(writer, 400, {}, b"", keep_alive=False)
+                    break
+
+                try:
+                    headers = await asyncio.wait_for(
+                        self._read_headers(reader), self._keep_alive_timeout
+                    )
+                except asyncio.TimeoutError:
+                    break
+                except ValueError:
+                    await self._write_response(writer, 431, {}, b"", keep_alive=False)
+                    break
+
+                try:
+                    content_length = int(headers.get("content-length", 0))
+                    if content_length < 0:
+                        raise ValueError("negative Content-Length")
+                except ValueError:
+                    await self._write_response(writer, 400, {}, b"", keep_alive=False)
+                    break
+                if (
+                    self._max_body_size is not None
+                    and content_length > self._max_body_size
+                ):
+                    # The body is not read so the connection cannot be reused.
+                    await self._write_response(writer, 413, {}, b"", keep_alive=False)
+                    break
+                body = (
+                    await reader.readexactly(content_length)
+                    if content_length > 0
+                    else b""
+                )
+
+                connection = headers.get("connection", "").lower()
+                if version == "HTTP/1.0":
+                    keep_alive = connection == "keep-alive"
+                else:
+                    keep_alive = connection != "close"
+
+                status, response_headers, data = await self._process(
+                    method, path, headers, body, reader.at_eof
+                )
+                try:
+                    await self._write_response(
+                        writer, status, response_headers, data, keep_alive=keep_alive
+                    )
+                finally:
+                    if not isinstance(data, bytes):
+                        # A streamed response is pending until it is fully sent.
+                        self._num_pending -= 1
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_headers(self, reader):
+        """Reads the request headers.
+
+        Raises:
+          ValueError: if there are too many headers or a line exceeds the stream
+            buffer limit.
+        """
+        headers = {}
+        for _ in range(_MAX_HEADERS + 1):
+            line = await reader.readline()
+            line = line.decode("latin-1").strip()
+            if not line:
+                return headers
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        raise ValueError("too many headers")
+
+    async def _process(self, method, path, headers, body, is_cancelled):
+        if self._max_queue_size is not None and (
+            self._num_pending >= self._max_queue_size
+        ):
+            logger.warning("Rejecting request: %d requests pending", self._num_pending)
+            return (
+                503,
+                {"Content-Type": "application/json"},
+                b'{"message": "server is overloaded"}',
+            )
+
+        self._num_pending += 1
+        streamed = False
+        try:
+            result = await self._loop.run_in_executor(
+                self._executor,
+                functools.partial(self._handler, is_cancelled=is_cancelled),
+                method,
+                path,
+                headers,
+                body,
+            )
+            streamed = not isinstance(result[2], bytes)
+            return result
+        except Exception:
+            logger.exception("Exception raised when handling %s %s", method, path)
+            return 500, {}, b""
+        finally:
+            # The slot of a streamed response is released by the caller.
+            if not streamed:
+                self._num_pending -= 1
+
+    async def _write_response(self, writer, status, headers, data, keep_alive=True):
+        streamed = not isinstance(data, bytes)
+        lines = ["HTTP/1.1 %d %s" % (status, http.HTTPStatus(status).phrase)]
+        for name, value in headers.items():
+            lines.append("%s: %s" % (name, value))
+        if streamed:
+            lines.append("Transfer-Encoding: chunked")
+        else:
+            lines.append("Content-Length: %d" % len(data))
+        lines.append("Connection: %s" % ("keep-alive" if keep_alive else "close"))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if not streamed:
+            writer.write(data)
+            await writer.drain()
+            return
+
+        # The chunks are produced by the handler code so they are generated in
+        # the thread pool.
+        try:
+            while True:
+                chunk = await self._loop.run_in_executor(
+                    self._executor, next, data, None
+                )
+                if chunk is None:
+                    break
+                if chunk:
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    await writer.drain()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            try:
+                data.close()
+            except ValueError:
+                # The generator is still running in the thread pool.
+                pass
@@ -184,6 +184,8 @@ class Framework(utility.Utility):
         Returns:
           A tuple with the created process (if any) and a dictionary containing
           information to use the model (e.g. port number for a backend server).
+          The optional "close" entry of the dictionary is a callable releasing the
+          client resources when the backend is terminated.
         """
         raise NotImplementedError()
 
@@ -1041,8 +1043,43 @@ class Framework(utility.Utility):
 
     def serve_wrapper(self, config, model_path, host, port, gpuid=0):
         local_config = self._finalize_config(config, training=False)
-        preprocessor = self._get_preprocessor(local_config, utils.Task.TRANSLATION)
-        postprocessor = self._get_postprocessor(local_config, utils.Task.TRANSLATION)
+        serving_config = local_config.get("serving", {})
+        processor_kwargs = {}
+        if serving_config.get("pipeline_cache_size") is not None:
+            processor_kwargs["pipeline_cache_size"] = serving_config[
+                "pipeline_cache_size"
+            ]
+        if serving_config.get("preprocess_workers"):
+            processor_kwargs["pool_size"] = serving_config["preprocess_workers"]
+            processor_kwargs["pool_min_inputs"] = serving_config.get(
+                "preprocess_min_examples", 256
+            )
+
+        def _get_processors(processors_config=local_config):
+            preprocessor = self._get_preprocessor(
+                processors_config, utils.Task.TRANSLATION, **processor_kwargs
+            )
+            postprocessor = self._get_postprocessor(
+                processors_config, utils.Task.TRANSLATION, **processor_kwargs
+            )
+            return preprocessor, postprocessor
+
+        models = serving_config.get("models")
+
+        def _get_model(name):
+            model_id = models.get(name)
+            if model_id is None:
+                raise serving.InvalidRequest("unknown model %s" % name)
+            model_path, model_config = self._fetch_serving_model(model_id)
+            preprocessor, postprocessor = _get_processors(model_config)
+            return (
+                lambda: self.serve(model_config, model_path, gpuid=gpuid),
+                preprocessor,
+                postprocessor,
+                utils.get_directory_size(model_path),
+            )
+
+        preprocessor, postprocessor = _get_processors()
         serving.start_server(
             host,
             port,
@@ -1053,8 +1090,32 @@ class Framework(utility.Utility):
             postprocessor=postprocessor,
             backend_info_fn=self.backend_info,
             rebatch_request=not self.has_own_request_batching,
+            processors_fn=_get_processors,
+            models_fn=_get_model if models else None,
         )
 
+    def _fetch_serving_model(self, model_id):
+        """Downloads an additional released model to serve and returns its local
+        path and its finalized configuration."""
+        model_path = os.path.join(self._models_dir, model_id)
+        model_config = utility.download_model(
+            self._storage,
+            self._storage.join(self._model_storage_read, model_id),
+            model_path,
+            should_check_integrity,
+        )
+        if model_config.get("modelType", "release") != "release":
+            raise ValueError(
+                "model %s cannot be served: additional models should be "
+                "released models" % model_id
+            )
+        # The environment is shared with the main model which is served
+        # concurrently, so MODEL_DIR is only overridden for this configuration.
+        model_config = self._finalize_config(
+            model_config, training=False, variables={"MODEL_DIR": model_path}
+        )
+        return model_path, model_config
+
     def postprocess(
         self,
         config,
@@ -1495,15 +1556,17 @@ class Framework(utility.Utility):
         data_util.merge_files_in_directory(data_path, merged_path, source, target)
         return merged_path
 
-    def _get_preprocessor(self, config, task):
+    def _get_preprocessor(self, config, task, **kwargs):
         if task == utils.Task.TRAINING:
             return preprocess.TrainingProcessor(
                 config, self._corpus_dir, self._data_dir
             )
-        return preprocess.InferenceProcessor(config, task=task)
+        return preprocess.InferenceProcessor(config, task=task, **kwargs)
 
-    def _get_postprocessor(self, config, task):
-        return preprocess.InferenceProcessor(config, task=task, postprocess=True)
+    def _get_postprocessor(self, config, task, **kwargs):
+        return preprocess.InferenceProcessor(
+            config, task=task, postprocess=True, **kwargs
+        )
 
     def _generate_training_data(self, config):
         preprocessor = self._get_preprocessor(config, utils.Task.TRAINING)
@@ -1528,10 +1591,12 @@ class Framework(utility.Utility):
             )
         return build_info
 
-    def _finalize_config(self, config, training=True):
+    def _finalize_config(self, config, training=True, variables=None):
         config_util.ensure_operators_name(config)
         config = config_util.old_to_new_config(config)
-        config = utility.resolve_environment_variables(config, training=training)
+        config = utility.resolve_environment_variables(
+            config, training=training, variables=variables
+        )
         config = self._upgrade_data_config(config, training=training)
         config = utility.resolve_remote_files(config, self._shared_dir, self._storage)
         return config
@@ -0,0 +1,341 @@
+"""Transport of translation batches to a local backend over a Unix domain socket.
+
+The messages are prefixed by their size as a 4-byte big-endian integer. Token
+batches use a compact binary encoding: the number of tokens per sentence is
+stored as an integer array, followed by all tokens joined in a single UTF-8
+string. Encoding or decoding a batch does not require building and parsing a
+JSON document.
+
+As both processes run on the same host, the arrays use the native byte order.
+"""
+
+import array
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+
+from nmtwizard.logger import get_logger
+
+logger = get_logger(__name__)
+
+_SIZE = struct.Struct(">I")
+_HEADER = struct.Struct(">II")
+
+# Tokens are joined with the ASCII unit separator.
+_TOKEN_SEPARATOR = "\x1f"
+
+_STATUS_OK = 0
+_STATUS_ERROR = 1
+
+
+class BackendError(RuntimeError):
+    """Exception raised when the backend failed to process a request."""
+
+    pass
+
+
+def _int_array(values=()):
+    values = array.array("I", values)
+    if values.itemsize != 4:
+        values = array.array("L", values)
+    return values
+
+
+def encode_batch(batch):
+    """Encodes a batch of tokens.
+
+    Args:
+      batch: A list of sentences, each sentence being a list of tokens.
+
+    Returns:
+      The encoded batch as bytes.
+
+    Raises:
+      ValueError: if a token contains the separator character.
+    """
+    tokens = [token for sentence in batch for token in sentence]
+    text = _TOKEN_SEPARATOR.join(tokens)
+    if tokens and text.count(_TOKEN_SEPARATOR) != len(tokens) - 1:
+        raise ValueError("Tokens can not contain the character U+001F")
+    sentence_lengths = _int_array(len(sentence) for sentence in batch)
+    return b"".join(
+        (
+            _HEADER.pack(len(sentence_lengths), len(tokens)),
+            sentence_lengths.tobytes(),
+            text.encode("utf-8"),
+        )
+    )
+
+
+def decode_batch(data, offset=0):
+    """Decodes a batch of tokens.
+
+    Args:
+      data: The bytes containing the encoded batch.
+      offset: The position of the encoded batch in data.
+
+    Returns:
+      A list of sentences, each sentence being a list of tokens.
+    """
+    num_sentences, num_tokens = _HEADER.unpack_from(data, offset)
+    offset += _HEADER.size
+    sentence_lengths = _int_array()
+    end = offset + num_sentences * sentence_lengths.itemsize
+    sentence_lengths.frombytes(data[offset:end])
+    if num_tokens == 0:
+        return [[] for _ in range(num_sentences)]
+    tokens = iter(bytes(data[end:]).decode("utf-8").split(_TOKEN_SEPARATOR))
+    return [list(itertools.islice(tokens, length)) for length in sentence_lengths]
+
+
+def encode_request(batch, options=None):
+    """Encodes a translation request."""
+    options = json.dumps(options or {}).encode("utf-8")
+    return b"".join((_SIZE.pack(len(options)), options, encode_batch(batch)))
+
+
+def decode_request(data):
+    """Decodes a translation request and returns the tuple (batch, options)."""
+    (options_size,) = _SIZE.unpack_from(data)
+    offset = _SIZE.size + options_size
+    options = json.loads(bytes(data[_SIZE.size : offset]).decode("utf-8"))
+    return decode_batch(data, offset), options
+
+
+def encode_response(hypotheses, scores):
+    """Encodes translation results.
+
+    Args:
+      hypotheses: A list of tokenized translations.
+      scores: The score of each translation.
+
+    Returns:
+      The encoded response as bytes.
+    """
+    scores = array.array("d", scores)
+    return b"".join(
+        (
+            bytes((_STATUS_OK,)),
+            _SIZE.pack(len(scores)),
+            scores.tobytes(),
+            encode_batch(hypotheses),
+        )
+    )
+
+
+def encode_error(message):
+    """Encodes an error response."""
+    return bytes((_STATUS_ERROR,)) + message.encode("utf-8")
+
+
+def decode_response(data):
+    """Decodes a response and returns the tuple (hypotheses, scores).
+
+    Raises:
+      BackendError: if the response is an error.
+    """
+    if data[0] != _STATUS_OK:
+        raise BackendError(bytes(data[1:]).decode("utf-8"))
+    (num_scores,) = _SIZE.unpack_from(data, 1)
+    offset = 1 + _SIZE.size
+    scores = array.array("d")
+    end = offset + num_scores * scores.itemsize
+    scores.frombytes(data[offset:end])
+    return decode_batch(data, end), scores.tolist()
+
+
+def send_message(sock, data):
+    """Sends a message prefixed by its size."""
+    sock.sendall(_SIZE.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            if received == 0:
+                return None
+            raise ConnectionError(
+                "the connection was closed in the middle of a message"
+            )
+        received += n
+    return buffer
+
+
+def recv_message(sock):
+    """Receives a message prefixed by its size.
+
+    Returns:
+      The message as a bytearray, or None if the connection was closed.
+    """
+    header = _recv_exactly(sock, _SIZE.size)
+    if header is None:
+        return None
+    (size,) = _SIZE.unpack(header)
+    if size == 0:
+        return bytearray()
+    data = _recv_exactly(sock, size)
+    if data is None:
+        raise ConnectionError("the connection was closed in the middle of a message")
+    return data
+
+
+class IPCClient(object):
+    """Client sending translation requests to a backend listening on a Unix socket.
+
+    Connections are kept open and reused between requests. The client can be
+    used from multiple threads: each request uses its own connection. A request
+    is retried on a new connection only if it could not be sent on an idle one.
+    """
+
+    def __init__(self, path, max_connections=8):
+        """Initializes the client.
+
+        Args:
+          path: The path to the Unix socket of the backend.
+          max_connections: The maximum number of idle connections to keep open.
+        """
+        self._path = path
+        self._idle_connections = queue.LifoQueue(maxsize=max_connections)
+
+    def translate(self, batch, options=None, timeout=None):
+        """Translates a batch of tokens.
+
+        Args:
+          batch: A list of sentences, each sentence being a list of tokens.
+          options: A dictionary of translation options sent to the backend.
+          timeout: The maximum time in seconds to wait for the result.
+
+        Returns:
+          A tuple (hypotheses, scores) with one translation and score per sentence.
+
+        Raises:
+          ConnectionError: if the backend cannot be reached.
+          socket.timeout: if the backend did not respond in time.
+          BackendError: if the backend failed to translate the batch.
+        """
+        message = encode_request(batch, options)
+        while True:
+            sock, reused = self._get_connection()
+            sent = False
+            try:
+                sock.settimeout(timeout)
+                send_message(sock, message)
+                sent = True
+                data = recv_message(sock)
+                if data is None:
+                    raise ConnectionError("the backend closed the connection")
+            except ConnectionError:
+                sock.close()
+                # An idle connection may have been closed by a backend restart. The
+                # batch is not sent again if the backend could have received it.
+                if reused and not sent:
+                    continue
+                raise
+            except BaseException:
+                sock.close()
+                raise
+            self._release_connection(sock)
+            return decode_response(data)
+
+    def close(self):
+        """Closes the idle connections."""
+        while True:
+            try:
+                sock = self._idle_connections.get_nowait()
+            except queue.Empty:
+                break
+            sock.close()
+
+    def _get_connection(self):
+        try:
+            return self._idle_connections.get_nowait(), True
+        except queue.Empty:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._path)
+        except (OSError, socket.error) as e:
+            sock.close()
+            raise ConnectionError("cannot connect to %s: %s" % (self._path, e))
+        return sock, False
+
+    def _release_connection(self, sock):
+        try:
+            self._idle_connections.put_nowait(sock)
+        except queue.Full:
+            sock.close()
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        with self.server.connections_lock:
+            self.server.connections.add(self.request)
+
+    def finish(self):
+        with self.server.connections_lock:
+            self.server.connections.discard(self.request)
+
+    def handle(self):
+        while True:
+            try:
+                data = recv_message(self.request)
+            except ConnectionError:
+                break
+            if data is None:
+                break
+            try:
+                batch, options = decode_request(data)
+                hypotheses, scores = self.server.translate_fn(batch, options)
+                response = encode_response(hypotheses, scores)
+            except Exception as e:
+                logger.exception("Exception raised when translating a batch")
+                response = encode_error(str(e))
+            try:
+                send_message(self.request, response)
+            except (OSError, socket.error):
+                break
+
+
+class IPCServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Server translating batches received on a Unix socket.
+
+    Each connection is handled in a separate thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, translate_fn):
+        """Initializes and binds the server.
+
+        Args:
+          path: The path to the Unix socket. An existing file at this path is
+            removed.
+          translate_fn: A callable taking a batch of tokens and a dictionary of
+            options, and returning a tuple (hypotheses, scores).
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        self.translate_fn = translate_fn
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        super().__init__(path, _RequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        with self.connections_lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except (OSError, socket.error):
+                    pass
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
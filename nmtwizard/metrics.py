@@ -0,0 +1,251 @@
+"""Minimal metrics collection with the Prometheus text exposition format."""
+
+import bisect
+import threading
+
+DEFAULT_LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _format_labels(names, values, extra=None):
+    labels = ['%s="%s"' % (name, value) for name, value in zip(names, values)]
+    if extra is not None:
+        labels.append('%s="%s"' % extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(labels)
+
+
+class _Metric(object):
+    """Base class for metrics with optional labels."""
+
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self._name = name
+        self._documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if registry is None:
+            registry = REGISTRY
+        registry.register(self)
+
+    @property
+    def name(self):
+        return self._name
+
+    def labels(self, *values):
+        """Returns the metric for these label values."""
+        if len(values) != len(self._labelnames):
+            raise ValueError(
+                "Metric %s expects %d label values, got %d"
+                % (self._name, len(self._labelnames), len(values))
+            )
+        values = tuple(str(value) for value in values)
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._new_child()
+                self._children[values] = child
+            return child
+
+    def _default_child(self):
+        if self._labelnames:
+            raise ValueError("Metric %s requires label values" % self._name)
+        return self.labels()
+
+    def collect(self):
+        """Returns the lines of this metric in the text exposition format."""
+        lines = [
+            "# HELP %s %s" % (self._name, self._documentation),
+            "# TYPE %s %s" % (self._name, self.type_name),
+        ]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            lines.extend(child.collect(self._name, self._labelnames, values))
+        return lines
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+
+class _Value(object):
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        return self._value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def collect(self, name, labelnames, values):
+        return [
+            "%s%s %s"
+            % (name, _format_labels(labelnames, values), _format_value(self._value))
+        ]
+
+
+class Counter(_Metric):
+    """A monotonically increasing value."""
+
+    type_name = "counter"
+
+    def inc(self, amount=1):
+        self._default_child().inc(amount)
+
+    def _new_child(self):
+        return _Value()
+
+
+class Gauge(_Metric):
+    """A value that can go up and down."""
+
+    type_name = "gauge"
+
+    def inc(self, amount=1):
+        self._default_child().inc(amount)
+
+    def dec(self, amount=1):
+        self._default_child().dec(amount)
+
+    def set(self, value):
+        self._default_child().set(value)
+
+    def _new_child(self):
+        return _Value()
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+    @property
+    def sum(self):
+        return self._sum
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def collect(self, name, labelnames, values):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = []
+        cumulative_count = 0
+        for bound, count in zip(self._buckets + (float("inf"),), counts):
+            cumulative_count += count
+            lines.append(
+                "%s_bucket%s %d"
+                % (
+                    name,
+                    _format_labels(labelnames, values, ("le", _format_value(bound))),
+                    cumulative_count,
+                )
+            )
+        labels = _format_labels(labelnames, values)
+        lines.append("%s_sum%s %s" % (name, labels, _format_value(total)))
+        lines.append("%s_count%s %d" % (name, labels, cumulative_count))
+        return lines
+
+
+class Histogram(_Metric):
+    """Counts observations in cumulative buckets."""
+
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name,
+        documentation,
+        labelnames=(),
+        buckets=DEFAULT_LATENCY_BUCKETS,
+        registry=None,
+    ):
+        self._buckets = tuple(sorted(float(bound) for bound in buckets))
+        super().__init__(name, documentation, labelnames=labelnames, registry=registry)
+
+    def observe(self, value):
+        self._default_child().observe(value)
+
+    def _new_child(self):
+        return _HistogramValue(self._buckets)
+
+
+class Registry(object):
+    """A collection of metrics."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(
+                    "A metric is already registered with name %s" % metric.name
+                )
+            self._metrics[metric.name] = metric
+
+    def generate_latest(self):
+        """Returns all metrics in the text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+REGISTRY = Registry()
+
+
+def generate_latest(registry=REGISTRY):
+    """Returns the metrics of the registry in the text exposition format."""
+    return registry.generate_latest()
@@ -2,11 +2,14 @@ import abc
 import os
 import collections
 import itertools
+import tempfile
 
 import pyonmttok
 
+from nmtwizard import data
 from nmtwizard.logger import get_logger
 from nmtwizard.preprocess import tokenizer
+from nmtwizard.preprocess.tu import PackedOutputs
 
 logger = get_logger(__name__)
 
@@ -204,11 +207,19 @@ def _build_vocabulary_counters(config):
     if vocab_config is None:
         return {}
     return {
-        "tokens": collections.defaultdict(int),
+        "tokens": collections.Counter(),
         "total": 0,
     }
 
 
+def _count_tokens(counters, tokens):
+    if not counters:
+        return
+    tokens = list(tokens)
+    counters["tokens"].update(tokens)
+    counters["total"] += len(tokens)
+
+
 class SubwordLearner(Consumer):
     """SubwordLearner class stores, learns and writes subword models."""
 
@@ -247,7 +258,15 @@ class SubwordLearner(Consumer):
         if source_learner is None and target_learner is None:
             return
 
-        for output in outputs[0]:
+        outputs = outputs[0]
+        if isinstance(outputs, PackedOutputs):
+            if source_learner is not None:
+                _ingest_tokens(source_learner, outputs.iter_tokens("src"))
+            if target_learner is not None:
+                _ingest_tokens(target_learner, outputs.iter_tokens("tgt"))
+            return
+
+        for output in outputs:
             if source_learner is not None:
                 _ingest_tokens(source_learner, output.src)
             if target_learner is not None:
@@ -329,13 +348,18 @@ class VocabularyBuilder(Consumer):
         self._tokens_to_add(outputs)
 
         outputs, _ = outputs
-        for output in outputs:
-            for token in itertools.chain.from_iterable(output.src):
-                self._source_counters["tokens"][token] += 1
-                self._source_counters["total"] += 1
-            for token in itertools.chain.from_iterable(output.tgt):
-                self._target_counters["tokens"][token] += 1
-                self._target_counters["total"] += 1
+        if isinstance(outputs, PackedOutputs):
+            source_tokens = outputs.get_all_tokens("src")
+            target_tokens = outputs.get_all_tokens("tgt")
+        else:
+            source_tokens = itertools.chain.from_iterable(
+                itertools.chain.from_iterable(output.src for output in outputs)
+            )
+            target_tokens = itertools.chain.from_iterable(
+                itertools.chain.from_iterable(output.tgt for output in outputs)
+            )
+        _count_tokens(self._source_counters, source_tokens)
+        _count_tokens(self._target_counters, target_tokens)
 
     def _prune(self, sorted_vocabulary, size, min_frequency):
         real_size = len(sorted_vocabulary)
@@ -553,8 +577,132 @@ class PostprocessFileWriter(FileWriter):
         files[0].write("\n")
 
 
+def _write_sampler_outputs(
+    outputs,
+    src_path,
+    tgt_path=None,
+    align_path=None,
+    example_weights_path=None,
+    example_weights=None,
+):
+    """Appends the outputs of a batch to the sampled files."""
+    if isinstance(outputs, PackedOutputs):
+        # The packed lines are already encoded and can be appended as is.
+        with open(src_path, "ab") as src_file:
+            src_file.write(outputs.get_data("src"))
+
+        if tgt_path:
+            with open(tgt_path, "ab") as tgt_file:
+                tgt_file.write(outputs.get_data("tgt") or b"")
+
+        if align_path:
+            with open(align_path, "a") as align_file:
+                for line in outputs.iter_alignment_lines():
+                    align_file.write("%s\n" % line)
+
+    else:
+        # Write lines to file from TUs
+        with open(src_path, "a") as src_file:
+            for output in outputs:
+                src_tokens = output.src
+                if isinstance(src_tokens, list):
+                    for part in src_tokens:
+                        part = " ".join(part)
+                        src_file.write("%s\n" % part)
+                else:
+                    src_file.write("%s\n" % output.src)
+
+        if tgt_path:
+            with open(tgt_path, "a") as tgt_file:
+                for output in outputs:
+                    tgt_tokens = output.tgt
+                    if isinstance(tgt_tokens, list):
+                        for part in tgt_tokens:
+                            part = " ".join(part)
+                            tgt_file.write("%s\n" % part)
+                    else:
+                        tgt_file.write("%s\n" % output.tgt)
+
+        if align_path:
+            with open(align_path, "a") as align_file:
+                for output in outputs:
+                    alignment = output.alignment
+                    if alignment:
+                        for part in alignment:
+                            part = " ".join(sorted("%s-%s" % tup for tup in part))
+                            align_file.write("%s\n" % part)
+
+    if example_weights_path:
+        with open(example_weights_path, "a") as example_weights_file:
+            example_weights_file.write(("%.1f\n" % example_weights) * len(outputs))
+
+
+class SamplerShard(object):
+    """Files written by a worker process for a batch of sampled data."""
+
+    __slots__ = ["src_path", "tgt_path", "align_path", "example_weights_path", "size"]
+
+    def __init__(self, src_path, tgt_path, align_path, example_weights_path, size):
+        self.src_path = src_path
+        self.tgt_path = tgt_path
+        self.align_path = align_path
+        self.example_weights_path = example_weights_path
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def paths(self):
+        return (
+            self.src_path,
+            self.tgt_path,
+            self.align_path,
+            self.example_weights_path,
+        )
+
+
+def write_sampler_shard(outputs, meta, config, shard_dir):
+    """Writes the outputs of a batch to new files in shard_dir.
+
+    This is called in the worker processes so that the outputs do not need to be
+    sent to the main process.
+
+    Returns:
+      A SamplerShard that should be passed to SamplerFileWriter in place of the
+      outputs.
+    """
+    src_suffix = config["source"]
+    tgt_suffix = config.get("target", None)
+    fd, src_path = tempfile.mkstemp(
+        prefix="%s." % meta["base_name"], suffix="." + src_suffix, dir=shard_dir
+    )
+    os.close(fd)
+    prefix = src_path[: -len(src_suffix)]
+    tgt_path = prefix + tgt_suffix if tgt_suffix else None
+    align_path = prefix + "align" if meta.get("write_alignment", False) else None
+    example_weights = meta.get("example_weights", False)
+    example_weights_path = prefix + "weights" if example_weights else None
+    _write_sampler_outputs(
+        outputs,
+        src_path,
+        tgt_path=tgt_path,
+        align_path=align_path,
+        example_weights_path=example_weights_path,
+        example_weights=example_weights,
+    )
+    return SamplerShard(
+        src_path, tgt_path, align_path, example_weights_path, len(outputs)
+    )
+
+
 class SamplerFileWriter(Consumer):
-    """SamplerFileWriter writes pre/postprocessed TUs into files at training using SamplerFile object."""
+    """SamplerFileWriter writes pre/postprocessed TUs into files at training using SamplerFile object.
+
+    The outputs can also be SamplerShard objects when the batches were written by
+    the worker processes. The shards are merged in the order they are received
+    when the writer is finalized.
+    """
 
     def __init__(self, config, result_dir, exit_step, summary):
         super().__init__()
@@ -563,6 +711,7 @@ class SamplerFileWriter(Consumer):
         self._summary = summary
         self._src_suffix = config["source"]
         self._tgt_suffix = config.get("target", None)
+        self._shards = collections.OrderedDict()
 
     def _consume(self, outputs):
         outputs, meta = outputs
@@ -593,38 +742,32 @@ class SamplerFileWriter(Consumer):
 
         file_summary["linefiltered"] += len(outputs)
 
-        # Write lines to file from TUs
-        with open(src_path, "a") as src_file:
-            for output in outputs:
-                src_tokens = output.src
-                if isinstance(src_tokens, list):
-                    for part in src_tokens:
-                        part = " ".join(part)
-                        src_file.write("%s\n" % part)
-                else:
-                    src_file.write("%s\n" % output.src)
-
-        if tgt_path:
-            with open(tgt_path, "a") as tgt_file:
-                for output in outputs:
-                    tgt_tokens = output.tgt
-                    if isinstance(tgt_tokens, list):
-                        for part in tgt_tokens:
-                            part = " ".join(part)
-                            tgt_file.write("%s\n" % part)
-                    else:
-                        tgt_file.write("%s\n" % output.tgt)
+        if isinstance(outputs, SamplerShard):
+            shards = self._shards.setdefault(
+                basename,
+                (src_path, tgt_path, align_path, example_weights_path, []),
+            )
+            shards[-1].append(outputs)
+            return
 
-        if write_alignment:
-            with open(align_path, "a") as align_file:
-                for output in outputs:
-                    alignment = output.alignment
-                    if alignment:
-                        for part in alignment:
-                            part = " ".join(sorted("%s-%s" % tup for tup in part))
-                            align_file.write("%s\n" % part)
+        _write_sampler_outputs(
+            outputs,
+            src_path,
+            tgt_path=tgt_path,
+            align_path=align_path if write_alignment else None,
+            example_weights_path=example_weights_path if example_weights else None,
+            example_weights=example_weights,
+        )
 
-        if example_weights:
-            with open(example_weights_path, "a") as example_weights_file:
-                for _ in outputs:
-                    example_weights_file.write("%.1f\n" % example_weights)
+    def finalize(self):
+        for basename, (*output_paths, shards) in self._shards.items():
+            logger.info("Merging %d shards of %s", len(shards), basename)
+            for i, output_path in enumerate(output_paths):
+                shard_paths = [
+                    shard.paths[i] for shard in shards if shard.paths[i] is not None
+                ]
+                if shard_paths:
+                    data.merge_files(shard_paths, output_path)
+                    for shard_path in shard_paths:
+                        os.remove(shard_path)
+        self._shards.clear()
@@ -1,20 +1,32 @@
 import abc
 import itertools
+import os
 
 from nmtwizard import utils
 from nmtwizard.preprocess import tu
 
 
 class Loader(abc.ABC):
-    """Base class for creating batches of TUs."""
+    """Base class for creating batches of TUs.
 
-    def __init__(self, batch_size):
+    A batch is complete when it contains batch_size TUs or, if batch_chars is set,
+    when its input lines contain at least batch_chars characters. Loaders that
+    support batch_chars report the number of characters of each batch in the
+    "num_chars" field of the batch metadata.
+    """
+
+    def __init__(self, batch_size, batch_chars=None):
         self._batch_size = batch_size
+        self._batch_chars = batch_chars
 
     @property
     def batch_size(self):
         return self._batch_size
 
+    @property
+    def batch_chars(self):
+        return self._batch_chars
+
     @abc.abstractmethod
     def __call__(self):
         raise NotImplementedError()
@@ -23,8 +35,8 @@ class Loader(abc.ABC):
 class FileLoader(Loader):
     """FileLoader class creates TUs from a file or aligned files."""
 
-    def __init__(self, batch_size, batch_meta=None):
-        super().__init__(batch_size)
+    def __init__(self, batch_size, batch_meta=None, batch_chars=None):
+        super().__init__(batch_size, batch_chars=batch_chars)
         if batch_meta is None:
             batch_meta = {}
         self._input_paths = {}
@@ -37,9 +49,14 @@ class FileLoader(Loader):
 
     @abc.abstractmethod
     def _get_translation_units(self, files):
-        """Yields TUs from the input files."""
+        """Yields tuples (TU, number of characters in the input lines)."""
         raise NotImplementedError()
 
+    def _make_batch(self, tu_list, num_chars):
+        batch_meta = self._batch_meta.copy()
+        batch_meta["num_chars"] = num_chars
+        return tu_list, batch_meta
+
     def __call__(self):
         if not self._input_paths:
             raise RuntimeError("No files have been registered")
@@ -49,15 +66,20 @@ class FileLoader(Loader):
 
         try:
             tu_list = []
+            num_chars = 0
 
-            for unit in self._get_translation_units(files):
+            for unit, unit_chars in self._get_translation_units(files):
                 tu_list.append(unit)
-                if len(tu_list) == self._batch_size:
-                    yield tu_list, self._batch_meta.copy()
+                num_chars += unit_chars
+                if len(tu_list) == self._batch_size or (
+                    self._batch_chars is not None and num_chars >= self._batch_chars
+                ):
+                    yield self._make_batch(tu_list, num_chars)
                     tu_list = []
+                    num_chars = 0
 
             if tu_list:
-                yield tu_list, self._batch_meta.copy()
+                yield self._make_batch(tu_list, num_chars)
         finally:
             for f in files.values():
                 f.close()
@@ -66,8 +88,10 @@ class FileLoader(Loader):
 class PreprocessFileLoader(FileLoader):
     """Loads TUs for preprocessing."""
 
-    def __init__(self, source_path, target_path=None, batch_size=None):
-        super().__init__(batch_size)
+    def __init__(
+        self, source_path, target_path=None, batch_size=None, batch_chars=None
+    ):
+        super().__init__(batch_size, batch_chars=batch_chars)
         self.register_file("source", source_path)
         if target_path is not None:
             self.register_file("target", target_path)
@@ -76,7 +100,8 @@ class PreprocessFileLoader(FileLoader):
         source_file = files["source"]
         target_file = files.get("target", itertools.repeat(None))
         for source, target in zip(source_file, target_file):
-            yield tu.TranslationUnit(source=source, target=target)
+            num_chars = len(source) + (len(target) if target is not None else 0)
+            yield tu.TranslationUnit(source=source, target=target), num_chars
 
 
 def _make_tokens_iterator(input_file):
@@ -95,8 +120,9 @@ class PostprocessFileLoader(FileLoader):
         start_state=None,
         batch_size=None,
         target_score_type=None,
+        batch_chars=None,
     ):
-        super().__init__(batch_size)
+        super().__init__(batch_size, batch_chars=batch_chars)
         if start_state is None:
             start_state = {}
         self._source_tokenizer = start_state.get("src_tokenizer")
@@ -123,17 +149,24 @@ class PostprocessFileLoader(FileLoader):
         source_file = files["source"]
         target_file = files["target"]
         for meta, src_lines, tgt_lines in self._get_parts(source_file, target_file):
+            num_chars = _count_chars(src_lines) + _count_chars(tgt_lines)
             if self._target_score_type is not None:
                 score = _extract_score(tgt_lines, self._target_score_type)
                 meta = [{"score": score}]
 
-            yield tu.TranslationUnit(
+            unit = tu.TranslationUnit(
                 source=src_lines,
                 target=tgt_lines,
                 metadata=meta,
                 source_tokenizer=self._source_tokenizer,
                 target_tokenizer=self._target_tokenizer,
             )
+            yield unit, num_chars
+
+
+def _count_chars(parts):
+    """Returns the number of characters of tokenized lines, including separators."""
+    return sum(sum(map(len, tokens)) + len(tokens) for tokens in parts)
 
 
 def _extract_score(tokens, score_type, separator="|||"):
@@ -173,35 +206,62 @@ def _extract_score(tokens, score_type, separator="|||"):
     return total_score / total_length if total_length != 0 else 0
 
 
+def _get_sampler_batch_meta(f):
+    # TODO V2: multiple src
+    batch_meta = {
+        "base_name": f.base_name,
+        "label": f.label,
+        "no_preprocess": f.no_preprocess,
+        "pattern": f.pattern,
+        "root": f.root,
+        "weight": f.weight,
+    }
+    if f.oversample_as_weights:
+        batch_meta["example_weights"] = f.oversample
+    return batch_meta
+
+
+def _get_sampler_paths(f):
+    paths = {"source": f.files["src"]}
+    tgt_path = f.files.get("tgt")
+    if tgt_path is not None:
+        paths["target"] = tgt_path
+    annotations = f.files.get("annotations")
+    if annotations is not None:
+        for key, path in annotations.items():
+            paths[key] = path
+    return paths
+
+
+def _make_sampled_units(src_line, tgt_line, annot_lines, num_samples):
+    """Yields the TUs of a sampled line with their number of characters."""
+    src_line = src_line.strip()
+    num_chars = len(src_line)
+    if tgt_line:
+        tgt_line = tgt_line.strip()
+        num_chars += len(tgt_line)
+    for key, line in annot_lines.items():
+        annot_lines[key] = line.strip()
+        num_chars += len(annot_lines[key])
+
+    while num_samples > 0:
+        unit = tu.TranslationUnit(
+            source=src_line, target=tgt_line, annotations=annot_lines
+        )
+        yield unit, num_chars
+        num_samples -= 1
+
+
 class SamplerFileLoader(FileLoader):
     """SamplerFileLoader class creates TUs from a SamplerFile object."""
 
-    def __init__(self, f, batch_size):
-        # TODO V2: multiple src
-        batch_meta = {
-            "base_name": f.base_name,
-            "label": f.label,
-            "no_preprocess": f.no_preprocess,
-            "pattern": f.pattern,
-            "root": f.root,
-            "weight": f.weight,
-        }
-        if f.oversample_as_weights:
-            batch_meta["example_weights"] = f.oversample
-
-        super().__init__(batch_size, batch_meta=batch_meta)
+    def __init__(self, f, batch_size, batch_chars=None):
+        super().__init__(
+            batch_size, batch_meta=_get_sampler_batch_meta(f), batch_chars=batch_chars
+        )
         self._file = f
-
-        src_path = f.files["src"]
-        tgt_path = f.files.get("tgt")
-        annotations = f.files.get("annotations")
-
-        self.register_file("source", src_path)
-        if tgt_path is not None:
-            self.register_file("target", tgt_path)
-        if annotations is not None:
-            for key, path in annotations.items():
-                self.register_file(key, path)
+        for name, path in _get_sampler_paths(f).items():
+            self.register_file(name, path)
 
     def _get_translation_units(self, files):
         src_file = files["source"]
@@ -220,30 +280,197 @@ class SamplerFileLoader(FileLoader):
             if num_samples == 0:
                 continue
 
-            src_line = src_line.strip()
-            if tgt_line:
-                tgt_line = tgt_line.strip()
-            for key, line in annot_lines.items():
-                annot_lines[key] = line.strip()
+            for unit in _make_sampled_units(
+                src_line, tgt_line, annot_lines, num_samples
+            ):
+                yield unit
+
+
+class SampledLinesReader(object):
+    """Reads the sampled lines of a range of lines in aligned files.
+
+    A reader only holds the file paths and positions, so it can be sent to a
+    worker process which then reads the lines and builds the TUs.
+    """
+
+    def __init__(self, paths, offsets, first_line, num_lines, samples):
+        """Initializes the reader.
+
+        Args:
+          paths: A dictionary mapping the file names ("source", "target", or an
+            annotation key) to their path.
+          offsets: A dictionary mapping the file names to the byte offset of the
+            first line.
+          first_line: The index of the first line of the range.
+          num_lines: The number of lines in the range.
+          samples: A dictionary mapping the index of the sampled lines to their
+            number of samples.
+        """
+        self._paths = paths
+        self._offsets = offsets
+        self._first_line = first_line
+        self._num_lines = num_lines
+        self._samples = samples
+
+    def read(self):
+        """Returns the list of TUs."""
+        files = {name: open(path, "rb") for name, path in self._paths.items()}
+        try:
+            for name, f in files.items():
+                f.seek(self._offsets[name])
+            src_file = files["source"]
+            tgt_file = files.get("target")
+            annotations = {
+                key: f for key, f in files.items() if key not in ("source", "target")
+            }
 
-            while num_samples > 0:
-                yield tu.TranslationUnit(
-                    source=src_line, target=tgt_line, annotations=annot_lines
+            tu_list = []
+            for i in range(self._first_line, self._first_line + self._num_lines):
+                src_line = src_file.readline()
+                tgt_line = tgt_file.readline() if tgt_file else None
+                annot_lines = {}
+                for key, annot_file in annotations.items():
+                    annot_lines[key] = annot_file.readline()
+
+                num_samples = self._samples.get(i, 0)
+                if num_samples == 0:
+                    continue
+
+                if tgt_line is not None:
+                    tgt_line = tgt_line.decode("utf-8")
+                for key, line in annot_lines.items():
+                    annot_lines[key] = line.decode("utf-8")
+                tu_list.extend(
+                    unit
+                    for unit, _ in _make_sampled_units(
+                        src_line.decode("utf-8"), tgt_line, annot_lines, num_samples
+                    )
                 )
-                num_samples -= 1
+            return tu_list
+        finally:
+            for f in files.values():
+                f.close()
+
+
+def _get_line_offsets(path, line_indices, buffer_size=1 << 20):
+    """Returns the byte offsets of the start of the lines in line_indices (sorted)."""
+    offsets = []
+    targets = iter(line_indices)
+    target = next(targets, None)
+    line = 0
+    position = 0
+    with open(path, "rb") as f:
+        while target is not None:
+            data = f.read(buffer_size)
+            start = 0
+            while target is not None:
+                if target == line:
+                    offsets.append(position + start)
+                    target = next(targets, None)
+                    continue
+                # Skip the rest of the buffer if it does not contain the target line.
+                if line + data.count(b"\n", start) < target:
+                    line += data.count(b"\n", start)
+                    break
+                start = data.index(b"\n", start) + 1
+                line += 1
+            if not data:
+                break
+            position += len(data)
+    if target is not None:
+        raise RuntimeError("Line %d not found in %s" % (target, path))
+    return offsets
+
+
+class SamplerFileReaderLoader(Loader):
+    """Creates batches of SampledLinesReader from a SamplerFile object.
+
+    The TUs are built when the processing function reads the batch, i.e. in the
+    worker processes. The number of characters of a batch is estimated from the
+    average line length of the files. The samples of a line are not split across
+    batches, so a batch can exceed batch_size when its last line is oversampled.
+    """
+
+    def __init__(self, f, batch_size, batch_chars=None):
+        super().__init__(batch_size, batch_chars=batch_chars)
+        self._file = f
+        self._batch_meta = _get_sampler_batch_meta(f)
+        self._paths = _get_sampler_paths(f)
+
+    def __call__(self):
+        f = self._file
+        line_chars = sum(os.path.getsize(path) for path in self._paths.values()) / max(
+            f.lines_count, 1
+        )
+
+        ranges = []
+        samples = {}
+        num_samples = 0
+        for i in sorted(f.random_sample):
+            count = f.random_sample[i]
+            if count == 0:
+                continue
+            samples[i] = count
+            num_samples += count
+            if num_samples >= self._batch_size or (
+                self._batch_chars is not None
+                and num_samples * line_chars >= self._batch_chars
+            ):
+                ranges.append((samples, num_samples))
+                samples = {}
+                num_samples = 0
+        if samples:
+            ranges.append((samples, num_samples))
+        if not ranges:
+            return
+
+        first_lines = [min(samples) for samples, _ in ranges]
+        offsets = {
+            name: _get_line_offsets(path, first_lines)
+            for name, path in self._paths.items()
+        }
+        for index, (samples, num_samples) in enumerate(ranges):
+            first_line = first_lines[index]
+            reader = SampledLinesReader(
+                self._paths,
+                {name: name_offsets[index] for name, name_offsets in offsets.items()},
+                first_line,
+                max(samples) - first_line + 1,
+                samples,
+            )
+            batch_meta = self._batch_meta.copy()
+            batch_meta["num_chars"] = int(num_samples * line_chars)
+            yield reader, batch_meta
 
 
 class SamplerFilesLoader(Loader):
     """Load TUs from a sequence of SamplerFile objects."""
 
-    def __init__(self, files, batch_size):
-        super().__init__(batch_size)
+    def __init__(self, files, batch_size, batch_chars=None, read_in_workers=False):
+        """Initializes the loader.
+
+        Args:
+          files: A list of SamplerFile objects.
+          batch_size: The maximum number of TUs in a batch.
+          batch_chars: The maximum number of characters in a batch.
+          read_in_workers: If True, the batches are SampledLinesReader objects and
+            the lines are read by the processing function (see
+            SamplerFileReaderLoader). Compressed files are always read by the loader.
+        """
+        super().__init__(batch_size, batch_chars=batch_chars)
         self._files = files
+        self._read_in_workers = read_in_workers
 
     def __call__(self):
         for f in self._files:
             if f.lines_kept == 0:
                 continue
-            loader = SamplerFileLoader(f, self._batch_size)
+            if self._read_in_workers and not any(
+                utils.is_gzip_file(path) for path in _get_sampler_paths(f).values()
+            ):
+                loader_class = SamplerFileReaderLoader
+            else:
+                loader_class = SamplerFileLoader
+            loader = loader_class(f, self._batch_size, batch_chars=self._batch_chars)
             for tu_batch in loader():
                 yield tu_batch
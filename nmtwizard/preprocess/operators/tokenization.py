@@ -87,9 +87,15 @@ class Tokenizer(prepoperator.MonolingualOperator):
                     vocab_file.write("%s\n" % token)
                 vocab_file.flush()
                 config["vocabulary_path"] = vocab_file.name
-                current_tokenizer = tokenizer.build_tokenizer(config)
+                current_tokenizer = tokenizer.build_tokenizer(
+                    config, shared=not self.process_type.training
+                )
         else:
-            current_tokenizer = tokenizer.build_tokenizer(config)
+            # Inference tokenizers are shared between the pipelines, for example
+            # the pipelines of models using the same tokenization.
+            current_tokenizer = tokenizer.build_tokenizer(
+                config, shared=not self.process_type.training
+            )
 
         previous_tokenizer = None
         if build_state:
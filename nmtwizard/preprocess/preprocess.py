@@ -3,11 +3,15 @@
 import copy
 import collections
 import functools
+import hashlib
+import json
 import multiprocessing
 import multiprocessing.managers
 import threading
 import os
+import shutil
 import gc
+import time
 
 from nmtwizard import config as config_util
 from nmtwizard import utils
@@ -18,10 +22,14 @@ from nmtwizard.preprocess import loader
 from nmtwizard.preprocess import prepoperator
 from nmtwizard.preprocess import sampler
 from nmtwizard.preprocess import tokenizer
-from nmtwizard.preprocess.tu import TranslationUnit
+from nmtwizard.preprocess.tu import PackedOutputs, TranslationUnit
 
 logger = get_logger(__name__)
 
+# Estimated memory usage per character of the input lines when the batch is
+# processed and its results are sent to the master process.
+_BYTES_PER_CHAR = 40
+
 
 def _get_tok_configs(config):
     tok_configs = []
@@ -68,6 +76,9 @@ def _process_batch(
     shared_state=None,
 ):
     """Rebuilds the pipeline if required and processes a batch of TUs."""
+    if isinstance(tu_batch[0], loader.SampledLinesReader):
+        # The batch lines are read here, i.e. in the worker process.
+        tu_batch = (tu_batch[0].read(), tu_batch[1])
     override_label = _get_corpus_label(tu_batch)
     if pipeline is None or override_label != pipeline.override_label:
         if override_label is None:
@@ -85,6 +96,7 @@ def _process_batch(
         )
 
     tu_list, batch_meta = tu_batch
+    num_chars = batch_meta.get("num_chars")
 
     if not batch_meta.get("no_preprocess"):
         base_name = _get_corpus_name(tu_batch)
@@ -102,6 +114,9 @@ def _process_batch(
             " from %s" % base_name if base_name is not None else "",
         )
 
+    if num_chars is not None:
+        # The master process uses this value to track the prefetched data.
+        batch_meta["num_chars"] = num_chars
     outputs = [tu.export(pipeline.process_type) for tu in tu_list]
     return (outputs, batch_meta), pipeline
 
@@ -119,6 +134,8 @@ def _process_batch_on_worker(
     config=None,
     process_type=None,
     exit_step=None,
+    pack_outputs=False,
+    shard_dir=None,
 ):
     """Processes a batch of TUs using the pipeline cached on the worker process."""
     global worker_pipeline
@@ -134,6 +151,16 @@ def _process_batch_on_worker(
             exit_step=exit_step,
             shared_state=shared_state,
         )
+        if pack_outputs:
+            packed_outputs = PackedOutputs.pack(outputs[0])
+            if packed_outputs is not None:
+                outputs = (packed_outputs, outputs[1])
+        if shard_dir is not None:
+            # Only the shard paths and the batch metadata are returned.
+            shard = consumer.write_sampler_shard(
+                outputs[0], outputs[1], config, shard_dir
+            )
+            outputs = (shard, outputs[1])
     except Exception as e:
         corpus_name = _get_corpus_name(tu_batch)
         worker_name = multiprocessing.current_process().name
@@ -147,6 +174,99 @@ def _process_batch_on_worker(
     return outputs
 
 
+def _make_inference_unit(
+    pipeline, source, target=None, target_name=None, metadata=None
+):
+    """Builds a TU from an inference input."""
+    tu = TranslationUnit(
+        source=source,
+        metadata=metadata,
+        source_tokenizer=pipeline.start_state.get("src_tokenizer"),
+    )
+
+    proc = "Postprocess" if pipeline.process_type.postprocess else "Preprocess"
+    logger.debug(
+        "[%d] %s source input:  %s", threading.current_thread().ident, proc, source
+    )
+
+    if target is not None:
+        tu.add_target(
+            target,
+            name=target_name,
+            tokenizer=pipeline.start_state.get("tgt_tokenizer"),
+        )
+        logger.debug(
+            "[%d] %s target input:  %s",
+            threading.current_thread().ident,
+            proc,
+            target,
+        )
+
+    return tu
+
+
+def _get_inference_result(tu, process_type):
+    """Returns the inference result of a processed TU."""
+    proc = "Postprocess" if process_type.postprocess else "Preprocess"
+    if process_type.postprocess:
+        logger.debug(
+            "[%d] %s target output:  %s",
+            threading.current_thread().ident,
+            proc,
+            tu.tgt_detok,
+        )
+        return tu.tgt_detok
+    src_tokens = tu.src_tok.tokens
+    tgt_tokens = (
+        tu.tgt_tok.tokens if tu.tgt_tok is not None else [None for _ in src_tokens]
+    )
+    logger.debug(
+        "[%d] %s source output:  %s",
+        threading.current_thread().ident,
+        proc,
+        src_tokens,
+    )
+    if tu.tgt_tok is not None:
+        logger.debug(
+            "[%d] %s target output:  %s",
+            threading.current_thread().ident,
+            proc,
+            tgt_tokens,
+        )
+    return src_tokens, tgt_tokens, tu.metadata
+
+
+def _process_inputs_on_worker(
+    inputs,
+    inference_config=None,
+    inference_options=None,
+    config=None,
+    process_type=None,
+):
+    """Processes a list of inference inputs using the pipeline cached on the worker
+    process."""
+    global worker_pipeline
+    try:
+        if worker_pipeline is None:
+            worker_pipeline = prepoperator.Pipeline(
+                config,
+                process_type,
+                inference_config=inference_config,
+                inference_options=inference_options,
+            )
+        tu_list = [
+            _make_inference_unit(worker_pipeline, **example_input)
+            for example_input in inputs
+        ]
+        tu_list, _ = worker_pipeline((tu_list, {}), options=inference_options)
+        return [_get_inference_result(tu, process_type) for tu in tu_list]
+    except Exception as e:
+        worker_name = multiprocessing.current_process().name
+        raise RuntimeError(
+            "An exception occured in worker process %s (see above)" % worker_name
+        ) from e
+
+
 class Processor(object):
     def __init__(
         self, config, pipeline_type, preprocess_exit_step=None, num_workers=None
@@ -179,7 +299,37 @@ class Processor(object):
             num_workers=self._num_workers,
         )
 
-    def process(self, loader, consumer, preprocess_exit_step=None, pipeline=None):
+    def process(
+        self,
+        loader,
+        consumer,
+        preprocess_exit_step=None,
+        pipeline=None,
+        pack_outputs=False,
+        shard_dir=None,
+    ):
+        """Processes the batches of a loader and passes the results to a consumer.
+
+        With multiple workers, the batches are loaded by a thread of the worker
+        pool while the workers process the previous batches and the consumer
+        uses the results. By default the results are consumed in the order in
+        which they are completed. When "ordered_output" is enabled in the "data"
+        configuration, they are consumed in the loading order so that the output
+        is deterministic: "reorder_buffer_size" (2 per worker by default) bounds
+        the number of batches that are loaded, processed, or waiting for a
+        previous batch.
+
+        The batches loaded in advance are limited to the number of workers (or
+        the reorder buffer size), in number of batches or in characters when the
+        loader has a "batch_chars" budget.
+
+        If pack_outputs is True, the workers return the tokenized outputs as
+        PackedOutputs when possible, so the consumer should support both forms.
+        If shard_dir is set, the workers write the outputs of each batch in this
+        directory and the consumer receives consumer.SamplerShard objects instead.
+        """
+        data_config = self._config.get("data", {})
+        garbage_collector = _GarbageCollector()
 
         if self._num_workers == 0:
             logger.info("Start processing")
@@ -202,20 +352,36 @@ class Processor(object):
                     consumer(outputs)
                     del tu_batch
                     del outputs
-                    gc.collect()
+                    garbage_collector.step()
 
         else:
-            logger.info("Start processing using %d worker(s)", self._num_workers)
+            ordered = data_config.get("ordered_output", False)
+            logger.info(
+                "Start processing using %d worker(s)%s",
+                self._num_workers,
+                " in loading order" if ordered else "",
+            )
+
+            # The prefetched data is counted in batches, or in characters if the
+            # loader builds batches with a character budget. One more batch can be
+            # loaded while the consumer uses a result.
+            num_batches = self._get_buffer_size() + 1
+            if loader.batch_chars is not None:
+                capacity = num_batches * loader.batch_chars
+                get_cost = lambda tu_batch: tu_batch[1].get("num_chars", 0)
+            else:
+                capacity = num_batches
+                get_cost = lambda tu_batch: 1
+            prefetch_budget = _PrefetchBudget(capacity)
 
-            def _get_iterator(semaphore):
+            def _get_iterator():
                 for tu_batch in loader():
+                    # Block while the batches loaded in advance exceed the budget.
+                    prefetch_budget.acquire(get_cost(tu_batch))
                     override_label = _get_corpus_label(tu_batch)
                     shared_state = self._global_shared_state.get(override_label)
                     yield tu_batch, shared_state
                     del tu_batch
-                    # If the semaphore value reaches 0, the iterator will block so that no more
-                    # batches are loaded.
-                    semaphore.acquire()
 
             process_func = functools.partial(
                 _process_batch_on_worker,
@@ -224,6 +390,8 @@ class Processor(object):
                 config=self._config,
                 process_type=self._pipeline_type,
                 exit_step=preprocess_exit_step,
+                pack_outputs=pack_outputs,
+                shard_dir=shard_dir,
             )
 
             # Because of the Python GIL (Global Interpreter Lock), we need to use
@@ -232,19 +400,108 @@ class Processor(object):
             # memory usage. This is mitigated by the better stream processing of
             # the loader/consumer which avoids loading the full corpus in memory.
             with multiprocessing.Pool(processes=self._num_workers) as pool:
-                # We use a semaphore to control how many batches can be loaded in advance.
-                buffer_size = self._num_workers
-                semaphore = multiprocessing.Semaphore(buffer_size)
-                iterable = _get_iterator(semaphore)
+                # In ordered mode, the prefetch budget also bounds the completed
+                # batches waiting for a slower batch that was loaded before them.
+                imap_func = pool.imap if ordered else pool.imap_unordered
 
                 with beat_service.monitor_activity() as monitor:
-                    for result in pool.imap_unordered(process_func, iterable):
-                        # Increment the semaphore value to allow loading another batch.
-                        semaphore.release()
+                    for result in imap_func(process_func, _get_iterator()):
+                        # Allow loading another batch.
+                        prefetch_budget.release(get_cost(result))
                         monitor.notify()
                         consumer(result)
                         del result
-                        gc.collect()
+                        garbage_collector.step()
+
+    def _get_buffer_size(self):
+        """Returns the number of batches that can be loaded in advance."""
+        data_config = self._config.get("data", {})
+        if data_config.get("ordered_output", False):
+            return data_config.get("reorder_buffer_size", 2 * self._num_workers)
+        return self._num_workers
+
+    def _get_batch_limits(self):
+        """Returns the maximum number of TUs and characters in a batch."""
+        data_config = self._config.get("data", {})
+        batch_size = data_config.get("batch_size", 100000)
+        batch_chars = data_config.get("batch_chars")
+        memory_limit = data_config.get("memory_limit")
+        if batch_chars is None and memory_limit:
+            # Batches are processed by the workers while others are loaded in
+            # advance or consumed.
+            if self._num_workers > 0:
+                num_batches = self._get_buffer_size() + 2
+            else:
+                num_batches = 1
+            batch_chars = max(int(memory_limit / (num_batches * _BYTES_PER_CHAR)), 1)
+            logger.info(
+                "Using batches of %d characters for a memory limit of %d bytes",
+                batch_chars,
+                memory_limit,
+            )
+        return batch_size, batch_chars
+
+
+class _PrefetchBudget(object):
+    """Limits the amount of data loaded in advance.
+
+    This is similar to a semaphore where each batch acquires an amount of the
+    capacity. A batch larger than the capacity is accepted when no other batch is
+    loaded.
+    """
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, amount):
+        with self._condition:
+            while self._used > 0 and self._used + amount > self._capacity:
+                self._condition.wait()
+            self._used += amount
+
+    def release(self, amount):
+        with self._condition:
+            self._used -= amount
+            self._condition.notify_all()
+
+
+class _GarbageCollector(object):
+    """Runs full garbage collections between batches when they are useful.
+
+    Most objects of a batch are freed by reference counting, and a full collection
+    after each batch is costly when the heap is large. A collection is run every
+    "interval" batches: the interval is doubled when the last collection freed
+    less than min_collected objects, and reset to 1 otherwise. Collections are
+    also skipped while they used more than max_time_ratio of the processing time.
+    """
+
+    def __init__(self, min_collected=1000, max_interval=64, max_time_ratio=0.05):
+        self._min_collected = min_collected
+        self._max_interval = max_interval
+        self._max_time_ratio = max_time_ratio
+        self._interval = 1
+        self._num_batches = 0
+        self._collect_time = 0
+        self._start_time = time.time()
+
+    def step(self):
+        """Called after each batch, collects the garbage if needed."""
+        self._num_batches += 1
+        if self._num_batches < self._interval:
+            return
+        elapsed_time = time.time() - self._start_time
+        if self._collect_time > self._max_time_ratio * elapsed_time:
+            return
+        self._num_batches = 0
+        start = time.time()
+        collected = gc.collect()
+        self._collect_time += time.time() - start
+        if collected < self._min_collected:
+            self._interval = min(2 * self._interval, self._max_interval)
+        else:
+            self._interval = 1
 
 
 class TrainingProcessor(Processor):
@@ -302,8 +559,15 @@ class TrainingProcessor(Processor):
             all_files, summary = sampler.sample(
                 self._config, data_path, oversample_as_weights
             )
-            batch_size = self._config.get("data", {}).get("batch_size", 100000)
-            sampler_loader = loader.SamplerFilesLoader(all_files, batch_size)
+            batch_size, batch_chars = self._get_batch_limits()
+            sampler_loader = loader.SamplerFilesLoader(
+                all_files,
+                batch_size,
+                batch_chars=batch_chars,
+                read_in_workers=self._config.get("data", {}).get(
+                    "read_in_workers", False
+                ),
+            )
             sampler_consumer = consumer.MultiConsumer(
                 [
                     consumer.OpsProfileLogger(),
@@ -312,6 +576,7 @@ class TrainingProcessor(Processor):
             )
 
             new_tokens_consumer = None
+            shard_dir = None
             if result == "subword":
                 sampler_consumer.add(
                     consumer.SubwordLearner(
@@ -332,15 +597,24 @@ class TrainingProcessor(Processor):
                         self._config, result_dir, preprocess_exit_step, summary
                     )
                 )
+                if self._num_workers > 0 and self._config.get("data", {}).get(
+                    "write_in_workers", False
+                ):
+                    shard_dir = os.path.join(result_dir, ".shards")
+                    os.makedirs(shard_dir, exist_ok=True)
 
             logger.info("Generating data to %s", result_dir)
             self.process(
                 sampler_loader,
                 sampler_consumer,
                 preprocess_exit_step=preprocess_exit_step,
+                pack_outputs=True,
+                shard_dir=shard_dir,
             )
 
             sampler_consumer.finalize()
+            if shard_dir is not None:
+                shutil.rmtree(shard_dir)
             num_samples = sampler_consumer.num_samples
             tokens_to_add = None
             if new_tokens_consumer is not None:
@@ -453,10 +727,43 @@ class TrainingProcessor(Processor):
 
 
 class InferenceProcessor(Processor):
-    def __init__(self, config, task=utils.Task.TRANSLATION, postprocess=False):
+    def __init__(
+        self,
+        config,
+        task=utils.Task.TRANSLATION,
+        postprocess=False,
+        pool_size=0,
+        pool_min_inputs=256,
+        pipeline_cache_size=16,
+    ):
+        """Initializes the processor.
+
+        Args:
+          config: The run configuration.
+          task: The task of the processing pipeline.
+          postprocess: If True, build a postprocessing pipeline.
+          pool_size: Number of worker processes used by process_inputs for large
+            lists of inputs. If 0, the inputs are always processed in the current
+            process.
+          pool_min_inputs: Minimum number of inputs to process with the worker
+            processes.
+          pipeline_cache_size: Maximum number of pipelines built for configuration
+            overrides that are kept in memory. If 0, a new pipeline is built for
+            each override.
+        """
         process_type = prepoperator.ProcessType(task, postprocess=postprocess)
         super().__init__(config, process_type, num_workers=0)
         self._postprocess = postprocess
+        self._pool_size = pool_size
+        self._pool_min_inputs = pool_min_inputs
+        self._pool = None
+        self._pool_users = 0
+        self._pool_closed = False
+        self._pool_lock = threading.Lock()
+        self._pipeline_cache = collections.OrderedDict()
+        self._pipeline_cache_size = pipeline_cache_size
+        self._pipeline_cache_lock = threading.Lock()
+        self._pipeline_cache_stats = collections.Counter()
         # Build a generic pipeline that will be used in process_input.
         self._pipeline = self.build_pipeline(self._config)
 
@@ -469,6 +776,48 @@ class InferenceProcessor(Processor):
             shared_state=self._global_shared_state.get(),
         )
 
+    def _get_pipeline(self, config=None):
+        # Rebuild pipeline if the example has its own configuration.
+        if config:
+            if config_util.is_v2_config(self._config):
+                raise ValueError(
+                    "Configuration override is not supported for V2 configurations"
+                )
+            key = hashlib.sha1(
+                json.dumps(config, sort_keys=True, default=str).encode("utf-8")
+            ).hexdigest()
+            with self._pipeline_cache_lock:
+                pipeline = self._pipeline_cache.get(key)
+                if pipeline is not None:
+                    self._pipeline_cache.move_to_end(key)
+                    self._pipeline_cache_stats["hits"] += 1
+                    return pipeline
+                self._pipeline_cache_stats["misses"] += 1
+
+            config = config_util.merge_config(copy.deepcopy(self._config), config)
+            pipeline = self.build_pipeline(config)
+
+            if self._pipeline_cache_size > 0:
+                with self._pipeline_cache_lock:
+                    self._pipeline_cache[key] = pipeline
+                    self._pipeline_cache.move_to_end(key)
+                    while len(self._pipeline_cache) > self._pipeline_cache_size:
+                        self._pipeline_cache.popitem(last=False)
+                        self._pipeline_cache_stats["evictions"] += 1
+            return pipeline
+        return self._pipeline
+
+    def pipeline_cache_stats(self):
+        """Returns statistics about the cache of pipelines built for configuration
+        overrides."""
+        with self._pipeline_cache_lock:
+            return {
+                "entries": len(self._pipeline_cache),
+                "hits": self._pipeline_cache_stats["hits"],
+                "misses": self._pipeline_cache_stats["misses"],
+                "evictions": self._pipeline_cache_stats["evictions"],
+            }
+
     def process_input(
         self,
         source,
@@ -496,72 +845,101 @@ class InferenceProcessor(Processor):
         """
         # This method should be thread-safe as the inference server is starting a new
         # thread for each request.
-
-        # Rebuild pipeline if the example has its own configuration.
-        if config:
-            if config_util.is_v2_config(self._config):
-                raise ValueError(
-                    "Configuration override is not supported for V2 configurations"
-                )
-            config = config_util.merge_config(copy.deepcopy(self._config), config)
-            pipeline = self.build_pipeline(config)
-        else:
-            pipeline = self._pipeline
-
-        tu = TranslationUnit(
-            source=source,
+        pipeline = self._get_pipeline(config)
+        tu = _make_inference_unit(
+            pipeline,
+            source,
+            target=target,
+            target_name=target_name,
             metadata=metadata,
-            source_tokenizer=pipeline.start_state.get("src_tokenizer"),
-        )
-
-        proc = "Postprocess" if self._postprocess else "Preprocess"
-        logger.debug(
-            "[%d] %s source input:  %s", threading.current_thread().ident, proc, source
         )
 
-        if target is not None:
-            tu.add_target(
-                target,
-                name=target_name,
-                tokenizer=pipeline.start_state.get("tgt_tokenizer"),
-            )
-            logger.debug(
-                "[%d] %s target input:  %s",
-                threading.current_thread().ident,
-                proc,
-                target,
-            )
-
         tu_batch = ([tu], {})
         tu_batch = pipeline(tu_batch, options=options)
         tu = tu_batch[0][0]
+        return _get_inference_result(tu, self._pipeline_type)
 
-        if self._postprocess:
-            logger.debug(
-                "[%d] %s target output:  %s",
-                threading.current_thread().ident,
-                proc,
-                tu.tgt_detok,
-            )
-            return tu.tgt_detok
-        src_tokens = tu.src_tok.tokens
-        tgt_tokens = (
-            tu.tgt_tok.tokens if tu.tgt_tok is not None else [None for _ in src_tokens]
-        )
-        logger.debug(
-            "[%d] %s source output:  %s",
-            threading.current_thread().ident,
-            proc,
-            src_tokens,
+    def process_inputs(self, inputs, config=None, options=None):
+        """Processes multiple translation examples at inference in a single batch.
+
+        Args:
+          inputs: A list of dictionaries with the "source", "target", "target_name",
+            and "metadata" arguments of process_input (only "source" is required).
+          config: A configuration override shared by all examples.
+          options: A dictionary with operators options shared by all examples.
+
+        Returns:
+          A list with the result of process_input for each input.
+        """
+        if not config and self._pool_size > 0 and len(inputs) >= self._pool_min_inputs:
+            results = self._process_on_pool(inputs, options)
+            if results is not None:
+                return results
+
+        pipeline = self._get_pipeline(config)
+        tu_list = [
+            _make_inference_unit(pipeline, **example_input) for example_input in inputs
+        ]
+        tu_list, _ = pipeline((tu_list, {}), options=options)
+        return [_get_inference_result(tu, self._pipeline_type) for tu in tu_list]
+
+    def _process_on_pool(self, inputs, options):
+        """Processes the inputs with the worker processes. Returns None if the
+        processor is closed."""
+        with self._pool_lock:
+            if self._pool_closed:
+                return None
+            if self._pool is None:
+                logger.info(
+                    "Starting %d worker processes for %s",
+                    self._pool_size,
+                    "postprocessing" if self._postprocess else "preprocessing",
+                )
+                # The serving threads may hold locks (e.g. in logging) that would
+                # never be released in forked workers.
+                self._pool = _get_pool_context().Pool(processes=self._pool_size)
+            pool = self._pool
+            self._pool_users += 1
+
+        process_func = functools.partial(
+            _process_inputs_on_worker,
+            inference_config=self._inference_config,
+            inference_options=(
+                options if options is not None else self._inference_options
+            ),
+            config=self._config,
+            process_type=self._pipeline_type,
         )
-        if tu.tgt_tok is not None:
-            logger.debug(
-                "[%d] %s target output:  %s",
-                threading.current_thread().ident,
-                proc,
-                tgt_tokens,
-            )
-        return src_tokens, tgt_tokens, tu.metadata
+
+        chunk_size = (len(inputs) + self._pool_size - 1) // self._pool_size
+        chunks = [inputs[i : i + chunk_size] for i in range(0, len(inputs), chunk_size)]
+        results = []
+        try:
+            for chunk_results in pool.map(process_func, chunks):
+                results.extend(chunk_results)
+        finally:
+            with self._pool_lock:
+                self._pool_users -= 1
+                # The pool is terminated by its last user when the processor is closed.
+                terminate = self._pool_closed and self._pool_users == 0
+            if terminate:
+                pool.terminate()
+        return results
+
+    def close(self):
+        """Terminates the worker processes, if any.
+
+        The worker processes are terminated once the inputs they are processing are
+        completed. The inputs are then processed in the current process.
+        """
+        with self._pool_lock:
+            self._pool_closed = True
+            pool = self._pool
+            self._pool = None
+            if self._pool_users > 0:
+                pool = None
+        if pool is not None:
+            pool.terminate()
 
     def process_file(
         self,
@@ -592,7 +970,7 @@ class InferenceProcessor(Processor):
                 path = path[:-3]
             return "%s.%s" % (path, suffix)
 
-        batch_size = self._config.get("data", {}).get("batch_size", 100000)
+        batch_size, batch_chars = self._get_batch_limits()
 
         if self._postprocess:
             file_loader = loader.PostprocessFileLoader(
@@ -602,6 +980,7 @@ class InferenceProcessor(Processor):
                 start_state=self._pipeline.start_state,
                 batch_size=batch_size,
                 target_score_type=target_score_type,
+                batch_chars=batch_chars,
             )
             file_consumer = consumer.PostprocessFileWriter(
                 _build_output_path(target_file, "detok")
@@ -611,6 +990,7 @@ class InferenceProcessor(Processor):
                 source_file,
                 target_file,
                 batch_size=batch_size,
+                batch_chars=batch_chars,
             )
             file_consumer = consumer.PreprocessFileWriter(
                 _build_output_path(source_file, "tok"),
@@ -630,6 +1010,13 @@ class InferenceProcessor(Processor):
             return file_consumer.outputs
 
 
+def _get_pool_context():
+    """Returns the multiprocessing context of the inference worker processes."""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
 class SharedManager(multiprocessing.managers.BaseManager):
     """Custom manager for shared resources with multiprocessing."""
 
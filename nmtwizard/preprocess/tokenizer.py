@@ -1,5 +1,11 @@
 """Tokenization utilities."""
 
+import hashlib
+import json
+import os
+import threading
+import weakref
+
 import pyonmttok
 
 _ALLOWED_TOKENIZER_ARGS = set(
@@ -33,13 +39,27 @@ _ALLOWED_TOKENIZER_ARGS = set(
 )
 
 
+_PATH_ARGS = ("bpe_model_path", "sp_model_path", "vocabulary_path")
+
+# Tokenizers built with shared=True, by arguments. The tokenizers are removed when
+# they are no longer used.
+_shared_tokenizers = weakref.WeakValueDictionary()
+_shared_tokenizers_lock = threading.Lock()
+
+
 def _is_valid_language_code(lang):
     # TODO: consider exposing this function in pyonmttok.
     return len(lang) == 2 and lang not in ("xx", "yy")
 
 
-def build_tokenizer(args):
-    """Builds a tokenizer based on user arguments."""
+def build_tokenizer(args, shared=False):
+    """Builds a tokenizer based on user arguments.
+
+    If shared is True, the same tokenizer instance is returned for arguments
+    referencing files with the same content (e.g. the same BPE model bundled in
+    several model packages). Shared tokenizers should not be used with
+    subword regularization.
+    """
     args = {
         name: value for name, value in args.items() if name in _ALLOWED_TOKENIZER_ARGS
     }
@@ -48,7 +68,38 @@ def build_tokenizer(args):
     lang = args.get("lang")
     if lang is not None and not _is_valid_language_code(lang):
         args.pop("lang")
-    return pyonmttok.Tokenizer(**args)
+    if not shared:
+        return pyonmttok.Tokenizer(**args)
+
+    key = _get_tokenizer_key(args)
+    with _shared_tokenizers_lock:
+        tokenizer = _shared_tokenizers.get(key)
+        if tokenizer is None:
+            tokenizer = pyonmttok.Tokenizer(**args)
+            _shared_tokenizers[key] = tokenizer
+        return tokenizer
+
+
+def _get_tokenizer_key(args):
+    """Returns a key identifying the tokenizer arguments and the content of the
+    files they reference."""
+    key_args = dict(args)
+    for name in _PATH_ARGS:
+        path = key_args.get(name)
+        if path and os.path.isfile(path):
+            key_args[name] = _get_file_digest(path)
+    return json.dumps(key_args, sort_keys=True)
+
+
+def _get_file_digest(path, buffer_size=65536):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(buffer_size)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
 
 
 def make_subword_learner(subword_config, subword_dir, tokenizer=None):
@@ -1,3 +1,5 @@
+import array
+import collections
 import copy
 import itertools
 import pyonmttok
@@ -49,6 +51,129 @@ class PreprocessOutput:
         self.alignment = alignment
 
 
+PackedSide = collections.namedtuple("PackedSide", ("data", "num_parts"))
+
+
+def _int_array(values=()):
+    return array.array("i", values)
+
+
+def _pack_side(parts_list):
+    """Packs the tokens of one side, or returns None if they can not be packed."""
+    lines = []
+    num_parts = _int_array()
+    for parts in parts_list:
+        if not isinstance(parts, list):
+            return None
+        for tokens in parts:
+            if not isinstance(tokens, list) or "" in tokens:
+                return None
+            line = " ".join(tokens)
+            # Tokens should not contain the separators.
+            if line.count(" ") != max(len(tokens) - 1, 0) or "\n" in line:
+                return None
+            lines.append(line)
+        num_parts.append(len(parts))
+    lines.append("")
+    return PackedSide("\n".join(lines).encode("utf-8"), num_parts)
+
+
+def _pack_alignment(alignments):
+    """Packs the alignments of each output in an int array.
+
+    For each output, the array contains the number of aligned parts and then for
+    each part the number of links followed by the source and target indices.
+    """
+    packed = _int_array()
+    for alignment in alignments:
+        if not alignment:
+            packed.append(0)
+            continue
+        packed.append(len(alignment))
+        for part in alignment:
+            packed.append(len(part))
+            for src, tgt in part:
+                packed.append(int(src))
+                packed.append(int(tgt))
+    return packed
+
+
+class PackedOutputs(object):
+    """Preprocess outputs of a batch packed in a few buffers.
+
+    The outputs are faster to send from the worker processes than a list of
+    PreprocessOutput with a str object per token. Each side is packed in a
+    PackedSide: the UTF-8 encoding of all lines (one line per part with the tokens
+    separated by spaces) and the number of parts of each output. The alignments
+    are packed in an int array.
+    """
+
+    __slots__ = ["src", "tgt", "metadata", "alignment"]
+
+    def __init__(self, src, tgt, metadata, alignment):
+        self.src = src
+        self.tgt = tgt
+        self.metadata = metadata
+        self.alignment = alignment
+
+    @classmethod
+    def pack(cls, outputs):
+        """Packs a list of tokenized PreprocessOutput.
+
+        Returns:
+          A PackedOutputs instance, or None if some outputs are not tokenized or
+          some tokens contain a space or a newline.
+        """
+        src = _pack_side([output.src for output in outputs])
+        if src is None:
+            return None
+        if all(output.tgt is None for output in outputs):
+            tgt = None
+        else:
+            tgt = _pack_side([output.tgt for output in outputs])
+            if tgt is None:
+                return None
+        try:
+            alignment = _pack_alignment([output.alignment for output in outputs])
+        except (TypeError, ValueError):
+            return None
+        metadata = [output.metadata for output in outputs]
+        return cls(src, tgt, metadata, alignment)
+
+    def __len__(self):
+        return len(self.src.num_parts)
+
+    def get_data(self, side):
+        """Returns the UTF-8 lines of a side ("src" or "tgt"), or None."""
+        packed_side = getattr(self, side)
+        return packed_side.data if packed_side is not None else None
+
+    def iter_tokens(self, side):
+        """Yields the tokens of each line of a side ("src" or "tgt")."""
+        data = self.get_data(side)
+        if not data:
+            return
+        for line in data.decode("utf-8").split("\n")[:-1]:
+            yield line.split(" ") if line else []
+
+    def get_all_tokens(self, side):
+        """Returns an iterator over all tokens of a side ("src" or "tgt")."""
+        data = self.get_data(side)
+        if not data:
+            return iter(())
+        # Empty lines produce empty strings that are filtered out.
+        return filter(None, data.decode("utf-8").replace("\n", " ").split(" "))
+
+    def iter_alignment_lines(self):
+        """Yields the alignments of each aligned part in the Pharaoh format."""
+        links = iter(self.alignment)
+        for num_aligned_parts in links:
+            for _ in range(num_aligned_parts):
+                num_links = next(links)
+                part = ["%d-%d" % (next(links), next(links)) for _ in range(num_links)]
+                yield " ".join(sorted(part))
+
+
 class TokReplace:
     """Structure for token replacement in tokenization."""
 
@@ -0,0 +1,104 @@
+"""Serialization of the serving payloads."""
+
+import gzip
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONSerializer(object):
+    """Serializer based on the json module of the standard library."""
+
+    name = "json"
+
+    def loads(self, data):
+        """Decodes a UTF-8 JSON document."""
+        return json.loads(data.decode("utf-8"))
+
+    def dumps(self, obj):
+        """Encodes an object to a UTF-8 JSON document."""
+        return json.dumps(obj).encode("utf-8")
+
+
+class OrjsonSerializer(object):
+    """Serializer based on the orjson package."""
+
+    name = "orjson"
+
+    def __init__(self):
+        if orjson is None:
+            raise ValueError("The orjson package is not installed")
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+_SERIALIZERS = {
+    JSONSerializer.name: JSONSerializer,
+    OrjsonSerializer.name: OrjsonSerializer,
+}
+
+
+def get_serializer(name="auto"):
+    """Returns a serializer.
+
+    Args:
+      name: The serializer name: "json", "orjson", or "auto" to select the fastest
+        serializer that is installed.
+
+    Raises:
+      ValueError: if the serializer is unknown or not installed.
+    """
+    if name == "auto":
+        name = OrjsonSerializer.name if orjson is not None else JSONSerializer.name
+    serializer_class = _SERIALIZERS.get(name)
+    if serializer_class is None:
+        raise ValueError(
+            "Invalid serializer '%s', expected one of: auto, %s"
+            % (name, ", ".join(sorted(_SERIALIZERS)))
+        )
+    return serializer_class()
+
+
+def accepts_gzip(accept_encoding):
+    """Returns True if the Accept-Encoding header value accepts gzip."""
+    if not accept_encoding:
+        return False
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() not in ("gzip", "x-gzip"):
+            continue
+        params = params.replace(" ", "")
+        return params not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def gzip_compress(data, compresslevel=6):
+    """Compresses data in the gzip format."""
+    return gzip.compress(data, compresslevel=compresslevel)
+
+
+def gzip_compress_stream(chunks, compresslevel=6):
+    """Compresses an iterator of chunks in a single gzip stream.
+
+    Each compressed chunk is flushed so that the client can decompress the data
+    received so far.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
@@ -1,20 +1,79 @@
 import collections
+import contextlib
+import heapq
+import itertools
 import json
-import functools
 import logging
+import math
+import select
 import signal
+import sys
 import threading
 import copy
+import functools
 import socket
 import time
 import socketserver
 import http.server
+import concurrent.futures
 
+from nmtwizard import async_server
 from nmtwizard import config as config_util
+from nmtwizard import metrics
+from nmtwizard import serialization
 from nmtwizard.logger import get_logger
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 logger = get_logger(__name__)
 
+_REQUESTS = metrics.Counter(
+    "nmtwizard_requests_total",
+    "Number of HTTP requests by route and status code.",
+    ("route", "code"),
+)
+_REQUEST_LATENCY = metrics.Histogram(
+    "nmtwizard_request_latency_seconds",
+    "Latency of HTTP requests by route.",
+    ("route",),
+)
+_REQUESTS_IN_FLIGHT = metrics.Gauge(
+    "nmtwizard_requests_in_flight",
+    "Number of HTTP requests being processed.",
+)
+_STAGE_LATENCY = metrics.Histogram(
+    "nmtwizard_stage_latency_seconds",
+    "Latency of each processing stage of the translation requests.",
+    ("stage",),
+)
+_CANCELLED_REQUESTS = metrics.Counter(
+    "nmtwizard_cancelled_requests_total",
+    "Number of translation requests stopped before completion by reason and stage.",
+    ("reason", "stage"),
+)
+_WARMUP_LATENCY = metrics.Gauge(
+    "nmtwizard_warmup_seconds",
+    "Duration of the warm-up requests by source length.",
+    ("length",),
+)
+_BATCHES_IN_FLIGHT = metrics.Gauge(
+    "nmtwizard_batches_in_flight",
+    "Number of batches being translated by the backend.",
+)
+_BATCH_SIZE = metrics.Histogram(
+    "nmtwizard_batch_size",
+    "Number of parts in the batches sent to the backend.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512),
+)
+_BATCH_TOKENS = metrics.Histogram(
+    "nmtwizard_batch_tokens",
+    "Number of source tokens in the batches sent to the backend.",
+    buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384),
+)
+
 
 class TranslationOutput(object):
     """Simple structure holding translation outputs."""
@@ -52,10 +111,21 @@ class TranslationBatch(
             "source_tokens",
             "target_tokens",
             "mode",
+            "parts",
         ),
     )
 ):
-    pass
+    """A batch of parts to translate.
+
+    The "parts" field contains the position of each entry in the parts of its
+    example, or None when the parts are in the same order as in the examples.
+    """
+
+    def __new__(cls, indices, source_tokens, target_tokens, mode, parts=None):
+        return super().__new__(cls, indices, source_tokens, target_tokens, mode, parts)
+
+
+ALIGN_FORMATS = ("nested", "flat")
 
 
 class InvalidRequest(Exception):
@@ -66,6 +136,1205 @@ class TranslationTimeout(Exception):
     pass
 
 
+class BackendUnavailable(Exception):
+    """Raised by translation functions when the backend cannot be reached."""
+
+    pass
+
+
+class Deadline(object):
+    """The deadline of a translation request.
+
+    The deadline starts when the object is created and expires after timeout
+    seconds, or as soon as is_cancelled returns True (e.g. when the client closed
+    the connection). Each processing stage calls check() so that the remaining
+    work is skipped once the deadline expired.
+    """
+
+    def __init__(self, timeout=None, is_cancelled=None):
+        """Initializes the deadline.
+
+        Args:
+          timeout: The maximum duration of the request in seconds. If None, the
+            request can only be cancelled.
+          is_cancelled: A callable returning True if the request is cancelled.
+        """
+        self._expire_time = time.time() + timeout if timeout is not None else None
+        self._is_cancelled = is_cancelled
+
+    def remaining(self):
+        """Returns the remaining time in seconds, or None if there is no timeout."""
+        if self._expire_time is None:
+            return None
+        return max(self._expire_time - time.time(), 0)
+
+    def check(self, stage):
+        """Raises TranslationTimeout if the request should be stopped.
+
+        Args:
+          stage: The name of the stage that is about to start.
+        """
+        if self._is_cancelled is not None and self._is_cancelled():
+            _CANCELLED_REQUESTS.labels("cancelled", stage).inc()
+            raise TranslationTimeout("the request was cancelled before %s" % stage)
+        if self._expire_time is not None and time.time() >= self._expire_time:
+            _CANCELLED_REQUESTS.labels("deadline", stage).inc()
+            raise TranslationTimeout("the request deadline expired before %s" % stage)
+
+
+class _PendingBatch(object):
+    """A batch waiting in the BatchScheduler queue."""
+
+    def __init__(self, source_tokens, target_tokens, options):
+        self.source_tokens = source_tokens
+        self.target_tokens = target_tokens
+        self.options = options
+        self.key = json.dumps(options, sort_keys=True, default=str)
+        self.size = len(source_tokens)
+        self.max_length = max((len(tokens) for tokens in source_tokens), default=0)
+        self.time = time.time()
+        self.future = concurrent.futures.Future()
+        # The position in the queue.
+        self.order = None
+        self.fair_queue = None
+        self.fair_entry = None
+
+
+class BatchScheduler(object):
+    """Gathers batches from concurrent requests into shared backend batches.
+
+    Batches submitted with the same translation options are merged until
+    max_batch_size or max_batch_tokens is reached, or the oldest batch waited
+    more than max_delay seconds. The scheduler is a callable with the same
+    signature as the translation function passed to translate_examples.
+
+    Batches are queued in submission order. When they are submitted by a
+    FairQueue (see FairQueue.wrap), they are queued in weighted fair order
+    instead: a merged batch starts with the queued batch that has the smallest
+    finish tag and is completed with the next compatible batches in this order.
+    """
+
+    def __init__(
+        self,
+        translate_fn,
+        max_batch_size=None,
+        max_batch_tokens=None,
+        max_delay=0.005,
+        num_workers=1,
+    ):
+        """Initializes the scheduler.
+
+        Args:
+          translate_fn: A callable that forwards a batch to the translation backend.
+          max_batch_size: The maximum number of parts in a merged batch.
+          max_batch_tokens: The maximum number of source tokens in a merged batch,
+            including padding.
+          max_delay: The maximum time in seconds a batch waits for other batches.
+          num_workers: The number of merged batches that are translated
+            concurrently (e.g. the number of backend replicas).
+        """
+        self._translate_fn = translate_fn
+        self._max_batch_size = max_batch_size
+        self._max_batch_tokens = max_batch_tokens
+        self._max_delay = max_delay
+        self._queue = collections.deque()
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._workers = threading.Semaphore(num_workers)
+        self._executor = (
+            concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+            if num_workers > 1
+            else None
+        )
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __call__(self, source_tokens, target_tokens, options):
+        return self.submit(source_tokens, target_tokens, options)
+
+    def submit(self, source_tokens, target_tokens, options, fair_queue=None, flow=None):
+        """Submits a batch and waits for its translation.
+
+        Args:
+          source_tokens: The batch source tokens.
+          target_tokens: The batch target tokens.
+          options: The translation options.
+          fair_queue: The FairQueue ordering the batch, if any.
+          flow: The FairQueue flow of the request submitting the batch.
+        """
+        pending = _PendingBatch(source_tokens, target_tokens, options)
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("the batch scheduler is stopped")
+            if fair_queue is not None:
+                pending.fair_queue = fair_queue
+                pending.fair_entry = fair_queue.enqueue(flow, source_tokens)
+                # Order by (finish_tag, counter).
+                pending.order = pending.fair_entry[:2]
+            else:
+                # Batches without a fair queue tag are processed first in FIFO order.
+                pending.order = (0, next(self._counter))
+            self._queue.append(pending)
+            self._condition.notify_all()
+        return pending.future.result()
+
+    @property
+    def max_batch_size(self):
+        return self._max_batch_size
+
+    @max_batch_size.setter
+    def max_batch_size(self, max_batch_size):
+        with self._condition:
+            self._max_batch_size = max_batch_size
+
+    def stop(self):
+        """Stops the scheduler once the queued batches are processed."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def _accepts_size(self, size, max_length=0):
+        if self._max_batch_size is not None and size > self._max_batch_size:
+            return False
+        if (
+            self._max_batch_tokens is not None
+            and size * max_length > self._max_batch_tokens
+        ):
+            return False
+        return True
+
+    def _next_batches(self):
+        """Returns the next list of pending batches to merge, or None when stopped."""
+        with self._condition:
+            while not self._queue:
+                if self._stopped:
+                    return None
+                self._condition.wait()
+
+            first = min(self._queue, key=_get_order)
+            self._queue.remove(first)
+            batches = [first]
+            size = first.size
+            max_length = first.max_length
+            deadline = first.time + self._max_delay
+            full = not self._accepts_size(size + 1, max_length)
+
+            while not full:
+                for pending in sorted(self._queue, key=_get_order):
+                    if pending.key != first.key:
+                        continue
+                    new_max_length = max(max_length, pending.max_length)
+                    if not self._accepts_size(size + pending.size, new_max_length):
+                        full = True
+                        break
+                    self._queue.remove(pending)
+                    batches.append(pending)
+                    size += pending.size
+                    max_length = new_max_length
+                if (
+                    full
+                    or self._stopped
+                    or not self._accepts_size(size + 1, max_length)
+                ):
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            return batches
+
+    def _run(self):
+        while True:
+            # Wait for a free worker so that batches keep being merged meanwhile.
+            self._workers.acquire()
+            batches = self._next_batches()
+            if batches is None:
+                break
+            if self._executor is None:
+                self._process(batches)
+            else:
+                self._executor.submit(self._process, batches)
+
+    def _process(self, batches):
+        try:
+            self._translate_batches(batches)
+        finally:
+            self._workers.release()
+
+    def _translate_batches(self, batches):
+        source_tokens = []
+        target_tokens = []
+        start = time.time()
+        for pending in batches:
+            if pending.fair_queue is not None:
+                pending.fair_queue.start(pending.fair_entry)
+            source_tokens.extend(pending.source_tokens)
+            target_tokens.extend(pending.target_tokens)
+            _STAGE_LATENCY.labels("queue").observe(start - pending.time)
+
+        logger.debug(
+            "Merged %d batches in a batch of size %d", len(batches), len(source_tokens)
+        )
+
+        try:
+            hypotheses = self._translate_fn(
+                source_tokens, target_tokens, batches[0].options
+            )
+        except Exception as e:
+            for pending in batches:
+                pending.future.set_exception(e)
+            return
+
+        offset = 0
+        for pending in batches:
+            if hypotheses is None:
+                pending.future.set_result(None)
+            else:
+                pending.future.set_result(hypotheses[offset : offset + pending.size])
+            offset += pending.size
+
+
+def _get_order(pending):
+    return pending.order
+
+
+class _Flow(object):
+    """The work units of a request in the FairQueue."""
+
+    def __init__(self, priority, weight):
+        self.priority = priority
+        self.weight = weight
+        self.finish_tag = 0
+
+
+class FairQueue(object):
+    """Weighted fair queuing of the translation work units of concurrent requests.
+
+    At most num_workers work units (i.e. calls to the translation function) are
+    processed concurrently. When units are waiting, the next one is selected with
+    weighted fair queuing: each request is a flow whose units are tagged with a
+    virtual finish time that increases by the number of source tokens divided by
+    the weight of the request priority class. Small requests are then served
+    between the work units of large requests, and classes with a higher weight
+    receive a larger share of the backend.
+
+    When the translation function is a BatchScheduler, the units are queued in
+    the scheduler in the same order so that they can be merged with other units
+    (see BatchScheduler), and num_workers is not used.
+    """
+
+    def __init__(self, weights, num_workers=1):
+        """Initializes the queue.
+
+        Args:
+          weights: A dictionary mapping priority class names to weights.
+          num_workers: The maximum number of work units processed concurrently.
+        """
+        self._weights = weights
+        self._num_workers = num_workers
+        self._num_active = 0
+        self._virtual_time = 0
+        self._waiting = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    @property
+    def priorities(self):
+        return list(self._weights.keys())
+
+    def num_waiting(self):
+        """Returns the number of waiting work units per priority class."""
+        with self._condition:
+            counts = {priority: 0 for priority in self._weights}
+            for _, _, priority, _ in self._waiting:
+                counts[priority] += 1
+            return counts
+
+    def wrap(self, translate_fn, priority):
+        """Returns a translation function scheduling the calls as a new flow.
+
+        Args:
+          translate_fn: The translation function to call.
+          priority: The priority class of the request.
+
+        Raises:
+          InvalidRequest: if the priority class is unknown.
+        """
+        weight = self._weights.get(priority)
+        if weight is None:
+            raise InvalidRequest(
+                "Invalid priority '%s', expected one of: %s"
+                % (priority, ", ".join(sorted(self._weights)))
+            )
+        flow = _Flow(priority, weight)
+
+        if isinstance(translate_fn, BatchScheduler):
+            return functools.partial(translate_fn.submit, fair_queue=self, flow=flow)
+
+        def _translate(source_tokens, target_tokens, options):
+            self._acquire(flow, source_tokens)
+            try:
+                return translate_fn(source_tokens, target_tokens, options)
+            finally:
+                self._release()
+
+        return _translate
+
+    def enqueue(self, flow, source_tokens):
+        """Tags a new work unit of a flow and registers it as waiting.
+
+        Returns:
+          The waiting entry (finish_tag, counter, priority, start_tag) that should
+          be passed to start() when the unit is sent to the backend.
+        """
+        cost = max(sum(len(tokens) for tokens in source_tokens), 1)
+        with self._condition:
+            return self._enqueue(flow, cost)
+
+    def start(self, entry):
+        """Marks a waiting unit as sent to the backend."""
+        with self._condition:
+            self._waiting.remove(entry)
+            heapq.heapify(self._waiting)
+            self._virtual_time = max(self._virtual_time, entry[3])
+            self._condition.notify_all()
+
+    def _enqueue(self, flow, cost):
+        start_tag = max(self._virtual_time, flow.finish_tag)
+        flow.finish_tag = start_tag + cost / flow.weight
+        entry = (flow.finish_tag, next(self._counter), flow.priority, start_tag)
+        heapq.heappush(self._waiting, entry)
+        return entry
+
+    def _acquire(self, flow, source_tokens):
+        start = time.time()
+        cost = max(sum(len(tokens) for tokens in source_tokens), 1)
+        with self._condition:
+            entry = self._enqueue(flow, cost)
+            while self._num_active >= self._num_workers or self._waiting[0] != entry:
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._num_active += 1
+            self._virtual_time = max(self._virtual_time, entry[3])
+            # The next waiting unit may also be dispatched.
+            self._condition.notify_all()
+        _STAGE_LATENCY.labels("priority_queue").observe(time.time() - start)
+
+    def _release(self):
+        with self._condition:
+            self._num_active -= 1
+            self._condition.notify_all()
+
+
+class BatchSizeTuner(object):
+    """Adjusts the maximum batch size online toward a target batch latency.
+
+    The latency of each batch sent to the backend is observed and assumed to be
+    proportional to the batch size. When a batch is slower than the target
+    latency, the batch size is reduced accordingly. When the latency estimated
+    for a slightly larger batch size is below the target latency (with some
+    headroom), the batch size is increased by a small step. Timeouts and out of
+    memory errors halve the batch size and pause the increases for a few batches.
+    """
+
+    def __init__(
+        self,
+        target_latency,
+        min_batch_size=1,
+        max_batch_size=256,
+        initial_batch_size=None,
+        headroom=0.8,
+        cooldown=10,
+        smoothing=0.2,
+    ):
+        """Initializes the tuner.
+
+        Args:
+          target_latency: The target latency of a batch in seconds.
+          min_batch_size: The minimum batch size.
+          max_batch_size: The maximum batch size.
+          initial_batch_size: The initial batch size (defaults to min_batch_size).
+          headroom: The batch size is increased when the estimated latency is
+            below this fraction of the target latency.
+          cooldown: The number of batches without increase after an error.
+          smoothing: The weight of the new observation in the moving averages of
+            the latency.
+        """
+        if initial_batch_size is None:
+            initial_batch_size = min_batch_size
+        self._target_latency = target_latency
+        self._min_batch_size = min_batch_size
+        self._max_batch_size = max_batch_size
+        self._batch_size = max(min_batch_size, min(initial_batch_size, max_batch_size))
+        self._headroom = headroom
+        self._cooldown = cooldown
+        self._smoothing = smoothing
+        self._remaining_cooldown = 0
+        self._latency = None
+        self._latency_per_token = None
+        self._increases = 0
+        self._decreases = 0
+        self._errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def batch_size(self):
+        """The current maximum batch size."""
+        return self._batch_size
+
+    def observe(self, batch_size, num_tokens, latency):
+        """Records the latency of a successful batch and returns the new batch size."""
+        with self._lock:
+            self._latency = self._average(self._latency, latency)
+            if num_tokens > 0:
+                self._latency_per_token = self._average(
+                    self._latency_per_token, latency / num_tokens
+                )
+            cooling_down = self._remaining_cooldown > 0
+            if cooling_down:
+                self._remaining_cooldown -= 1
+            if latency > self._target_latency:
+                # Assume the latency is proportional to the batch size, but do not
+                # reduce by more than half at once.
+                target_size = batch_size * self._target_latency / latency
+                new_batch_size = max(int(target_size), batch_size // 2)
+                if new_batch_size < self._batch_size:
+                    self._set_batch_size(new_batch_size)
+            elif not cooling_down:
+                new_batch_size = self._batch_size + max(1, self._batch_size // 8)
+                # The fixed overhead of a batch makes this estimation conservative.
+                estimated_latency = latency * new_batch_size / batch_size
+                if estimated_latency < self._headroom * self._target_latency:
+                    self._set_batch_size(new_batch_size)
+            return self._batch_size
+
+    def observe_error(self):
+        """Records a timed out or out of memory batch and returns the new batch size."""
+        with self._lock:
+            self._errors += 1
+            self._remaining_cooldown = self._cooldown
+            self._set_batch_size(self._batch_size // 2)
+            return self._batch_size
+
+    def stats(self):
+        """Returns the state of the tuner."""
+        with self._lock:
+            return {
+                "batch_size": self._batch_size,
+                "target_latency": self._target_latency,
+                "latency": self._latency,
+                "latency_per_token": self._latency_per_token,
+                "increases": self._increases,
+                "decreases": self._decreases,
+                "errors": self._errors,
+            }
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return (1 - self._smoothing) * average + self._smoothing * value
+
+    def _set_batch_size(self, batch_size):
+        batch_size = max(self._min_batch_size, min(batch_size, self._max_batch_size))
+        if batch_size > self._batch_size:
+            self._increases += 1
+        elif batch_size < self._batch_size:
+            self._decreases += 1
+        self._batch_size = batch_size
+
+
+# Patterns in the name or message of the errors raised when the backend ran out of
+# memory (e.g. CUDA or TensorFlow errors).
+_OUT_OF_MEMORY_PATTERNS = (
+    "out of memory",
+    "outofmemory",
+    "resource exhausted",
+    "resourceexhausted",
+)
+
+
+def _is_out_of_memory_error(error):
+    """Returns True if the error reports that the backend ran out of memory."""
+    if isinstance(error, MemoryError):
+        return True
+    name = type(error).__name__.lower()
+    message = str(error).lower()
+    return any(
+        pattern in name or pattern in message for pattern in _OUT_OF_MEMORY_PATTERNS
+    )
+
+
+class LoadMonitor(object):
+    """Tracks the load of the serving instance.
+
+    The monitor counts the batches submitted by the requests that are waiting
+    (e.g. in the FairQueue or the BatchScheduler) or being translated, and the
+    number of source tokens translated by the backend over a sliding window. The
+    time to translate the pending tokens at this throughput estimates how long a
+    new request would wait.
+    """
+
+    def __init__(self, window=10):
+        """Initializes the monitor.
+
+        Args:
+          window: The duration in seconds of the window used to compute the
+            throughput.
+        """
+        self._window = window
+        self._start_time = time.time()
+        self._pending_batches = 0
+        self._pending_tokens = 0
+        self._running_batches = 0
+        self._running_tokens = 0
+        self._completed = collections.deque()
+        self._lock = threading.Lock()
+
+    def wrap(self, translate_fn):
+        """Returns a translation function counting the pending batches."""
+
+        def _translate(source_tokens, target_tokens, options):
+            num_tokens = sum(len(tokens) for tokens in source_tokens)
+            with self._lock:
+                self._pending_batches += 1
+                self._pending_tokens += num_tokens
+            try:
+                return translate_fn(source_tokens, target_tokens, options)
+            finally:
+                with self._lock:
+                    self._pending_batches -= 1
+                    self._pending_tokens -= num_tokens
+
+        return _translate
+
+    @contextlib.contextmanager
+    def track_batch(self, num_tokens):
+        """Context manager wrapping the translation of a batch by the backend."""
+        with self._lock:
+            self._running_batches += 1
+            self._running_tokens += num_tokens
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._running_batches -= 1
+                self._running_tokens -= num_tokens
+                self._completed.append((time.time(), num_tokens))
+
+    def stats(self):
+        """Returns the current load."""
+        now = time.time()
+        with self._lock:
+            while self._completed and self._completed[0][0] < now - self._window:
+                self._completed.popleft()
+            completed_tokens = sum(num_tokens for _, num_tokens in self._completed)
+            elapsed = min(self._window, now - self._start_time)
+            throughput = completed_tokens / elapsed if elapsed > 0 else 0
+            # Merged batches keep the number of tokens so the difference is the
+            # number of tokens that did not reach the backend yet.
+            queued_tokens = max(self._pending_tokens - self._running_tokens, 0)
+            remaining_tokens = queued_tokens + self._running_tokens
+            if remaining_tokens == 0:
+                estimated_wait = 0
+            elif throughput > 0:
+                estimated_wait = remaining_tokens / throughput
+            else:
+                estimated_wait = None
+            return {
+                "pending_batches": self._pending_batches,
+                "queued_tokens": queued_tokens,
+                "batches_in_flight": self._running_batches,
+                "tokens_per_second": throughput,
+                "estimated_wait": estimated_wait,
+            }
+
+
+_LoadedModel = collections.namedtuple("_LoadedModel", ("deployment", "size"))
+
+
+class ModelManager(object):
+    """Loads named models on demand and unloads the least recently used ones.
+
+    When the total size of the loaded models exceeds memory_budget, or their
+    number exceeds max_models, the least recently used models are unloaded once
+    their requests are completed. The size of a model is an estimation returned
+    by the loading function.
+    """
+
+    def __init__(self, load_fn, memory_budget=None, max_models=None, drain_timeout=60):
+        """Initializes the manager.
+
+        Args:
+          load_fn: A callable taking a model name and returning a tuple
+            (deployment, size) where size is the estimated memory size of the
+            model in bytes. It should raise InvalidRequest for unknown models.
+          memory_budget: The maximum total size of the loaded models.
+          max_models: The maximum number of loaded models.
+          drain_timeout: The maximum time in seconds to wait for the requests of an
+            unloaded model.
+        """
+        self._load_fn = load_fn
+        self._memory_budget = memory_budget
+        self._max_models = max_models
+        self._drain_timeout = drain_timeout
+        self._models = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Models are loaded one at a time.
+        self._load_lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def acquire(self, name):
+        """Returns the deployment of a model, loading it if needed.
+
+        The deployment is acquired and should be released by the caller.
+        """
+        deployment = self._acquire_loaded(name)
+        if deployment is not None:
+            return deployment
+        with self._load_lock:
+            # The model could be loaded while waiting for the lock.
+            deployment = self._acquire_loaded(name)
+            if deployment is not None:
+                return deployment
+            logger.info("Loading model %s", name)
+            deployment, size = self._load_fn(name)
+            with self._lock:
+                self._models[name] = _LoadedModel(deployment, size)
+                self._stats["loads"] += 1
+                deployment.acquire()
+                evicted = self._select_evictions(keep=name)
+        for evicted_name, evicted_deployment in evicted:
+            logger.info("Unloading least recently used model %s", evicted_name)
+            threading.Thread(
+                target=self._stop, args=(evicted_deployment,), daemon=True
+            ).start()
+        return deployment
+
+    def reload(self, name, check_fn=None):
+        """Loads a new deployment of a model and swaps it with the current one.
+
+        The current deployment keeps serving requests until the new one is loaded
+        and validated by check_fn, and is stopped once its requests are completed.
+        """
+        with self._load_lock:
+            logger.info("Reloading model %s", name)
+            deployment, size = self._load_fn(name)
+            if check_fn is not None:
+                try:
+                    check_fn(deployment)
+                except Exception:
+                    deployment.stop(close_processors=True)
+                    raise
+            with self._lock:
+                previous_model = self._models.pop(name, None)
+                self._models[name] = _LoadedModel(deployment, size)
+                self._stats["loads"] += 1
+                evicted = self._select_evictions(keep=name)
+        for evicted_name, evicted_deployment in evicted:
+            logger.info("Unloading least recently used model %s", evicted_name)
+            threading.Thread(
+                target=self._stop, args=(evicted_deployment,), daemon=True
+            ).start()
+        if previous_model is not None:
+            self._stop(previous_model.deployment)
+
+    def unload(self, name):
+        """Unloads a model. Returns False if the model is not loaded."""
+        with self._lock:
+            model = self._models.pop(name, None)
+        if model is None:
+            return False
+        self._stop(model.deployment)
+        return True
+
+    def stop(self):
+        """Unloads all models."""
+        with self._lock:
+            models = list(self._models.values())
+            self._models.clear()
+        for model in models:
+            model.deployment.stop(close_processors=True)
+
+    def stats(self):
+        """Returns the loaded models and the cache counters."""
+        with self._lock:
+            return {
+                "models": [
+                    {"name": name, "size": model.size}
+                    for name, model in self._models.items()
+                ],
+                "size": sum(model.size for model in self._models.values()),
+                "memory_budget": self._memory_budget,
+                "hits": self._stats["hits"],
+                "loads": self._stats["loads"],
+                "evictions": self._stats["evictions"],
+            }
+
+    def _acquire_loaded(self, name):
+        with self._lock:
+            model = self._models.get(name)
+            if model is None:
+                return None
+            self._models.move_to_end(name)
+            self._stats["hits"] += 1
+            model.deployment.acquire()
+            return model.deployment
+
+    def _select_evictions(self, keep):
+        evicted = []
+        total_size = sum(model.size for model in self._models.values())
+        for name in list(self._models.keys()):
+            if name == keep:
+                continue
+            over_budget = (
+                self._memory_budget is not None and total_size > self._memory_budget
+            )
+            too_many = (
+                self._max_models is not None and len(self._models) > self._max_models
+            )
+            if not over_budget and not too_many:
+                break
+            model = self._models.pop(name)
+            total_size -= model.size
+            self._stats["evictions"] += 1
+            evicted.append((name, model.deployment))
+        return evicted
+
+    def _stop(self, deployment):
+        if not deployment.drain(timeout=self._drain_timeout):
+            logger.warning("A model is unloaded while requests are still in progress")
+        deployment.stop(close_processors=True)
+
+
+class _BackendReplica(object):
+    """A backend instance managed by the BackendPool."""
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.info = None
+        self.outstanding_tokens = 0
+        self.restarts = 0
+
+    @property
+    def is_running(self):
+        return self.info is not None and (
+            self.process is None or _process_is_running(self.process)
+        )
+
+
+class BackendPool(object):
+    """Manages replicas of the backend service.
+
+    Batches are dispatched to the running replica with the least outstanding
+    work, i.e. the smallest number of source tokens being translated. A
+    background thread checks the replicas every health_check_interval seconds
+    and restarts those whose process is no longer running.
+    """
+
+    def __init__(self, backend_service_fn, num_replicas=1, health_check_interval=5):
+        """Initializes the pool.
+
+        Args:
+          backend_service_fn: A callable starting a backend replica and returning
+            a tuple (process, info), where process can be None. If info is a
+            dictionary with a "close" entry, this callable is called when the
+            replica is terminated to release the client resources (e.g. sessions).
+          num_replicas: The number of backend replicas.
+          health_check_interval: The interval in seconds between two health checks.
+            If 0 or None, stopped replicas are not restarted.
+        """
+        self._backend_service_fn = backend_service_fn
+        self._replicas = [_BackendReplica(i) for i in range(num_replicas)]
+        self._health_check_interval = health_check_interval
+        self._loaded = False
+        # _lock protects the dispatch state, _manage_lock serializes replica
+        # (re)starts which can take a long time.
+        self._lock = threading.Lock()
+        self._manage_lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._monitor = None
+
+    @property
+    def num_replicas(self):
+        return len(self._replicas)
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def replicas_info(self):
+        """Returns a list of (replica index, info) for the running replicas."""
+        with self._lock:
+            return [
+                (replica.index, replica.info)
+                for replica in self._replicas
+                if replica.is_running
+            ]
+
+    def stats(self):
+        """Returns the state of each replica."""
+        with self._lock:
+            return [
+                {
+                    "index": replica.index,
+                    "running": replica.is_running,
+                    "outstanding_tokens": replica.outstanding_tokens,
+                    "restarts": replica.restarts,
+                }
+                for replica in self._replicas
+            ]
+
+    def is_reachable(self):
+        """Returns True if at least one replica is running."""
+        with self._lock:
+            return self._loaded and any(
+                replica.is_running for replica in self._replicas
+            )
+
+    def load(self):
+        """Starts all replicas."""
+        with self._manage_lock:
+            for replica in self._replicas:
+                self._start(replica)
+            self._loaded = True
+        if self._monitor is None and self._health_check_interval:
+            self._monitor = threading.Thread(target=self._run_monitor, daemon=True)
+            self._monitor.start()
+
+    def unload(self):
+        """Terminates all replicas."""
+        with self._manage_lock:
+            self._loaded = False
+            for replica in self._replicas:
+                self._terminate(replica)
+
+    def reload(self):
+        """Restarts all replicas."""
+        with self._manage_lock:
+            self.unload()
+            self.load()
+
+    def stop(self):
+        """Stops the health checks and terminates all replicas."""
+        self._stopped.set()
+        if self._monitor is not None:
+            self._monitor.join()
+        self.unload()
+
+    def check_health(self):
+        """Restarts the replicas that are no longer running."""
+        with self._manage_lock:
+            if not self._loaded:
+                return
+            for replica in self._replicas:
+                if replica.is_running:
+                    continue
+                logger.warning(
+                    "Backend replica %d is not running, restarting it", replica.index
+                )
+                self._terminate(replica)
+                try:
+                    self._start(replica)
+                except Exception:
+                    logger.exception(
+                        "Failed to restart backend replica %d", replica.index
+                    )
+                    continue
+                with self._lock:
+                    replica.restarts += 1
+
+    @contextlib.contextmanager
+    def dispatch(self, source_tokens):
+        """Selects a replica to translate a batch.
+
+        Args:
+          source_tokens: The batch source tokens.
+
+        Returns:
+          A context manager returning the information of the selected replica.
+
+        Raises:
+          BackendUnavailable: if no replica is running.
+        """
+        work = sum(len(tokens) for tokens in source_tokens)
+        with self._lock:
+            replicas = [replica for replica in self._replicas if replica.is_running]
+            if not self._loaded or not replicas:
+                raise BackendUnavailable("backend service is unavailable")
+            replica = min(replicas, key=lambda replica: replica.outstanding_tokens)
+            replica.outstanding_tokens += work
+        try:
+            yield replica.info
+        finally:
+            with self._lock:
+                replica.outstanding_tokens -= work
+
+    def _start(self, replica):
+        process, info = self._backend_service_fn()
+        with self._lock:
+            replica.process = process
+            replica.info = info
+
+    def _terminate(self, replica):
+        with self._lock:
+            process = replica.process
+            info = replica.info
+            replica.process = None
+            replica.info = None
+        if process is not None and _process_is_running(process):
+            process.terminate()
+        close_fn = info.get("close") if isinstance(info, dict) else None
+        if close_fn is not None:
+            try:
+                close_fn()
+            except Exception:
+                logger.exception(
+                    "Failed to close the client of backend replica %d", replica.index
+                )
+
+    def _run_monitor(self):
+        while not self._stopped.wait(self._health_check_interval):
+            self.check_health()
+
+
+# Text of the request sent to a new model before it receives traffic.
+_WARMUP_TEXT = "Hello world!"
+
+# Words repeated to build the synthetic sentences of the warm-up phase.
+_WARMUP_WORDS = ("hello", "world", "this", "is", "a", "warm-up", "sentence")
+
+# Delays in seconds between the warm-up attempts while the backend is starting.
+_WARMUP_RETRY_DELAY = 0.1
+_WARMUP_MAX_RETRY_DELAY = 5
+
+
+def warmup(run_fn, lengths=(1, 16, 64), batch_size=8):
+    """Runs synthetic translation requests of increasing length.
+
+    The requests go through the same preprocessing, translation, and
+    postprocessing path as client requests so that the lazy initializations
+    (graph tracing, tokenization models, memory allocations, etc.) are not paid
+    by the first client requests.
+
+    Args:
+      run_fn: A function running a translation request.
+      lengths: The number of words of the synthetic sentences. A request is run
+        for each length, from the shortest to the longest.
+      batch_size: The number of sentences in each request.
+
+    Returns:
+      A list of dictionaries with the length, the batch size, and the duration in
+      seconds of each warm-up request.
+    """
+    timings = []
+    for length in sorted(lengths):
+        text = " ".join(_WARMUP_WORDS[i % len(_WARMUP_WORDS)] for i in range(length))
+        start = time.time()
+        run_fn({"src": [{"text": text} for _ in range(batch_size)]})
+        duration = time.time() - start
+        _WARMUP_LATENCY.labels(length).set(duration)
+        logger.info(
+            "Warm-up request with %d sentences of %d words completed in %.3f seconds",
+            batch_size,
+            length,
+            duration,
+        )
+        timings.append(dict(length=length, batch_size=batch_size, seconds=duration))
+    return timings
+
+
+class _Deployment(object):
+    """A backend pool and the processors serving requests with it.
+
+    Requests acquire the deployment for their whole duration so that a reloaded
+    model only receives new requests, and the previous deployment can be stopped
+    once drained.
+    """
+
+    def __init__(
+        self,
+        backend_pool,
+        translate_fn,
+        preprocessor=None,
+        postprocessor=None,
+        scheduler=None,
+        tuner=None,
+        model_id=None,
+    ):
+        self.backend_pool = backend_pool
+        self.translate_fn = translate_fn
+        self.model_id = model_id
+        self.preprocessor = preprocessor
+        self.postprocessor = postprocessor
+        self.tuner = tuner
+        self._scheduler = scheduler
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            self._in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def drain(self, timeout=None):
+        """Waits for the requests in progress. Returns False on timeout."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._in_flight == 0, timeout)
+
+    def stop(self, close_processors=False):
+        """Stops the scheduler and the backend replicas."""
+        if self._scheduler is not None:
+            self._scheduler.stop()
+        self.backend_pool.stop()
+        if close_processors:
+            for processor in (self.preprocessor, self.postprocessor):
+                if processor is not None and hasattr(processor, "close"):
+                    processor.close()
+
+
+# Translation options that do not change the translation result.
+_CACHE_IGNORED_OPTIONS = ("timeout", "max_batch_size", "max_batch_tokens")
+
+
+def _approximate_size(obj):
+    """Returns the approximate memory size of a cache key or value in bytes."""
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(_approximate_size(item) for item in obj)
+    if isinstance(obj, TranslationOutput):
+        return (
+            sys.getsizeof(obj)
+            + _approximate_size(obj.output)
+            + _approximate_size(obj.score)
+            + _approximate_size(obj.attention)
+        )
+    return sys.getsizeof(obj)
+
+
+def _as_hashable(tokens):
+    if isinstance(tokens, list):
+        return tuple(_as_hashable(token) for token in tokens)
+    return tokens
+
+
+def _copy_lists(value):
+    """Copies the nested lists of value."""
+    if isinstance(value, list):
+        return [_copy_lists(item) for item in value]
+    return value
+
+
+def _copy_outputs(hypotheses):
+    """Copies translation outputs so that the cached values are not shared with
+    the caller, including the token lists of each part."""
+    return [
+        TranslationOutput(
+            _copy_lists(hypothesis.output),
+            score=_copy_lists(hypothesis.score),
+            attention=_copy_lists(hypothesis.attention),
+        )
+        for hypothesis in hypotheses
+    ]
+
+
+class TranslationCache(object):
+    """A LRU cache of translation hypotheses with a size limit in bytes.
+
+    The cache is keyed on the model identifier, the translation mode, the
+    preprocessed source and target tokens, and the translation options that can
+    change the result. Entries older than ttl seconds are ignored.
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def make_key(model_id, mode, source_tokens, target_tokens, options=None):
+        """Builds the cache key of a part to translate."""
+        if options:
+            options = {
+                key: value
+                for key, value in options.items()
+                if key not in _CACHE_IGNORED_OPTIONS
+            }
+        options_key = json.dumps(options, sort_keys=True) if options else None
+        return (
+            model_id,
+            mode,
+            _as_hashable(source_tokens),
+            _as_hashable(target_tokens),
+            options_key,
+        )
+
+    def get(self, key):
+        """Returns the hypotheses cached for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                hypotheses, size, timestamp = entry
+                if self._ttl is not None and time.time() - timestamp > self._ttl:
+                    self._remove(key)
+                    entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+        return _copy_outputs(hypotheses)
+
+    def put(self, key, hypotheses):
+        """Caches the hypotheses of key."""
+        size = _approximate_size(key) + _approximate_size(hypotheses)
+        if size > self._max_bytes:
+            return
+        hypotheses = _copy_outputs(hypotheses)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (hypotheses, size, time.time())
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def clear(self):
+        """Removes all cache entries."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Returns the cache counters."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
 def pick_free_port():
     """Selects an available port."""
     s = socket.socket()
@@ -73,9 +1342,16 @@ def pick_free_port():
     return s.getsockname()[1]
 
 
-def start_server(
-    host,
-    port,
+# The request handler of a serving service: handle_request returns the response
+# (status, headers, body) to an HTTP request, warmup runs the warm-up requests
+# configured for the server start, stop terminates the backend, and is_ready
+# returns True when the server can receive traffic.
+ServingHandler = collections.namedtuple(
+    "ServingHandler", ("handle_request", "warmup", "stop", "is_ready")
+)
+
+
+def make_serving_handler(
     config,
     backend_service_fn,
     translate_fn,
@@ -83,162 +1359,807 @@ def start_server(
     postprocessor=None,
     backend_info_fn=None,
     rebatch_request=True,
+    processors_fn=None,
+    models_fn=None,
 ):
-    """Start a serving service.
-
-    This function will only return on SIGINT or SIGTERM signals.
+    """Builds the request handler of a serving service.
+
+    The backend service is started when the handler is built.
+
+    When "dynamic_batching" is enabled in the serving configuration, batches from
+    concurrent requests are merged before calling translate_fn (see BatchScheduler).
+    The backend service is started "num_replicas" times (see BackendPool) and the
+    batches are dispatched to the least loaded replica.
+    On /reload_model, the new backend and processors are loaded while the current
+    ones keep serving requests. They replace the current ones after a successful
+    warm-up request, and the previous backend is terminated once the requests it
+    was processing are completed (see _Deployment). Additional models are
+    reloaded the same way (see ModelManager.reload).
+    When models_fn is set, requests can select an additional model that is
+    loaded on first use and unloaded when it is the least recently used model
+    and the "models_memory_budget" or "max_loaded_models" limit is exceeded (see
+    ModelManager).
+    When "warmup" is set in the serving configuration, synthetic requests are
+    translated when the server starts and on /reload_model (see warmup). The
+    server reports that it is not ready until a warm-up is completed. On start,
+    the warm-up is retried while the backend is unavailable, for up to
+    "startup_timeout" seconds.
+    /health reports the load of the instance (see LoadMonitor) and returns the
+    status 503 with a Retry-After header when a "saturation" threshold is exceeded.
 
     Args:
-      host: The hostname of the service.
-      port: The port used by the service.
+      config: The model configuration.
       backend_service_fn: A callable to start the framework dependent backend service.
+        It is called once per backend replica.
       translation_fn: A callable that forwards the request to the translation backend.
       backend_info_fn: A callable returning some information about the backend service,
         and whether it can accept new requests or not.
       preprocessor: A Processor instance for preprocessing.
       postprocessor: A Processor instance for postprocessing.
       rebatch_request: If True, incoming requests are rebatched according to
-        max_batch_size. Otherwise, max_batch_size is passed as a translation option
-        to translate_fn which takes responsibility over batching.
+        max_batch_size and max_batch_tokens. Otherwise, these values are passed as
+        translation options to translate_fn which takes responsibility over batching.
+      processors_fn: A callable returning a new tuple (preprocessor, postprocessor)
+        when the model is reloaded. If None, the processors are reused.
+      models_fn: A callable taking the name of an additional model and returning a
+        tuple (backend_service_fn, preprocessor, postprocessor, size) where size is
+        the estimated memory size of the model in bytes. It should raise
+        InvalidRequest for unknown models. If None, only the main model is served.
+
+    Returns:
+      A ServingHandler.
     """
-    global backend_process
-    global backend_info
-    backend_process, backend_info = backend_service_fn()
     serving_config = config.get("serving")
     if serving_config is None:
         serving_config = {}
+    num_replicas = serving_config.get("num_replicas", 1)
     global_timeout = serving_config.get("timeout")
+    request_timeout = serving_config.get("request_timeout")
     global_max_batch_size = serving_config.get("max_batch_size")
+    global_max_batch_tokens = serving_config.get("max_batch_tokens")
+    sort_by_length = serving_config.get("sort_by_length", False)
+    serializer = serialization.get_serializer(
+        serving_config.get("json_serializer", "auto")
+    )
+    gzip_min_size = serving_config.get("gzip_min_size", 1024)
+
+    autotune_config = serving_config.get("autotune")
+    saturation_config = serving_config.get("saturation")
+    load_monitor = LoadMonitor(window=serving_config.get("throughput_window", 10))
+
+    cache = None
+    cache_max_bytes = serving_config.get("cache_max_bytes")
+    if cache_max_bytes:
+        cache = TranslationCache(cache_max_bytes, ttl=serving_config.get("cache_ttl"))
+
+    def _deploy(preprocessor, postprocessor, service_fn=None, model_id=None):
+        backend_pool = BackendPool(
+            service_fn if service_fn is not None else backend_service_fn,
+            num_replicas=num_replicas,
+            health_check_interval=serving_config.get("health_check_interval", 5),
+        )
+        backend_pool.load()
+
+        tuner = None
+        if autotune_config is not None:
+            tuner = BatchSizeTuner(
+                autotune_config["target_latency"],
+                min_batch_size=autotune_config.get("min_batch_size", 1),
+                max_batch_size=autotune_config.get(
+                    "max_batch_size", global_max_batch_size or 256
+                ),
+                initial_batch_size=global_max_batch_size,
+            )
 
-    def _backend_is_reachable():
-        return (
-            backend_info is not None
-            and backend_process is None
-            or _process_is_running(backend_process)
+        def _observe(batch_size, num_tokens, latency, hypotheses, error):
+            if error is None and hypotheses is not None:
+                new_batch_size = tuner.observe(batch_size, num_tokens, latency)
+            elif error is None or _is_out_of_memory_error(error):
+                # The batch timed out or did not fit in memory.
+                new_batch_size = tuner.observe_error()
+            else:
+                # Other failures (e.g. no replica is available) do not depend on
+                # the batch size.
+                return
+            if scheduler is not None:
+                scheduler.max_batch_size = new_batch_size
+
+        def backend_translate_fn(source_tokens, target_tokens, options):
+            _BATCHES_IN_FLIGHT.inc()
+            start = time.time()
+            hypotheses = None
+            error = None
+            num_tokens = sum(len(tokens) for tokens in source_tokens)
+            try:
+                with backend_pool.dispatch(source_tokens) as info:
+                    with load_monitor.track_batch(num_tokens):
+                        hypotheses = translate_fn(
+                            info, source_tokens, target_tokens, options
+                        )
+                return hypotheses
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                latency = time.time() - start
+                _STAGE_LATENCY.labels("translate").observe(latency)
+                _BATCHES_IN_FLIGHT.dec()
+                _BATCH_SIZE.observe(len(source_tokens))
+                _BATCH_TOKENS.observe(num_tokens)
+                if tuner is not None:
+                    _observe(len(source_tokens), num_tokens, latency, hypotheses, error)
+
+        scheduler = None
+        if serving_config.get("dynamic_batching"):
+            scheduler = BatchScheduler(
+                backend_translate_fn,
+                max_batch_size=(
+                    (tuner.batch_size if tuner is not None else global_max_batch_size)
+                    if rebatch_request
+                    else None
+                ),
+                max_batch_tokens=global_max_batch_tokens if rebatch_request else None,
+                max_delay=serving_config.get("max_batch_delay", 0.005),
+                num_workers=num_replicas,
+            )
+
+        return _Deployment(
+            backend_pool,
+            scheduler if scheduler is not None else backend_translate_fn,
+            preprocessor=preprocessor,
+            postprocessor=postprocessor,
+            scheduler=scheduler,
+            tuner=tuner,
+            model_id=model_id,
         )
 
-    class ServerHandler(http.server.SimpleHTTPRequestHandler):
-        def _send_response(self, data, status=200):
-            self.send_response(status)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps(data).encode("utf-8"))
+    deployment = _deploy(preprocessor, postprocessor, model_id=config.get("model"))
+    deployment_lock = threading.Lock()
+    reload_lock = threading.Lock()
 
-        def _send_error(self, status, message, from_request=None):
-            if from_request is not None:
-                logger.exception(
-                    "Exception raised for request:\n%s",
-                    json.dumps(from_request, ensure_ascii=False),
-                )
-            data = {"message": message}
-            self._send_response(data, status=status)
+    model_manager = None
+    if models_fn is not None:
 
-        def do_GET(self):
-            if self.path == "/status":
-                self.status()
-            elif self.path == "/health":
-                self.health()
-            else:
-                self._send_error(404, "invalid route %s" % self.path)
+        def _load_model(name):
+            service_fn, model_preprocessor, model_postprocessor, size = models_fn(name)
+            model_deployment = _deploy(
+                model_preprocessor,
+                model_postprocessor,
+                service_fn=service_fn,
+                model_id=name,
+            )
+            return model_deployment, size
 
-        def do_POST(self):
-            if self.path == "/translate":
-                self.translate()
-            elif self.path == "/unload_model":
-                self.unload_model()
-            elif self.path == "/reload_model":
-                self.reload_model()
-            else:
-                self._send_error(404, "invalid route %s" % self.path)
+        model_manager = ModelManager(
+            _load_model,
+            memory_budget=serving_config.get("models_memory_budget"),
+            max_models=serving_config.get("max_loaded_models"),
+            drain_timeout=serving_config.get("reload_drain_timeout", 60),
+        )
 
-        def translate(self):
-            if not _backend_is_reachable():
-                self._send_error(503, "backend service is unavailable")
-                return
-            content_len = int(self.headers.get("content-length", 0))
-            if content_len == 0:
-                self._send_error(400, "missing request data")
+    def _acquire_deployment(model_name=None):
+        if model_name is not None:
+            if model_manager is None:
+                raise InvalidRequest("this server does not serve additional models")
+            return model_manager.acquire(model_name)
+        with deployment_lock:
+            current = deployment
+            current.acquire()
+        return current
+
+    def _get_model_name(request, headers):
+        options = request.get("options") if isinstance(request, dict) else None
+        model_name = options.pop("model", None) if options else None
+        if model_name is None:
+            model_name = headers.get("x-model")
+        return model_name
+
+    def _backend_is_reachable():
+        return deployment.backend_pool.is_reachable()
+
+    fair_queue = None
+    work_unit_size = None
+    priority_weights = serving_config.get("priorities")
+    if priority_weights:
+        fair_queue = FairQueue(
+            priority_weights,
+            num_workers=serving_config.get("max_concurrent_batches", num_replicas),
+        )
+        default_priority = serving_config.get(
+            "default_priority",
+            max(priority_weights, key=lambda priority: priority_weights[priority]),
+        )
+        work_unit_size = serving_config.get("work_unit_size", 64)
+
+    def _get_priority(request, headers):
+        options = request.get("options") if isinstance(request, dict) else None
+        priority = options.pop("priority", None) if options else None
+        if priority is None:
+            priority = headers.get("x-priority", default_priority)
+        return priority
+
+    def _run_request(
+        request, current, stream=False, deadline=None, priority=None, use_cache=True
+    ):
+        translate_fn = current.translate_fn
+        if fair_queue is not None:
+            translate_fn = fair_queue.wrap(
+                translate_fn, priority if priority is not None else default_priority
+            )
+        translate_fn = load_monitor.wrap(translate_fn)
+        return (stream_request if stream else run_request)(
+            request,
+            translate_fn,
+            preprocessor=current.preprocessor,
+            postprocessor=current.postprocessor,
+            config=config,
+            rebatch_request=rebatch_request,
+            max_batch_size=(
+                current.tuner.batch_size
+                if current.tuner is not None
+                else global_max_batch_size
+            ),
+            max_batch_tokens=global_max_batch_tokens,
+            sort_by_length=sort_by_length,
+            timeout=global_timeout,
+            cache=cache if use_cache else None,
+            model_id=current.model_id,
+            deadline=deadline,
+            max_work_unit_size=work_unit_size,
+        )
+
+    warmup_config = serving_config.get("warmup")
+    if warmup_config is True:
+        warmup_config = {}
+    warmup_timings = None
+    # Set when the server is ready to receive traffic.
+    ready = threading.Event()
+    if not isinstance(warmup_config, dict):
+        warmup_config = None
+        ready.set()
+
+    def _warmup(current):
+        return warmup(
+            lambda request: _run_request(request, current, use_cache=False),
+            lengths=warmup_config.get("lengths", (1, 16, 64)),
+            batch_size=warmup_config.get("batch_size", 8),
+        )
+
+    def _warmup_on_start():
+        nonlocal warmup_timings
+        # The backend may still be starting when the frontend is listening.
+        startup_timeout = warmup_config.get("startup_timeout", 600)
+        start = time.time()
+        delay = _WARMUP_RETRY_DELAY
+        while True:
+            with reload_lock:
+                if ready.is_set():
+                    # A model reload completed its own warm-up.
+                    return
+                try:
+                    warmup_timings = _warmup(deployment)
+                    break
+                except BackendUnavailable as e:
+                    error = e
+                except Exception:
+                    logger.exception("Warm-up failed, the server is not ready")
+                    return
+            elapsed = time.time() - start
+            if startup_timeout is not None and elapsed + delay > startup_timeout:
+                logger.error(
+                    "Backend service is still unavailable after %.1f seconds, "
+                    "the server is not ready: %s",
+                    elapsed,
+                    error,
+                )
                 return
-            post_body = self.rfile.read(content_len)
-            request = None
-            try:
-                request = json.loads(post_body.decode("utf-8"))
-                result = run_request(
-                    request,
-                    functools.partial(translate_fn, backend_info),
-                    preprocessor=preprocessor,
-                    postprocessor=postprocessor,
-                    config=config,
-                    rebatch_request=rebatch_request,
-                    max_batch_size=global_max_batch_size,
-                    timeout=global_timeout,
+            logger.info(
+                "Backend service is not available yet, retrying the warm-up in "
+                "%.1f seconds: %s",
+                delay,
+                error,
+            )
+            time.sleep(delay)
+            delay = min(delay * 2, _WARMUP_MAX_RETRY_DELAY)
+        logger.info("Warm-up completed in %.3f seconds", time.time() - start)
+        ready.set()
+
+    def _response(data, status=200, gzip=False, extra_headers=None):
+        start = time.time()
+        body = serializer.dumps(data)
+        headers = {"Content-Type": "application/json"}
+        if extra_headers:
+            headers.update(extra_headers)
+        if gzip and len(body) >= gzip_min_size:
+            body = serialization.gzip_compress(body)
+            headers["Content-Encoding"] = "gzip"
+        _STAGE_LATENCY.labels("encode").observe(time.time() - start)
+        return status, headers, body
+
+    def _error(status, message, from_request=None):
+        if from_request is not None:
+            logger.exception(
+                "Exception raised for request:\n%s",
+                json.dumps(from_request, ensure_ascii=False),
+            )
+        return _response({"message": message}, status=status)
+
+    def translate(headers, body, is_cancelled=None):
+        deadline = Deadline(timeout=request_timeout, is_cancelled=is_cancelled)
+        if not ready.is_set():
+            return _error(503, "model is warming up")
+        if not body:
+            return _error(400, "missing request data")
+        request = None
+        stream = "application/x-ndjson" in headers.get("accept", "")
+        gzip = gzip_min_size is not None and serialization.accepts_gzip(
+            headers.get("accept-encoding")
+        )
+        current = None
+        try:
+            request = serializer.loads(body)
+            # The request is processed by the same deployment from start to end.
+            current = _acquire_deployment(_get_model_name(request, headers))
+            if not current.backend_pool.is_reachable():
+                raise BackendUnavailable("backend service is unavailable")
+            result = _run_request(
+                request,
+                current,
+                stream=stream,
+                deadline=deadline,
+                priority=(
+                    _get_priority(request, headers) if fair_queue is not None else None
+                ),
+            )
+        except Exception as e:
+            if current is not None:
+                current.release()
+            return _error(_get_error_status(e), str(e), from_request=request)
+        if stream:
+            response_headers = {"Content-Type": "application/x-ndjson"}
+            chunks = _encode_stream(result, request, serializer)
+            if gzip:
+                response_headers["Content-Encoding"] = "gzip"
+                chunks = serialization.gzip_compress_stream(chunks)
+            return (
+                200,
+                response_headers,
+                _StreamedBody(chunks, on_close=current.release),
+            )
+        current.release()
+        return _response(result, gzip=gzip)
+
+    def health(headers, body, is_cancelled=None):
+        if not ready.is_set():
+            return _error(503, "model is warming up")
+        if not _backend_is_reachable():
+            return _error(503, "backend service is unavailable")
+        backend_pool = deployment.backend_pool
+        replicas_info = []
+        for index, replica_info in backend_pool.replicas_info():
+            if backend_info_fn is None:
+                replica_info, replica_available = {}, True
+            else:
+                replica_info, replica_available = backend_info_fn(
+                    serving_config, replica_info
                 )
-            except InvalidRequest as e:
-                self._send_error(400, str(e), from_request=request)
-            except TranslationTimeout as e:
-                self._send_error(504, str(e), from_request=request)
+            replicas_info.append((index, replica_info, replica_available))
+        if not replicas_info:
+            return _error(503, "backend service is unavailable")
+        available = any(replica_available for _, _, replica_available in replicas_info)
+        if backend_pool.num_replicas == 1:
+            info = replicas_info[0][1]
+        else:
+            replicas = {stats["index"]: stats for stats in backend_pool.stats()}
+            for index, replica_info, replica_available in replicas_info:
+                replicas[index].update(info=replica_info, available=replica_available)
+            info = {"replicas": [replicas[index] for index in sorted(replicas)]}
+        if warmup_timings is not None:
+            info = dict(info, warmup=warmup_timings)
+        tuner = deployment.tuner
+        if tuner is not None:
+            info = dict(info, batch_size_tuner=tuner.stats())
+        if model_manager is not None:
+            info = dict(info, models=model_manager.stats())
+        if fair_queue is not None:
+            info = dict(info, waiting_batches=fair_queue.num_waiting())
+        if cache is not None:
+            info = dict(info, cache=cache.stats())
+        preprocessor = deployment.preprocessor
+        if preprocessor is not None and hasattr(preprocessor, "pipeline_cache_stats"):
+            info = dict(info, pipeline_cache=preprocessor.pipeline_cache_stats())
+        load = load_monitor.stats()
+        info = dict(info, load=load)
+        if available and _is_saturated(load):
+            # Suggest to come back when the pending work is expected to be done.
+            retry_after = max(1, int(math.ceil(load["estimated_wait"] or 1)))
+            return _response(
+                dict(info, saturated=True),
+                status=503,
+                extra_headers={"Retry-After": str(retry_after)},
+            )
+        return _response(info, status=200 if available else 503)
+
+    def _is_saturated(load):
+        if not saturation_config:
+            return False
+        max_pending_batches = saturation_config.get("max_pending_batches")
+        if (
+            max_pending_batches is not None
+            and load["pending_batches"] > max_pending_batches
+        ):
+            return True
+        max_estimated_wait = saturation_config.get("max_estimated_wait")
+        estimated_wait = load["estimated_wait"]
+        if (
+            max_estimated_wait is not None
+            and estimated_wait is not None
+            and estimated_wait > max_estimated_wait
+        ):
+            return True
+        return False
+
+    def status(headers, body, is_cancelled=None):
+        if not ready.is_set():
+            return _response({"status": "warming_up"}, status=503)
+        if not deployment.backend_pool.loaded:
+            status = "unloaded"
+        else:
+            status = "ready"
+        return _response({"status": status})
+
+    def _get_route_model_name(body):
+        if not body or model_manager is None:
+            return None
+        try:
+            request = serializer.loads(body)
+        except ValueError:
+            return None
+        return request.get("model") if isinstance(request, dict) else None
+
+    def unload_model(headers, body, is_cancelled=None):
+        model_name = _get_route_model_name(body)
+        if model_name is not None:
+            if not model_manager.unload(model_name):
+                return _error(404, "model %s is not loaded" % model_name)
+            return _response({"status": "unloaded"})
+        with reload_lock:
+            deployment.backend_pool.unload()
+        if cache is not None:
+            cache.clear()
+        return status(headers, body)
+
+    def _check_deployment(new_deployment):
+        """Translates warm-up requests before the deployment receives traffic."""
+        if warmup_config is not None:
+            return _warmup(new_deployment)
+        _run_request({"src": [{"text": _WARMUP_TEXT}]}, new_deployment, use_cache=False)
+        return None
+
+    def reload_model(headers, body, is_cancelled=None):
+        nonlocal deployment, warmup_timings
+        model_name = _get_route_model_name(body)
+        if model_name is not None:
+            # The current deployment of the model serves requests until the new
+            # one is ready, as for the main model.
+            try:
+                model_manager.reload(model_name, check_fn=_check_deployment)
+            except Exception as e:
+                logger.exception("Failed to reload model %s", model_name)
+                return _error(_get_error_status(e), str(e))
+            if cache is not None:
+                cache.clear()
+            return _response({"status": "ready"})
+        with reload_lock:
+            if not serving_config.get("zero_downtime_reload", True):
+                if cache is not None:
+                    cache.clear()
+                deployment.backend_pool.reload()
+                return status(headers, body)
+
+            # Load the new deployment while the current one keeps serving.
+            try:
+                if processors_fn is not None:
+                    new_preprocessor, new_postprocessor = processors_fn()
+                else:
+                    new_preprocessor = deployment.preprocessor
+                    new_postprocessor = deployment.postprocessor
+                new_deployment = _deploy(new_preprocessor, new_postprocessor)
             except Exception as e:
-                self._send_error(500, str(e), from_request=request)
+                logger.exception("Failed to load the new model")
+                return _error(500, "failed to load the new model: %s" % str(e))
+            try:
+                timings = _check_deployment(new_deployment)
+                if timings is not None:
+                    warmup_timings = timings
+            except Exception as e:
+                logger.exception("Warm-up request failed on the new model")
+                new_deployment.stop(close_processors=processors_fn is not None)
+                return _error(500, "warm-up request failed: %s" % str(e))
+
+            with deployment_lock:
+                previous_deployment = deployment
+                deployment = new_deployment
+            # The new model is warm even when the warm-up on start failed.
+            ready.set()
+            logger.info("Switched to the new model, draining the previous one")
+            if cache is not None:
+                cache.clear()
+
+            if not previous_deployment.drain(
+                timeout=serving_config.get("reload_drain_timeout", 60)
+            ):
+                logger.warning(
+                    "The previous model is terminated while requests are still "
+                    "in progress"
+                )
+            previous_deployment.stop(close_processors=processors_fn is not None)
+            # Remove translations cached by the previous model during the drain.
+            if cache is not None:
+                cache.clear()
+        return status(headers, body)
+
+    def get_metrics(headers, body, is_cancelled=None):
+        return 200, {"Content-Type": metrics.CONTENT_TYPE}, metrics.generate_latest()
+
+    routes = {
+        ("GET", "/status"): status,
+        ("GET", "/health"): health,
+        ("GET", "/metrics"): get_metrics,
+        ("POST", "/translate"): translate,
+        ("POST", "/unload_model"): unload_model,
+        ("POST", "/reload_model"): reload_model,
+    }
+
+    def handle_request(method, path, headers, body, is_cancelled=None):
+        """Returns the response (status, headers, body) to an HTTP request.
+
+        The body is either bytes or an iterator of bytes for streamed responses.
+        is_cancelled is an optional callable returning True when the client closed
+        the connection.
+        """
+        route = routes.get((method, path))
+        route_name = path if route is not None else "other"
+        _REQUESTS_IN_FLIGHT.inc()
+        start = time.time()
+        try:
+            if route is None:
+                response = _error(404, "invalid route %s" % path)
             else:
-                self._send_response(result)
+                response = route(headers, body, is_cancelled=is_cancelled)
+        finally:
+            _REQUESTS_IN_FLIGHT.dec()
+        _REQUEST_LATENCY.labels(route_name).observe(time.time() - start)
+        _REQUESTS.labels(route_name, response[0]).inc()
+        return response
+
+    def _stop():
+        deployment.stop()
+        if model_manager is not None:
+            model_manager.stop()
+
+    return ServingHandler(
+        handle_request=handle_request,
+        warmup=_warmup_on_start,
+        stop=_stop,
+        is_ready=ready.is_set,
+    )
 
-        def health(self):
-            if not _backend_is_reachable():
-                self._send_error(503, "backend service is unavailable")
-                return
-            if backend_info_fn is None:
-                self._send_response({})
-                return
-            info, available = backend_info_fn(serving_config, backend_info)
-            self._send_response(info, status=200 if available else 503)
 
-        def status(self):
-            if backend_info is None:
-                status = "unloaded"
-            else:
-                status = "ready"
-            self._send_response({"status": status})
-
-        def unload_model(self):
-            global backend_process
-            global backend_info
-            if backend_process is not None and _process_is_running(backend_process):
-                backend_process.terminate()
-            backend_process = None
-            backend_info = None
-            self.status()
-
-        def reload_model(self):
-            global backend_process
-            global backend_info
-            if backend_process is not None and _process_is_running(backend_process):
-                backend_process.terminate()
-            backend_process, backend_info = backend_service_fn()
-            self.status()
+def start_server(
+    host,
+    port,
+    config,
+    backend_service_fn,
+    translate_fn,
+    preprocessor=None,
+    postprocessor=None,
+    backend_info_fn=None,
+    rebatch_request=True,
+    processors_fn=None,
+    models_fn=None,
+):
+    """Start a serving service.
+
+    This function will only return on SIGINT or SIGTERM signals.
+
+    Args:
+      host: The hostname of the service.
+      port: The port used by the service.
+      backend_service_fn: A callable to start the framework dependent backend service.
+        It is called once per backend replica.
+      translation_fn: A callable that forwards the request to the translation backend.
+      backend_info_fn: A callable returning some information about the backend service,
+        and whether it can accept new requests or not.
+      preprocessor: A Processor instance for preprocessing.
+      postprocessor: A Processor instance for postprocessing.
+      rebatch_request: If True, incoming requests are rebatched according to
+        max_batch_size and max_batch_tokens. Otherwise, these values are passed as
+        translation options to translate_fn which takes responsibility over batching.
+      processors_fn: A callable returning a new tuple (preprocessor, postprocessor)
+        when the model is reloaded. If None, the processors are reused.
+      models_fn: A callable taking the name of an additional model and returning a
+        tuple (backend_service_fn, preprocessor, postprocessor, size) where size is
+        the estimated memory size of the model in bytes. It should raise
+        InvalidRequest for unknown models. If None, only the main model is served.
+
+    The requests are processed by the handler returned by make_serving_handler.
+
+    The HTTP frontend is selected with the "frontend" serving option: "threading"
+    (the default) starts a thread per connection, and "asyncio" handles
+    connections in an event loop (see async_server.AsyncHTTPServer).
+    """
+    serving_config = config.get("serving")
+    if serving_config is None:
+        serving_config = {}
+    handler = make_serving_handler(
+        config,
+        backend_service_fn,
+        translate_fn,
+        preprocessor=preprocessor,
+        postprocessor=postprocessor,
+        backend_info_fn=backend_info_fn,
+        rebatch_request=rebatch_request,
+        processors_fn=processors_fn,
+        models_fn=models_fn,
+    )
 
+    frontend = serving_config.get("frontend", "threading")
     try:
-        frontend_server = socketserver.ThreadingTCPServer((host, port), ServerHandler)
-    except socket.error as e:
-        if backend_process is not None:
-            backend_process.terminate()
+        if frontend == "threading":
+            frontend_server = socketserver.ThreadingTCPServer(
+                (host, port), _make_request_handler(handler.handle_request)
+            )
+        elif frontend == "asyncio":
+            frontend_server = async_server.AsyncHTTPServer(
+                host,
+                port,
+                handler.handle_request,
+                max_workers=serving_config.get("frontend_threads"),
+                max_queue_size=serving_config.get("max_queue_size"),
+                keep_alive_timeout=serving_config.get("keep_alive_timeout", 5),
+                max_body_size=serving_config.get("max_body_size", 100 * 1024 * 1024),
+            )
+        else:
+            raise ValueError("Invalid serving frontend: %s" % frontend)
+    except (socket.error, ValueError) as e:
+        handler.stop()
         raise e
 
     def shutdown(signum, frame):
         frontend_server.shutdown()
-        if backend_process is not None:
-            backend_process.terminate()
+        handler.stop()
 
     signal.signal(signal.SIGINT, shutdown)
     signal.signal(signal.SIGTERM, shutdown)
 
-    logger.info("Serving model on port %d", port)
+    logger.info("Serving model on port %d with the %s frontend", port, frontend)
     server_thread = threading.Thread(target=frontend_server.serve_forever)
     server_thread.start()
+    if not handler.is_ready():
+        threading.Thread(target=handler.warmup, daemon=True).start()
     while server_thread.is_alive():
         time.sleep(1)
     frontend_server.server_close()
 
 
+def _get_error_status(error):
+    """Returns the HTTP status of an error raised when processing a request."""
+    if isinstance(error, InvalidRequest):
+        return 400
+    if isinstance(error, BackendUnavailable):
+        return 503
+    if isinstance(error, TranslationTimeout):
+        return 504
+    return 500
+
+
+def _encode_stream(results, request, serializer):
+    """Yields the results as newline-delimited JSON.
+
+    The response status is already sent when the results are produced, so an
+    error is reported as a final {"message": ...} line.
+    """
+    try:
+        for result in results:
+            yield serializer.dumps(result) + b"\n"
+    except Exception as e:
+        logger.exception(
+            "Exception raised for request:\n%s",
+            json.dumps(request, ensure_ascii=False),
+        )
+        yield serializer.dumps({"message": str(e)}) + b"\n"
+
+
+class _StreamedBody(object):
+    """An iterator over the chunks of a streamed response body.
+
+    on_close is called once, when the chunks are exhausted or the body is closed
+    (even if the iteration did not start).
+    """
+
+    def __init__(self, chunks, on_close=None):
+        self._chunks = chunks
+        self._on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        on_close = self._on_close
+        self._on_close = None
+        try:
+            self._chunks.close()
+        finally:
+            if on_close is not None:
+                on_close()
+
+
+def _is_disconnected(sock):
+    """Returns True if the peer closed the connection."""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and not sock.recv(1, socket.MSG_PEEK)
+    except (OSError, ValueError):
+        return True
+
+
+def _make_request_handler(handle_request):
+    """Returns a http.server request handler class calling handle_request."""
+
+    class ServerHandler(http.server.SimpleHTTPRequestHandler):
+        def do_GET(self):
+            self._handle()
+
+        def do_POST(self):
+            self._handle()
+
+        def _handle(self):
+            content_len = int(self.headers.get("content-length", 0))
+            body = self.rfile.read(content_len) if content_len > 0 else b""
+            status, headers, data = handle_request(
+                self.command,
+                self.path,
+                self.headers,
+                body,
+                is_cancelled=lambda: _is_disconnected(self.connection),
+            )
+            try:
+                self._send(status, headers, data)
+            except ConnectionError:
+                logger.debug("The client closed the connection before the response")
+                self.close_connection = True
+
+        def _send(self, status, headers, data):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            if isinstance(data, bytes):
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+
+            # Streamed response: the body ends when the connection is closed.
+            self.close_connection = True
+            try:
+                self.end_headers()
+                for chunk in data:
+                    self.wfile.write(chunk)
+                    self.wfile.flush()
+            finally:
+                data.close()
+
+    return ServerHandler
+
+
 def run_request(
     request,
     translate_fn,
@@ -247,9 +2168,140 @@ def run_request(
     config=None,
     rebatch_request=True,
     max_batch_size=None,
+    max_batch_tokens=None,
+    sort_by_length=False,
+    timeout=None,
+    cache=None,
+    model_id=None,
+    deadline=None,
+    max_work_unit_size=None,
+):
+    """Runs a translation request.
+
+    If a Deadline is set, it is checked before each processing stage and before
+    each translation batch. If max_work_unit_size is set, the translation
+    function is never called with more parts, even when rebatch_request is False.
+    """
+    src, options, max_batch_size, max_batch_tokens, align_options = _read_request(
+        request,
+        rebatch_request=rebatch_request,
+        max_batch_size=max_batch_size,
+        max_batch_tokens=max_batch_tokens,
+        timeout=timeout,
+        max_work_unit_size=max_work_unit_size,
+    )
+
+    if not src:
+        results = []
+    else:
+        if deadline is not None:
+            deadline.check("preprocess")
+        start = time.time()
+        examples = preprocess_examples(
+            src, preprocessor, config=config, config_override=options.get("config")
+        )
+        _STAGE_LATENCY.labels("preprocess").observe(time.time() - start)
+        outputs = translate_examples(
+            examples,
+            translate_fn,
+            max_batch_size=max_batch_size,
+            max_batch_tokens=max_batch_tokens,
+            sort_by_length=sort_by_length,
+            options=options,
+            cache=cache,
+            model_id=model_id,
+            deadline=deadline,
+        )
+        if deadline is not None:
+            deadline.check("postprocess")
+        start = time.time()
+        results = postprocess_outputs(outputs, examples, postprocessor, **align_options)
+        _STAGE_LATENCY.labels("postprocess").observe(time.time() - start)
+
+    return {"tgt": results}
+
+
+def stream_request(
+    request,
+    translate_fn,
+    preprocessor=None,
+    postprocessor=None,
+    config=None,
+    rebatch_request=True,
+    max_batch_size=None,
+    max_batch_tokens=None,
+    sort_by_length=False,
     timeout=None,
+    cache=None,
+    model_id=None,
+    deadline=None,
+    max_work_unit_size=None,
 ):
-    """Runs a translation request."""
+    """Runs a translation request and returns an iterator over the results.
+
+    The request is validated and preprocessed before this function returns. Each
+    example result is then produced as soon as all its parts are translated and
+    postprocessed, in completion order: the iterator yields dictionaries
+    {"index": ..., "tgt": ...} where "index" is the position of the example in
+    the request. The arguments are the same as run_request.
+    """
+    src, options, max_batch_size, max_batch_tokens, align_options = _read_request(
+        request,
+        rebatch_request=rebatch_request,
+        max_batch_size=max_batch_size,
+        max_batch_tokens=max_batch_tokens,
+        timeout=timeout,
+        max_work_unit_size=max_work_unit_size,
+    )
+    if not src:
+        return iter([])
+
+    if deadline is not None:
+        deadline.check("preprocess")
+    start = time.time()
+    examples = preprocess_examples(
+        src, preprocessor, config=config, config_override=options.get("config")
+    )
+    _STAGE_LATENCY.labels("preprocess").observe(time.time() - start)
+
+    def _generate():
+        translations = iter_translate_examples(
+            examples,
+            translate_fn,
+            max_batch_size=max_batch_size,
+            max_batch_tokens=max_batch_tokens,
+            sort_by_length=sort_by_length,
+            options=options,
+            cache=cache,
+            model_id=model_id,
+            deadline=deadline,
+        )
+        for completed in translations:
+            completed_examples = [example for example, _ in completed]
+            outputs = [outputs for _, outputs in completed]
+            if deadline is not None:
+                deadline.check("postprocess")
+            start = time.time()
+            results = postprocess_outputs(
+                outputs, completed_examples, postprocessor, **align_options
+            )
+            _STAGE_LATENCY.labels("postprocess").observe(time.time() - start)
+            for example, result in zip(completed_examples, results):
+                yield {"index": example.index, "tgt": result}
+
+    return _generate()
+
+
+def _read_request(
+    request,
+    rebatch_request=True,
+    max_batch_size=None,
+    max_batch_tokens=None,
+    timeout=None,
+    max_work_unit_size=None,
+):
+    """Validates a request and returns the examples, the options, the batch
+    limits, and the alignment options."""
     if logger.isEnabledFor(logging.DEBUG):
         logger.debug("Incoming request: %s", json.dumps(request, ensure_ascii=False))
 
@@ -261,32 +2313,74 @@ def run_request(
     if not isinstance(src, list):
         raise InvalidRequest("src field must be a list")
 
-    if not src:
-        results = []
-    else:
-        # Read request specific options and config.
-        options = request.get("options", {})
+    # Read request specific options and config.
+    options = request.get("options", {})
+    align_format = options.pop("align_format", "nested")
+    if align_format not in ALIGN_FORMATS:
+        raise InvalidRequest(
+            "Invalid align_format '%s', expected one of: %s"
+            % (align_format, ", ".join(ALIGN_FORMATS))
+        )
+    align_threshold = options.pop("align_threshold", None)
+    if align_threshold is not None and (
+        isinstance(align_threshold, bool)
+        or not isinstance(align_threshold, (int, float))
+    ):
+        raise InvalidRequest("align_threshold must be a number")
+    align_options = dict(align_format=align_format, align_threshold=align_threshold)
+    if src:
         options.setdefault("timeout", timeout)
         max_batch_size = options.get("max_batch_size", max_batch_size)
-        if not rebatch_request and max_batch_size is not None:
-            options["max_batch_size"] = max_batch_size
-            max_batch_size = None
-
-        examples = preprocess_examples(
-            src, preprocessor, config=config, config_override=options.get("config")
-        )
-        outputs = translate_examples(
-            examples, translate_fn, max_batch_size=max_batch_size, options=options
-        )
-        results = postprocess_outputs(outputs, examples, postprocessor)
+        max_batch_tokens = options.get("max_batch_tokens", max_batch_tokens)
+        if not rebatch_request:
+            if max_batch_size is not None:
+                options["max_batch_size"] = max_batch_size
+                max_batch_size = None
+            if max_batch_tokens is not None:
+                options["max_batch_tokens"] = max_batch_tokens
+                max_batch_tokens = None
+        if max_work_unit_size is not None:
+            max_batch_size = (
+                min(max_batch_size, max_work_unit_size)
+                if max_batch_size is not None
+                else max_work_unit_size
+            )
 
-    return {"tgt": results}
+    return src, options, max_batch_size, max_batch_tokens, align_options
 
 
 def preprocess_example(
     preprocessor, index, raw_example, config=None, config_override=None
 ):
     """Applies preprocessing function on example."""
+    resolved = _resolve_example(
+        index, raw_example, config=config, config_override=config_override
+    )
+    if preprocessor is None:
+        source_tokens = resolved.source_text
+        target_tokens = None
+        metadata = None
+    else:
+        source_tokens, target_tokens, metadata = preprocessor.process_input(
+            resolved.source_text,
+            target=resolved.target_text,
+            target_name=resolved.target_name,
+            config=resolved.config,
+            options=resolved.options,
+        )
+    return _make_translation_example(
+        index, resolved, source_tokens, target_tokens, metadata
+    )
+
+
+_ResolvedExample = collections.namedtuple(
+    "_ResolvedExample",
+    ("source_text", "target_text", "target_name", "mode", "config", "options"),
+)
+
+
+def _resolve_example(index, raw_example, config=None, config_override=None):
+    """Validates a request example and resolves its configuration and options."""
     if not isinstance(raw_example, dict):
         raise InvalidRequest("example %d is not a JSON object" % index)
     source_text = raw_example.get("text")
@@ -340,19 +2434,17 @@ def preprocess_example(
                 "support Neural Fuzzy Adaptation"
             )
 
-    if preprocessor is None:
-        source_tokens = source_text
-        target_tokens = None
-        metadata = None
-    else:
-        source_tokens, target_tokens, metadata = preprocessor.process_input(
-            source_text,
-            target=target_text,
-            target_name=target_name,
-            config=config_override,
-            options=options,
-        )
+    return _ResolvedExample(
+        source_text=source_text,
+        target_text=target_text,
+        target_name=target_name,
+        mode=mode,
+        config=config_override,
+        options=options,
+    )
+
 
+def _make_translation_example(index, resolved, source_tokens, target_tokens, metadata):
     # Move to the general multiparts representation.
     if not source_tokens or not isinstance(source_tokens[0], list):
         source_tokens = [source_tokens]
@@ -361,53 +2453,129 @@ def preprocess_example(
 
     return TranslationExample(
         index=index,
-        config=config_override,
-        options=options,
+        config=resolved.config,
+        options=resolved.options,
         source_tokens=source_tokens,
         target_tokens=target_tokens,
-        mode=mode,
+        mode=resolved.mode,
         metadata=metadata,
     )
 
 
+def _group_by_config(items, get_config_and_options):
+    """Groups items sharing the same configuration override and options.
+
+    Returns:
+      A list of tuples (config, options, indices) in order of first appearance.
+    """
+    groups = collections.OrderedDict()
+    for i, item in enumerate(items):
+        config, options = get_config_and_options(item)
+        key = (
+            json.dumps(config, sort_keys=True, default=str),
+            json.dumps(options, sort_keys=True, default=str),
+        )
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = (config, options, [])
+        group[2].append(i)
+    return list(groups.values())
+
+
 def preprocess_examples(raw_examples, preprocessor, config=None, config_override=None):
-    """Applies preprocessing on a list of example structures."""
-    examples = []
-    for i, raw_example in enumerate(raw_examples):
-        example = preprocess_example(
-            preprocessor, i, raw_example, config=config, config_override=config_override
+    """Applies preprocessing on a list of example structures.
+
+    If the preprocessor implements process_inputs, examples sharing the same
+    configuration override and options are processed in a single batch.
+    """
+    if preprocessor is None or not hasattr(preprocessor, "process_inputs"):
+        return [
+            preprocess_example(
+                preprocessor,
+                i,
+                raw_example,
+                config=config,
+                config_override=config_override,
+            )
+            for i, raw_example in enumerate(raw_examples)
+        ]
+
+    resolved_examples = [
+        _resolve_example(i, raw_example, config=config, config_override=config_override)
+        for i, raw_example in enumerate(raw_examples)
+    ]
+    examples = [None] * len(resolved_examples)
+    groups = _group_by_config(
+        resolved_examples, lambda resolved: (resolved.config, resolved.options)
+    )
+    for group_config, group_options, indices in groups:
+        inputs = []
+        for i in indices:
+            resolved = resolved_examples[i]
+            inputs.append(
+                {
+                    "source": resolved.source_text,
+                    "target": resolved.target_text,
+                    "target_name": resolved.target_name,
+                }
+            )
+        results = preprocessor.process_inputs(
+            inputs, config=group_config, options=group_options
         )
-        examples.append(example)
+        for i, (source_tokens, target_tokens, metadata) in zip(indices, results):
+            examples[i] = _make_translation_example(
+                i, resolved_examples[i], source_tokens, target_tokens, metadata
+            )
     return examples
 
 
-def postprocess_output(output, example, postprocessor):
+def postprocess_output(
+    output, example, postprocessor, align_format="nested", align_threshold=None
+):
     """Applies postprocessing function on a translation output."""
 
     # Send all parts to the postprocessing.
     if postprocessor is None:
-        text = output.output[0]
-        score = None
-        align = None
-    else:
-        tgt_tokens = output.output
-        src_tokens = example.source_tokens
-        text = postprocessor.process_input(
-            src_tokens,
-            tgt_tokens,
-            metadata=example.metadata,
-            config=example.config,
-            options=example.options,
-        )
+        return _make_result(output.output[0])
+    text = postprocessor.process_input(
+        example.source_tokens,
+        output.output,
+        metadata=example.metadata,
+        config=example.config,
+        options=example.options,
+    )
+    return _make_result(
+        text,
+        output=output,
+        example=example,
+        align_format=align_format,
+        align_threshold=align_threshold,
+    )
+
+
+def _make_result(
+    text, output=None, example=None, align_format="nested", align_threshold=None
+):
+    score = None
+    align = None
+    if output is not None:
         score = sum(output.score) if all(s is not None for s in output.score) else None
         attention = output.attention
-        if attention and len(attention) == 1:
+        # The attention can be a NumPy array, so its length is checked explicitly.
+        # The alignments are only returned for single part examples.
+        if attention is not None and len(attention) == 1:
             attention = attention[0]
             align = (
-                align_tokens(src_tokens, tgt_tokens, attention) if attention else None
+                align_tokens(
+                    example.source_tokens[0],
+                    output.output[0],
+                    attention,
+                    flat=align_format == "flat",
+                    threshold=align_threshold,
+                )
+                if attention is not None and len(attention) > 0
+                else None
             )
-        else:
-            align = None
 
     result = {"text": text}
     if score is not None:
@@ -417,107 +2585,413 @@ def postprocess_output(output, example, postprocessor):
     return result
 
 
-def postprocess_outputs(outputs, examples, postprocessor):
-    """Applies postprocess on model outputs."""
+def postprocess_outputs(
+    outputs, examples, postprocessor, align_format="nested", align_threshold=None
+):
+    """Applies postprocess on model outputs.
+
+    If the postprocessor implements process_inputs, hypotheses of examples sharing
+    the same configuration override and options are processed in a single batch.
+    """
+    if postprocessor is None or not hasattr(postprocessor, "process_inputs"):
+        return [
+            [
+                postprocess_output(
+                    hypothesis,
+                    example,
+                    postprocessor,
+                    align_format=align_format,
+                    align_threshold=align_threshold,
+                )
+                for hypothesis in hypotheses
+            ]
+            for hypotheses, example in zip(outputs, examples)
+        ]
+
+    pairs = [
+        (hypothesis, example)
+        for hypotheses, example in zip(outputs, examples)
+        for hypothesis in hypotheses
+    ]
+    texts = [None] * len(pairs)
+    groups = _group_by_config(pairs, lambda pair: (pair[1].config, pair[1].options))
+    for group_config, group_options, indices in groups:
+        inputs = []
+        for i in indices:
+            hypothesis, example = pairs[i]
+            inputs.append(
+                {
+                    "source": example.source_tokens,
+                    "target": hypothesis.output,
+                    "metadata": example.metadata,
+                }
+            )
+        results = postprocessor.process_inputs(
+            inputs, config=group_config, options=group_options
+        )
+        for i, text in zip(indices, results):
+            texts[i] = text
+
     results = []
+    offset = 0
     for hypotheses, example in zip(outputs, examples):
         results.append(
             [
-                postprocess_output(hypothesis, example, postprocessor)
-                for hypothesis in hypotheses
+                _make_result(
+                    texts[offset + i],
+                    output=hypothesis,
+                    example=example,
+                    align_format=align_format,
+                    align_threshold=align_threshold,
+                )
+                for i, hypothesis in enumerate(hypotheses)
             ]
         )
+        offset += len(hypotheses)
     return results
 
 
-def align_tokens(src_tokens, tgt_tokens, attention):
+def align_tokens(src_tokens, tgt_tokens, attention, flat=False, threshold=None):
+    """Aligns target tokens with source tokens from the attention weights.
+
+    Each target token is aligned with the source token receiving the most
+    attention or, if threshold is set, with all source tokens receiving at least
+    this attention weight. The attention can be a list of lists or a 2D array of
+    shape [target length, source length]. When NumPy is installed, the alignments
+    of all target tokens are computed with array operations.
+
+    By default, each alignment is a dictionary with the character range and the
+    index of the target and source tokens. If flat is True, the alignments are
+    instead returned as a flat list of integers with 6 values per aligned pair:
+    tgt_start, tgt_end, tgt_id, src_start, src_end, src_id.
+    """
     if not src_tokens or not tgt_tokens:
         return []
-    src_ranges = []
-    offset = 0
-    for src_token in src_tokens:
-        src_ranges.append((offset, offset + len(src_token)))
-        offset += len(src_token) + 1
+    if np is not None:
+        links = _align_links_numpy(src_tokens, tgt_tokens, attention, threshold)
+        if flat:
+            return links.ravel().tolist()
+        links = links.tolist()
+    else:
+        links = _align_links(src_tokens, tgt_tokens, attention, threshold)
+        if flat:
+            return [value for link in links for value in link]
+
     alignments = []
-    offset = 0
-    for tgt_id, (tgt_token, attn) in enumerate(zip(tgt_tokens, attention)):
-        src_id = attn.index(max(attn))
-        tgt_range = (offset, offset + len(tgt_token))
-        src_range = src_ranges[src_id]
-        offset += len(tgt_token) + 1
-        alignments.append(
-            {
-                "tgt": [{"range": tgt_range, "id": tgt_id}],
-                "src": [{"range": src_range, "id": src_id}],
-            }
-        )
+    for tgt_start, tgt_end, tgt_id, src_start, src_end, src_id in links:
+        src = {"range": (src_start, src_end), "id": src_id}
+        if alignments and alignments[-1]["tgt"][0]["id"] == tgt_id:
+            alignments[-1]["src"].append(src)
+        else:
+            alignments.append(
+                {"tgt": [{"range": (tgt_start, tgt_end), "id": tgt_id}], "src": [src]}
+            )
     return alignments
 
 
-def translate_examples(examples, func, max_batch_size=None, options=None):
-    """Translates examples."""
+def _token_ranges(tokens):
+    ranges = []
+    offset = 0
+    for token in tokens:
+        ranges.append((offset, offset + len(token)))
+        offset += len(token) + 1
+    return ranges
+
+
+def _align_links(src_tokens, tgt_tokens, attention, threshold):
+    """Returns the aligned pairs as tuples sorted by target index."""
+    src_ranges = _token_ranges(src_tokens)
+    tgt_ranges = _token_ranges(tgt_tokens)
+    num_src = len(src_tokens)
+    links = []
+    for tgt_id, (tgt_range, attn) in enumerate(zip(tgt_ranges, attention)):
+        attn = list(attn[:num_src])
+        if threshold is None:
+            src_ids = [attn.index(max(attn))]
+        else:
+            src_ids = [
+                src_id for src_id, value in enumerate(attn) if value >= threshold
+            ]
+        for src_id in src_ids:
+            links.append(tgt_range + (tgt_id,) + src_ranges[src_id] + (src_id,))
+    return links
+
+
+def _token_ranges_numpy(tokens):
+    lengths = np.fromiter((len(token) for token in tokens), np.int64, len(tokens))
+    ends = np.cumsum(lengths + 1) - 1
+    return ends - lengths, ends
+
+
+def _align_links_numpy(src_tokens, tgt_tokens, attention, threshold):
+    """Returns the aligned pairs as an array of shape [num_links, 6] sorted by
+    target index."""
+    attention = np.asarray(attention)
+    attention = attention[: len(tgt_tokens), : len(src_tokens)]
+    if threshold is None:
+        tgt_ids = np.arange(attention.shape[0])
+        src_ids = attention.argmax(axis=1)
+    else:
+        tgt_ids, src_ids = np.nonzero(attention >= threshold)
+    src_starts, src_ends = _token_ranges_numpy(src_tokens)
+    tgt_starts, tgt_ends = _token_ranges_numpy(tgt_tokens[: attention.shape[0]])
+    return np.stack(
+        [
+            tgt_starts[tgt_ids],
+            tgt_ends[tgt_ids],
+            tgt_ids,
+            src_starts[src_ids],
+            src_ends[src_ids],
+            src_ids,
+        ],
+        axis=1,
+    )
+
+
+def translate_examples(
+    examples,
+    func,
+    max_batch_size=None,
+    max_batch_tokens=None,
+    sort_by_length=False,
+    options=None,
+    cache=None,
+    model_id=None,
+    deadline=None,
+):
+    """Translates examples.
+
+    If a TranslationCache is set, the parts found in the cache are not sent to
+    the translation function, and the new hypotheses are added to the cache.
+
+    If a Deadline is set, it is checked before each batch: the batches that are
+    not started when the deadline expires are not translated and
+    TranslationTimeout is raised.
+    """
+    outputs_per_example = {}
+    for completed in iter_translate_examples(
+        examples,
+        func,
+        max_batch_size=max_batch_size,
+        max_batch_tokens=max_batch_tokens,
+        sort_by_length=sort_by_length,
+        options=options,
+        cache=cache,
+        model_id=model_id,
+        deadline=deadline,
+    ):
+        for example, outputs in completed:
+            outputs_per_example[example.index] = outputs
+    return [outputs_per_example[example.index] for example in examples]
+
+
+def iter_translate_examples(
+    examples,
+    func,
+    max_batch_size=None,
+    max_batch_tokens=None,
+    sort_by_length=False,
+    options=None,
+    cache=None,
+    model_id=None,
+    deadline=None,
+):
+    """Translates examples and yields them as soon as all their parts are translated.
+
+    The arguments are the same as translate_examples.
+
+    Yields:
+      Non empty lists of tuples (example, outputs), where outputs is the list of
+      merged hypotheses of the example. A list is yielded after each call to the
+      translation function (and first for the examples found in the cache).
+    """
     if options is None:
         options = {}
-    hypotheses_per_example = collections.defaultdict(list)
-    for batch in batch_iterator(examples, max_batch_size=max_batch_size):
-        batch_options = options.copy()
-        batch_options["mode"] = batch.mode
-        batch_hypotheses = func(batch.source_tokens, batch.target_tokens, batch_options)
-        if batch_hypotheses is None:
-            raise TranslationTimeout("translation failed or timed out")
-
-        # Gather hypotheses by example id.
-        for index, hypotheses in zip(batch.indices, batch_hypotheses):
-            hypotheses_per_example[index].append(hypotheses)
-
-    # Merge multi-part hypotheses.
-    outputs = []
-    for index, hypotheses in hypotheses_per_example.items():
-        num_hypotheses = len(hypotheses[0])
-        outputs.insert(
-            index,
-            [
+    examples_per_index = {example.index: example for example in examples}
+    hypotheses_per_example = collections.defaultdict(dict)
+    start = time.time()
+    excluded_time = 0
+
+    def _completed(indices):
+        completed = []
+        for index in indices:
+            example = examples_per_index[index]
+            example_hypotheses = hypotheses_per_example.get(index)
+            if (
+                example_hypotheses is None
+                or len(example_hypotheses) != example.num_parts
+            ):
+                continue
+            del hypotheses_per_example[index]
+
+            # Merge multi-part hypotheses.
+            hypotheses = [example_hypotheses[part] for part in range(example.num_parts)]
+            num_hypotheses = len(hypotheses[0])
+            outputs = [
                 merge_translation_outputs(part[h] for part in hypotheses)
                 for h in range(num_hypotheses)
-            ],
-        )
-
-    return outputs
+            ]
+            completed.append((example, outputs))
+        return completed
 
+    try:
+        cached_parts = set()
+        if cache is not None:
+            for example in examples:
+                for part, (source_tokens, target_tokens) in enumerate(
+                    zip(example.source_tokens, example.target_tokens)
+                ):
+                    key = cache.make_key(
+                        model_id, example.mode, source_tokens, target_tokens, options
+                    )
+                    hypotheses = cache.get(key)
+                    if hypotheses is not None:
+                        hypotheses_per_example[example.index][part] = hypotheses
+                        cached_parts.add((example.index, part))
+
+            completed = _completed([example.index for example in examples])
+            if completed:
+                yield_start = time.time()
+                yield completed
+                excluded_time += time.time() - yield_start
+
+        for batch in batch_iterator(
+            examples,
+            max_batch_size=max_batch_size,
+            max_batch_tokens=max_batch_tokens,
+            sort_by_length=sort_by_length,
+            exclude=cached_parts,
+        ):
+            if deadline is not None:
+                deadline.check("translate")
+            batch_options = options.copy()
+            batch_options["mode"] = batch.mode
+            batch_start = time.time()
+            batch_hypotheses = func(
+                batch.source_tokens, batch.target_tokens, batch_options
+            )
+            excluded_time += time.time() - batch_start
+            if batch_hypotheses is None:
+                raise TranslationTimeout("translation failed or timed out")
+
+            # Gather hypotheses by example id and part id.
+            for i, (index, hypotheses) in enumerate(
+                zip(batch.indices, batch_hypotheses)
+            ):
+                example_hypotheses = hypotheses_per_example[index]
+                part = (
+                    batch.parts[i]
+                    if batch.parts is not None
+                    else len(example_hypotheses)
+                )
+                example_hypotheses[part] = hypotheses
+                if cache is not None:
+                    key = cache.make_key(
+                        model_id,
+                        batch.mode,
+                        batch.source_tokens[i],
+                        batch.target_tokens[i],
+                        options,
+                    )
+                    cache.put(key, hypotheses)
+
+            completed = _completed(collections.OrderedDict.fromkeys(batch.indices))
+            if completed:
+                yield_start = time.time()
+                yield completed
+                excluded_time += time.time() - yield_start
+    finally:
+        # Record the time spent outside of the translation function and consumers.
+        _STAGE_LATENCY.labels("batching").observe(time.time() - start - excluded_time)
+
+
+def batch_iterator(
+    examples,
+    max_batch_size=None,
+    max_batch_tokens=None,
+    sort_by_length=False,
+    exclude=None,
+):
+    """Yields batch of tokens not larger than max_batch_size.
 
-def batch_iterator(examples, max_batch_size=None):
-    """Yields batch of tokens not larger than max_batch_size."""
+    Args:
+      examples: A list of TranslationExample.
+      max_batch_size: The maximum number of parts in a batch.
+      max_batch_tokens: The maximum number of source tokens in a batch, including
+        padding (i.e. the batch size times the length of the longest part).
+      sort_by_length: If True, the parts are sorted by source length so that parts
+        of similar length are batched together.
+      exclude: A set of (example index, part index) that should not be batched.
+
+    The batches define the "parts" field when the parts are sorted or excluded.
+    """
     examples_per_mode = collections.defaultdict(list)
     for example in examples:
         examples_per_mode[example.mode].append(example)
     for mode, examples in examples_per_mode.items():
         indices = []
+        parts = []
         source_tokens = []
         target_tokens = []
         for example in examples:
-            indices.extend(example.index for _ in range(example.num_parts))
-            source_tokens.extend(example.source_tokens)
-            target_tokens.extend(example.target_tokens)
-        batch_size = len(source_tokens)
-        if max_batch_size is None or batch_size <= max_batch_size:
+            for part in range(example.num_parts):
+                if exclude and (example.index, part) in exclude:
+                    continue
+                indices.append(example.index)
+                parts.append(part)
+                source_tokens.append(example.source_tokens[part])
+                target_tokens.append(example.target_tokens[part])
+        if not source_tokens:
+            continue
+        if sort_by_length:
+            order = sorted(
+                range(len(source_tokens)), key=lambda i: len(source_tokens[i])
+            )
+            indices = [indices[i] for i in order]
+            parts = [parts[i] for i in order]
+            source_tokens = [source_tokens[i] for i in order]
+            target_tokens = [target_tokens[i] for i in order]
+        elif not exclude:
+            parts = None
+        for lower_bound, upper_bound in _batch_bounds(
+            source_tokens,
+            max_batch_size=max_batch_size,
+            max_batch_tokens=max_batch_tokens,
+        ):
             yield TranslationBatch(
-                indices=indices,
-                source_tokens=source_tokens,
-                target_tokens=target_tokens,
+                indices=indices[lower_bound:upper_bound],
+                source_tokens=source_tokens[lower_bound:upper_bound],
+                target_tokens=target_tokens[lower_bound:upper_bound],
                 mode=mode,
+                parts=parts[lower_bound:upper_bound] if parts is not None else None,
             )
-        else:
-            offset = 0
-            while offset < batch_size:
-                lower_bound = offset
-                upper_bound = min(offset + max_batch_size, batch_size)
-                yield TranslationBatch(
-                    indices=indices[lower_bound:upper_bound],
-                    source_tokens=source_tokens[lower_bound:upper_bound],
-                    target_tokens=target_tokens[lower_bound:upper_bound],
-                    mode=mode,
-                )
-                offset = upper_bound
+
+
+def _batch_bounds(source_tokens, max_batch_size=None, max_batch_tokens=None):
+    """Yields the (lower, upper) bounds of consecutive batches in source_tokens."""
+    batch_size = len(source_tokens)
+    if max_batch_tokens is None:
+        if max_batch_size is None:
+            max_batch_size = batch_size
+        for offset in range(0, batch_size, max_batch_size):
+            yield offset, min(offset + max_batch_size, batch_size)
+        return
+
+    lower_bound = 0
+    max_length = 0
+    for i, tokens in enumerate(source_tokens):
+        length = max(max_length, len(tokens))
+        size = i - lower_bound + 1
+        if size > 1 and (
+            (max_batch_size is not None and size > max_batch_size)
+            or size * length > max_batch_tokens
+        ):
+            yield lower_bound, i
+            lower_bound = i
+            length = len(tokens)
+        max_length = length
+    if lower_bound < batch_size:
+        yield lower_bound, batch_size
 
 
 def merge_translation_outputs(parts):
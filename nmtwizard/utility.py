@@ -29,7 +29,7 @@ os.environ.setdefault("CORPUS_DIR", "/root/corpus")
 os.environ.setdefault("MODELS_DIR", "/root/models")
 
 
-def getenv(m, training=True):
+def getenv(m, training=True, variables=None):
     var = m.group(1)
     if "TRAIN_" in var:
         if not training:
@@ -38,6 +38,8 @@ def getenv(m, training=True):
             var = "CORPUS_DIR"
         else:
             var = var.replace("TRAIN_", "")
+    if variables is not None and var in variables:
+        return variables[var]
     value = os.getenv(var)
     if value is None:
         raise ValueError("Environment variable %s is not defined" % var)
@@ -59,13 +61,18 @@ def _map_config_fn(a, fn):
         return fn(a)
 
 
-def resolve_environment_variables(config, training=True):
-    """Returns a new configuration with all environment variables replaced."""
+def resolve_environment_variables(config, training=True, variables=None):
+    """Returns a new configuration with all environment variables replaced.
+
+    The values in the variables dictionary take precedence over the environment.
+    """
 
     def _map_fn(value):
         if not isinstance(value, str):
             return value
-        return ENVVAR_RE.sub(lambda m: getenv(m, training=training), value)
+        return ENVVAR_RE.sub(
+            lambda m: getenv(m, training=training, variables=variables), value
+        )
 
     return _map_config_fn(config, _map_fn)
 
@@ -379,8 +386,8 @@ def check_model_dir(should_check_integrity_fn, model_dir, force=False):
     return md5check == md5ref
 
 
-def fetch_model(storage, remote_model_path, model_path, should_check_integrity_fn):
-    """Downloads the remote model."""
+def download_model(storage, remote_model_path, model_path, should_check_integrity_fn):
+    """Downloads the remote model and returns its configuration."""
     check_integrity_fn = functools.partial(check_model_dir, should_check_integrity_fn)
     storage.get(
         remote_model_path,
@@ -388,5 +395,13 @@ def fetch_model(storage, remote_model_path, model_path, should_check_integrity_f
         directory=True,
         check_integrity_fn=check_integrity_fn,
     )
-    os.environ["MODEL_DIR"] = model_path
     return load_model_config(model_path)
+
+
+def fetch_model(storage, remote_model_path, model_path, should_check_integrity_fn):
+    """Downloads the remote model and sets MODEL_DIR to its local path."""
+    model_config = download_model(
+        storage, remote_model_path, model_path, should_check_integrity_fn
+    )
+    os.environ["MODEL_DIR"] = model_path
+    return model_config
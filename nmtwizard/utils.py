@@ -108,6 +108,15 @@ def open_file(path, *args, **kwargs):
         return open(path, *args, **kwargs)
 
 
+def get_directory_size(path):
+    """Returns the total size in bytes of the files in a directory."""
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(root, filename))
+    return size
+
+
 def count_lines(path, buffer_size=65536):
     path_new = get_file_path(path)
     if path_new is None:
@@ -0,0 +1,225 @@
+import contextlib
+import json
+import socket
+import threading
+import time
+
+import requests
+
+from nmtwizard import async_server
+from nmtwizard import serving
+
+
+@contextlib.contextmanager
+def _run_server(handler, **kwargs):
+    port = serving.pick_free_port()
+    server = async_server.AsyncHTTPServer("127.0.0.1", port, handler, **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:%d" % port, server
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+def _echo_handler(method, path, headers, body, is_cancelled=None):
+    data = {
+        "method": method,
+        "path": path,
+        "content_type": headers.get("content-type"),
+        "body": body.decode("utf-8"),
+    }
+    return 200, {"Content-Type": "application/json"}, json.dumps(data).encode("utf-8")
+
+
+def test_async_server():
+    with _run_server(_echo_handler) as (url, _):
+        with requests.Session() as session:
+            response = session.get(url + "/status")
+            assert response.status_code == 200
+            assert response.headers["Connection"] == "keep-alive"
+            assert response.json()["method"] == "GET"
+            assert response.json()["path"] == "/status"
+
+            # The same connection is reused for the next request.
+            response = session.post(url + "/translate", json={"src": []})
+            assert response.status_code == 200
+            assert response.json()["method"] == "POST"
+            assert response.json()["content_type"] == "application/json"
+            assert json.loads(response.json()["body"]) == {"src": []}
+
+
+def test_async_server_streamed_response():
+    def _handler(method, path, headers, body, is_cancelled=None):
+        chunks = (("line %d\n" % i).encode("utf-8") for i in range(3))
+        return 200, {"Content-Type": "application/x-ndjson"}, chunks
+
+    with _run_server(_handler) as (url, _):
+        with requests.Session() as session:
+            response = session.get(url + "/translate", stream=True)
+            assert response.headers["Transfer-Encoding"] == "chunked"
+            assert list(response.iter_lines()) == [b"line 0", b"line 1", b"line 2"]
+
+            # The connection can be reused after a streamed response.
+            response = session.get(url + "/translate")
+            assert response.text == "line 0\nline 1\nline 2\n"
+
+
+def test_async_server_client_disconnect():
+    disconnected = threading.Event()
+
+    def _handler(method, path, headers, body, is_cancelled=None):
+        for _ in range(100):
+            if is_cancelled():
+                disconnected.set()
+                break
+            time.sleep(0.05)
+        return 200, {}, b""
+
+    with _run_server(_handler) as (url, server):
+        port = int(url.rsplit(":", 1)[1])
+        with socket.create_connection(("127.0.0.1", port)) as connection:
+            connection.sendall(b"GET /status HTTP/1.1\r\n\r\n")
+            time.sleep(0.1)
+        assert disconnected.wait(5)
+
+
+def test_async_server_handler_error():
+    def _handler(method, path, headers, body, is_cancelled=None):
+        raise RuntimeError("handler error")
+
+    with _run_server(_handler) as (url, _):
+        response = requests.get(url + "/status")
+        assert response.status_code == 500
+
+
+def test_async_server_admission_control():
+    started = threading.Event()
+    release = threading.Event()
+
+    def _handler(method, path, headers, body, is_cancelled=None):
+        started.set()
+        release.wait()
+        return 200, {}, b"{}"
+
+    with _run_server(_handler, max_queue_size=1) as (url, server):
+        responses = []
+        thread = threading.Thread(
+            target=lambda: responses.append(requests.get(url + "/translate"))
+        )
+        thread.start()
+        started.wait()
+        assert server.num_pending == 1
+
+        response = requests.get(url + "/translate")
+        assert response.status_code == 503
+
+        release.set()
+        thread.join()
+        assert responses[0].status_code == 200
+
+
+def test_async_server_invalid_content_length():
+    with _run_server(_echo_handler) as (url, _):
+        port = int(url.rsplit(":", 1)[1])
+        with socket.create_connection(("127.0.0.1", port)) as connection:
+            connection.settimeout(5)
+            connection.sendall(
+                b"POST /translate HTTP/1.1\r\nContent-Length: abc\r\n\r\n"
+            )
+            response = connection.recv(1024)
+        assert response.startswith(b"HTTP/1.1 400 ")
+
+        # The server still accepts new connections.
+        assert requests.get(url + "/status").status_code == 200
+
+
+def _send_raw_request(url, data, timeout=5):
+    port = int(url.rsplit(":", 1)[1])
+    with socket.create_connection(("127.0.0.1", port)) as connection:
+        connection.settimeout(timeout)
+        connection.sendall(data)
+        return connection.recv(1024)
+
+
+def test_async_server_slow_headers():
+    with _run_server(_echo_handler, keep_alive_timeout=0.5) as (url, _):
+        port = int(url.rsplit(":", 1)[1])
+        with socket.create_connection(("127.0.0.1", port)) as connection:
+            connection.settimeout(5)
+            start = time.time()
+            connection.sendall(b"GET /status HTTP/1.1\r\nHost: localhost\r\n")
+            # The connection is closed when the headers are not completed in time.
+            assert connection.recv(1024) == b""
+            assert time.time() - start < 2
+        assert requests.get(url + "/status").status_code == 200
+
+
+def test_async_server_too_many_headers():
+    with _run_server(_echo_handler) as (url, _):
+        headers = b"".join(b"X-Header-%d: a\r\n" % i for i in range(200))
+        response = _send_raw_request(
+            url, b"GET /status HTTP/1.1\r\n" + headers + b"\r\n"
+        )
+        assert response.startswith(b"HTTP/1.1 431 ")
+        assert requests.get(url + "/status").status_code == 200
+
+
+def test_async_server_line_too_long():
+    with _run_server(_echo_handler) as (url, _):
+        value = b"a" * (1 << 17)
+        response = _send_raw_request(
+            url, b"GET /status HTTP/1.1\r\nX-Header: " + value + b"\r\n\r\n"
+        )
+        assert response.startswith(b"HTTP/1.1 431 ")
+        response = _send_raw_request(url, b"GET /" + value + b" HTTP/1.1\r\n\r\n")
+        assert response.startswith(b"HTTP/1.1 400 ")
+        assert requests.get(url + "/status").status_code == 200
+
+
+def test_async_server_body_too_large():
+    with _run_server(_echo_handler, max_body_size=16) as (url, _):
+        response = requests.post(url + "/translate", data=b"a" * 17)
+        assert response.status_code == 413
+        assert response.headers["Connection"] == "close"
+        response = requests.post(url + "/translate", data=b"a" * 16)
+        assert response.status_code == 200
+        assert response.json()["body"] == "a" * 16
+
+
+def test_async_server_admission_control_streamed_response():
+    started = threading.Event()
+    release = threading.Event()
+
+    def _handler(method, path, headers, body, is_cancelled=None):
+        def _chunks():
+            yield b"line 0\n"
+            started.set()
+            release.wait()
+            yield b"line 1\n"
+
+        return 200, {"Content-Type": "application/x-ndjson"}, _chunks()
+
+    with _run_server(_handler, max_queue_size=1) as (url, server):
+        responses = []
+        thread = threading.Thread(
+            target=lambda: responses.append(requests.get(url + "/translate"))
+        )
+        thread.start()
+        started.wait()
+        # The request is still pending while its response is streamed.
+        assert server.num_pending == 1
+        assert requests.get(url + "/translate").status_code == 503
+
+        release.set()
+        thread.join()
+        assert responses[0].text == "line 0\nline 1\n"
+        # The slot is released after the last chunk is written.
+        for _ in range(50):
+            if server.num_pending == 0:
+                break
+            time.sleep(0.01)
+        assert server.num_pending == 0
+        assert requests.get(url + "/status").status_code == 200
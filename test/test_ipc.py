@@ -0,0 +1,115 @@
+import os
+import socket
+import threading
+
+import pytest
+
+from nmtwizard import ipc
+
+
+def test_encode_decode_batch():
+    batch = [["Hello", "world", "!"], [], ["ça", "va", "😀", ""]]
+    assert ipc.decode_batch(ipc.encode_batch(batch)) == batch
+    assert ipc.decode_batch(ipc.encode_batch([[], []])) == [[], []]
+    with pytest.raises(ValueError):
+        ipc.encode_batch([["a\x1fb"]])
+
+
+def test_encode_decode_request():
+    batch = [["a", "b"], ["c"]]
+    data = ipc.encode_request(batch, {"beam_size": 2})
+    assert ipc.decode_request(data) == (batch, {"beam_size": 2})
+
+
+def test_encode_decode_response():
+    data = ipc.encode_response([["x", "y"], ["z"]], [-0.5, -1.25])
+    assert ipc.decode_response(data) == ([["x", "y"], ["z"]], [-0.5, -1.25])
+    with pytest.raises(ipc.BackendError, match="out of memory"):
+        ipc.decode_response(ipc.encode_error("out of memory"))
+
+
+def _start_server(path, translate_fn):
+    server = ipc.IPCServer(path, translate_fn)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def _stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+def _reverse(batch, options):
+    if options.get("fail"):
+        raise ValueError("invalid batch")
+    return [list(reversed(tokens)) for tokens in batch], [float(len(batch))] * len(
+        batch
+    )
+
+
+def test_ipc_client_server(tmp_path):
+    path = str(tmp_path / "backend.sock")
+    server = _start_server(path, _reverse)
+    client = ipc.IPCClient(path, max_connections=2)
+    try:
+        for _ in range(3):
+            hypotheses, scores = client.translate([["a", "b", "c"], ["d"]])
+            assert hypotheses == [["c", "b", "a"], ["d"]]
+            assert scores == [2.0, 2.0]
+        with pytest.raises(ipc.BackendError, match="invalid batch"):
+            client.translate([["a"]], options={"fail": True})
+
+        # The client reconnects when the backend is restarted.
+        _stop_server(server)
+        assert not os.path.exists(path)
+        with pytest.raises(ConnectionError):
+            client.translate([["a"]])
+        server = _start_server(path, _reverse)
+        assert client.translate([["a", "b"]]) == ([["b", "a"]], [1.0])
+    finally:
+        client.close()
+        _stop_server(server)
+
+
+def test_ipc_client_server_restart(tmp_path):
+    path = str(tmp_path / "backend.sock")
+    server = _start_server(path, _reverse)
+    client = ipc.IPCClient(path, max_connections=2)
+    try:
+        assert client.translate([["a", "b"]]) == ([["b", "a"]], [1.0])
+        # The idle connection to the previous server is transparently replaced.
+        _stop_server(server)
+        server = _start_server(path, _reverse)
+        assert client.translate([["a", "b"]]) == ([["b", "a"]], [1.0])
+        assert client.translate([["c"]]) == ([["c"]], [1.0])
+    finally:
+        client.close()
+        _stop_server(server)
+
+
+def test_ipc_client_backend_crash(tmp_path):
+    path = str(tmp_path / "backend.sock")
+    batches = []
+
+    def _translate(batch, options):
+        batches.append(batch)
+        if batch == [["crash"]]:
+            # The backend dies after receiving the batch.
+            with server.connections_lock:
+                for connection in server.connections:
+                    connection.shutdown(socket.SHUT_RDWR)
+        return _reverse(batch, options)
+
+    server = _start_server(path, _translate)
+    client = ipc.IPCClient(path, max_connections=2)
+    try:
+        assert client.translate([["a", "b"]]) == ([["b", "a"]], [1.0])
+        # The batch received by the backend is not sent again.
+        with pytest.raises(ConnectionError):
+            client.translate([["crash"]])
+        assert batches == [[["a", "b"]], [["crash"]]]
+        assert client.translate([["a", "b"]]) == ([["b", "a"]], [1.0])
+    finally:
+        client.close()
+        _stop_server(server)
@@ -0,0 +1,63 @@
+import pytest
+
+from nmtwizard import metrics
+
+
+def _lines(registry):
+    return registry.generate_latest().decode("utf-8").splitlines()
+
+
+def test_counter():
+    registry = metrics.Registry()
+    counter = metrics.Counter(
+        "requests_total", "Number of requests.", ("code",), registry=registry
+    )
+    counter.labels(200).inc()
+    counter.labels(200).inc()
+    counter.labels(404).inc()
+    assert _lines(registry) == [
+        "# HELP requests_total Number of requests.",
+        "# TYPE requests_total counter",
+        'requests_total{code="200"} 2',
+        'requests_total{code="404"} 1',
+    ]
+
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        counter.labels(200, "GET")
+
+
+def test_gauge():
+    registry = metrics.Registry()
+    gauge = metrics.Gauge("in_flight", "Number of requests.", registry=registry)
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    assert _lines(registry)[-1] == "in_flight 1"
+    gauge.set(5)
+    assert _lines(registry)[-1] == "in_flight 5"
+
+
+def test_histogram():
+    registry = metrics.Registry()
+    histogram = metrics.Histogram(
+        "latency", "Latency.", ("stage",), buckets=(0.1, 1), registry=registry
+    )
+    histogram.labels("translate").observe(0.05)
+    histogram.labels("translate").observe(0.1)
+    histogram.labels("translate").observe(2)
+    assert _lines(registry)[2:] == [
+        'latency_bucket{stage="translate",le="0.1"} 2',
+        'latency_bucket{stage="translate",le="1"} 2',
+        'latency_bucket{stage="translate",le="+Inf"} 3',
+        'latency_sum{stage="translate"} 2.15',
+        'latency_count{stage="translate"} 3',
+    ]
+
+
+def test_registry_duplicate_metric():
+    registry = metrics.Registry()
+    metrics.Counter("requests_total", "Number of requests.", registry=registry)
+    with pytest.raises(ValueError):
+        metrics.Gauge("requests_total", "Number of requests.", registry=registry)
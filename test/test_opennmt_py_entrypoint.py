@@ -0,0 +1,196 @@
+import http.server
+import importlib.util
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+
+from nmtwizard import ipc, serving
+
+
+def _load_entrypoint():
+    root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    path = os.path.join(root_dir, "frameworks", "opennmt_py", "entrypoint.py")
+    spec = importlib.util.spec_from_file_location("opennmt_py_entrypoint", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+entrypoint = _load_entrypoint()
+
+
+class _TranslationHandler(http.server.BaseHTTPRequestHandler):
+    """Mimics the /translate route of onmt_server by reversing the tokens."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.clients.add(self.client_address)
+        if self.path != "/translator-backend/translate":
+            self.send_error(404)
+            return
+        srcs = [example["src"] for example in data]
+        if "slow" in srcs:
+            time.sleep(0.5)
+        if "fail" in srcs:
+            result = {"error": "invalid batch"}
+        else:
+            result = [
+                [
+                    {"tgt": " ".join(reversed(src.split())), "pred_score": -1.0}
+                    for src in srcs
+                ]
+            ]
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _TranslationServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port):
+        super().__init__(("127.0.0.1", port), _TranslationHandler)
+        self.clients = set()
+        self.connections = []
+
+    def process_request(self, request, client_address):
+        self.connections.append(request)
+        super().process_request(request, client_address)
+
+    def handle_error(self, request, client_address):
+        # The client closes the connection when the request times out.
+        pass
+
+    def server_close(self):
+        super().server_close()
+        # Like a backend process exiting, also close the kept-alive connections.
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def _start_server(port):
+    server = _TranslationServer(port)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def _stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+def _translate(model_info, inputs, options=None):
+    # forward_request does not depend on the framework state.
+    return entrypoint.OpenNMTPYFramework.forward_request(
+        None, model_info, inputs, options=options
+    )
+
+
+@pytest.fixture
+def model_info():
+    port = serving.pick_free_port()
+    session = entrypoint._make_session(2)
+    yield {"port": port, "session": session}
+    session.close()
+
+
+def test_forward_request_over_session(model_info):
+    server = _start_server(model_info["port"])
+    try:
+        for _ in range(3):
+            outputs = _translate(model_info, [["a", "b", "c"], ["d"]])
+            assert [[output.output for output in hyps] for hyps in outputs] == [
+                [["c", "b", "a"]],
+                [["d"]],
+            ]
+            assert outputs[0][0].score == -1.0
+        # The sequential requests reused the same connection.
+        assert len(server.clients) == 1
+        with pytest.raises(RuntimeError, match="invalid batch"):
+            _translate(model_info, [["fail"]])
+        assert _translate(model_info, [["slow"]], options={"timeout": 0.1}) is None
+    finally:
+        _stop_server(server)
+
+
+def test_forward_request_backend_restart(model_info):
+    server = _start_server(model_info["port"])
+    try:
+        assert _translate(model_info, [["a", "b"]])[0][0].output == ["b", "a"]
+        # The idle connection to the previous server is replaced.
+        _stop_server(server)
+        server = _start_server(model_info["port"])
+        assert _translate(model_info, [["a", "b"]])[0][0].output == ["b", "a"]
+    finally:
+        _stop_server(server)
+    with pytest.raises(serving.BackendUnavailable):
+        _translate(model_info, [["a", "b"]])
+
+
+def _reverse(batch, options):
+    if any("slow" in tokens for tokens in batch):
+        time.sleep(0.5)
+    if any("fail" in tokens for tokens in batch):
+        raise ValueError("invalid batch")
+    return [list(reversed(tokens)) for tokens in batch], [-1.0] * len(batch)
+
+
+def _start_ipc_server(path):
+    server = ipc.IPCServer(path, _reverse)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def test_make_socket_path():
+    path = entrypoint._make_socket_path()
+    try:
+        directory = os.path.dirname(path)
+        assert not os.path.exists(path)
+        assert os.stat(directory).st_mode & 0o777 == 0o700
+        assert len(path) < 100
+    finally:
+        os.rmdir(directory)
+
+
+def test_forward_request_over_ipc(tmp_path):
+    path = str(tmp_path / "backend.sock")
+    client = ipc.IPCClient(path, max_connections=2)
+    model_info = {"ipc_client": client}
+    server = _start_ipc_server(path)
+    try:
+        outputs = _translate(model_info, [["a", "b", "c"], ["d"]])
+        assert [[output.output for output in hyps] for hyps in outputs] == [
+            [["c", "b", "a"]],
+            [["d"]],
+        ]
+        assert outputs[0][0].score == -1.0
+        with pytest.raises(RuntimeError, match="invalid batch"):
+            _translate(model_info, [["fail"]])
+        assert _translate(model_info, [["slow"]], options={"timeout": 0.1}) is None
+        # The idle connection to the previous server is replaced.
+        _stop_server(server)
+        server = _start_ipc_server(path)
+        assert _translate(model_info, [["a", "b"]])[0][0].output == ["b", "a"]
+    finally:
+        _stop_server(server)
+    with pytest.raises(serving.BackendUnavailable):
+        _translate(model_info, [["a", "b"]])
+    client.close()
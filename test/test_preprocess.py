@@ -5,20 +5,33 @@ from copy import deepcopy
 import random
 import glob
 import time
+import threading
 import requests_mock
 
 from nmtwizard import beat_service
+from nmtwizard import config as config_util
 from nmtwizard import utils
-from nmtwizard.preprocess.consumer import Consumer
-from nmtwizard.preprocess.loader import Loader
+from nmtwizard.preprocess.consumer import Consumer, SamplerFileWriter
+from nmtwizard.preprocess.loader import (
+    Loader,
+    PreprocessFileLoader,
+    SampledLinesReader,
+    SamplerFileLoader,
+    SamplerFileReaderLoader,
+)
 from nmtwizard.preprocess.preprocess import (
     Processor,
     InferenceProcessor,
     TrainingProcessor,
 )
 from nmtwizard.preprocess.tokenizer import vocabulary_iterator
-from nmtwizard.preprocess.tu import TranslationUnit
+from nmtwizard.preprocess.tu import (
+    PackedOutputs,
+    PreprocessOutput,
+    TranslationUnit,
+)
 from nmtwizard.preprocess import prepoperator
+from nmtwizard.preprocess import sampler
 
 
 def generate_pseudo_corpus(corpus_dir, size, name, suffix):
@@ -856,6 +869,214 @@ def test_preprocess_gzip_file(tmpdir):
     assert utils.count_lines(output_path)[1] == num_lines
 
 
+def test_preprocess_file_loader_batch_chars(tmpdir):
+    input_path = generate_pseudo_corpus(tmpdir, 10, "input", "en")
+    file_loader = PreprocessFileLoader(input_path, batch_size=4, batch_chars=20)
+    batches = list(file_loader())
+    # Each line "input N\n" contains 8 characters.
+    assert [len(tu_list) for tu_list, _ in batches] == [3, 3, 3, 1]
+    assert [meta["num_chars"] for _, meta in batches] == [24, 24, 24, 8]
+
+    file_loader = PreprocessFileLoader(input_path, batch_size=4)
+    assert [len(tu_list) for tu_list, _ in file_loader()] == [4, 4, 2]
+
+
+@pytest.mark.parametrize("num_cpus", [1, 2])
+def test_preprocess_with_memory_limit(tmpdir, num_cpus):
+    os.environ["NB_CPU"] = str(num_cpus)
+    config = deepcopy(config_base)
+    config["data"]["memory_limit"] = 400000
+    preprocessor = TrainingProcessor(config, "", str(tmpdir))
+    _, batch_chars = preprocessor._get_batch_limits()
+    assert batch_chars == (10000 if num_cpus == 1 else 2500)
+    _, _, num_samples, _, _ = preprocessor.generate_preprocessed_data()
+    assert num_samples == 800
+    del os.environ["NB_CPU"]
+
+
+@pytest.mark.parametrize("batch_size", [7, 10000])
+def test_sampler_file_reader_loader(tmpdir, batch_size):
+    corpus_dir = tmpdir.join("corpus")
+    corpus_dir.mkdir()
+    generate_pseudo_corpus(corpus_dir, 100, "small", "en")
+    generate_pseudo_corpus(corpus_dir, 100, "small", "de")
+    generate_pseudo_corpus(corpus_dir, 1000, "large", "en")
+    generate_pseudo_corpus(corpus_dir, 1000, "large", "de")
+    config = {
+        "source": "en",
+        "target": "de",
+        "data": {
+            "sample": 600,
+            "sample_dist": [
+                {"path": str(corpus_dir), "distribution": [["small", 3], ["large", 1]]}
+            ],
+        },
+    }
+    all_files, _ = sampler.sample(config, str(corpus_dir), False)
+
+    def _get_sources(tu_batches):
+        return [unit.src_detok for tu_list, _ in tu_batches for unit in tu_list]
+
+    for f in all_files:
+        expected = _get_sources(SamplerFileLoader(f, batch_size)())
+        readers = list(SamplerFileReaderLoader(f, batch_size)())
+        assert all(isinstance(reader, SampledLinesReader) for reader, _ in readers)
+        assert _get_sources((reader.read(), meta) for reader, meta in readers) == (
+            expected
+        )
+        assert len(expected) == f.lines_kept
+
+        # A batch is cut as soon as it reaches batch_size, even when the samples
+        # of its last line jump past it.
+        max_count = max(f.random_sample.values())
+        batch_sizes = [len(reader.read()) for reader, _ in readers]
+        assert sum(batch_sizes) == f.lines_kept
+        for size in batch_sizes[:-1]:
+            assert batch_size <= size < batch_size + max_count
+        assert 0 < batch_sizes[-1] < batch_size + max_count
+
+    # The small corpus is oversampled.
+    small_file = next(f for f in all_files if f.base_name == "small")
+    assert max(small_file.random_sample.values()) > 1
+
+
+@pytest.mark.parametrize("num_cpus", [1, 2])
+def test_preprocess_read_in_workers(tmpdir, num_cpus):
+    os.environ["NB_CPU"] = str(num_cpus)
+    config = deepcopy(config_base)
+    config["data"]["read_in_workers"] = True
+    config["data"]["batch_size"] = 100
+    preprocessor = TrainingProcessor(config, "", str(tmpdir))
+    _, _, num_samples, _, _ = preprocessor.generate_preprocessed_data()
+    assert num_samples == 800
+    del os.environ["NB_CPU"]
+
+
+def _make_preprocess_outputs():
+    return [
+        PreprocessOutput(
+            [["Hello", "world", "!"]],
+            [["Bonjour", "le", "monde", "!"]],
+            None,
+            [{(0, 0), (1, 2), (2, 3)}],
+        ),
+        PreprocessOutput([[], ["a", "b"]], [["c"], []], {"id": 1}, None),
+        PreprocessOutput([["é", "ü"]], [["ß"]], None, [[(1, 0), (0, 0)]]),
+    ]
+
+
+def test_packed_outputs():
+    outputs = _make_preprocess_outputs()
+    packed = PackedOutputs.pack(outputs)
+    assert len(packed) == 3
+    assert packed.get_data("src") == "Hello world !\n\na b\né ü\n".encode("utf-8")
+    assert list(packed.iter_tokens("src")) == [
+        part for output in outputs for part in output.src
+    ]
+    assert list(packed.iter_tokens("tgt")) == [
+        part for output in outputs for part in output.tgt
+    ]
+    assert list(packed.get_all_tokens("tgt")) == [
+        "Bonjour",
+        "le",
+        "monde",
+        "!",
+        "c",
+        "ß",
+    ]
+    assert list(packed.iter_alignment_lines()) == ["0-0 1-2 2-3", "0-0 1-0"]
+    assert packed.metadata == [None, {"id": 1}, None]
+
+    assert PackedOutputs.pack([PreprocessOutput("a b", None, None, None)]) is None
+    assert PackedOutputs.pack([PreprocessOutput([["a b"]], None, None, None)]) is None
+    assert PackedOutputs.pack([PreprocessOutput([["a\n"]], None, None, None)]) is None
+    assert PackedOutputs.pack([PreprocessOutput([[""]], None, None, None)]) is None
+    packed = PackedOutputs.pack([PreprocessOutput([["a"]], None, None, None)])
+    assert packed.tgt is None
+    assert list(packed.get_all_tokens("tgt")) == []
+
+
+def test_sampler_file_writer_packed_outputs(tmpdir):
+    config = {"source": "en", "target": "de"}
+    meta = {"base_name": "corpus", "write_alignment": True, "example_weights": 0.5}
+    outputs = _make_preprocess_outputs()
+
+    def _write(outputs, result_dir):
+        result_dir.mkdir()
+        writer = SamplerFileWriter(config, str(result_dir), None, {"corpus": {}})
+        # Write 2 batches to check that the files are appended.
+        writer((outputs, meta))
+        writer((outputs, meta))
+        contents = {}
+        for path in result_dir.listdir():
+            with open(str(path), "rb") as f:
+                contents[path.basename] = f.read()
+        return contents
+
+    expected = _write(outputs, tmpdir.join("list"))
+    assert sorted(expected) == [
+        "corpus.align",
+        "corpus.de",
+        "corpus.en",
+        "corpus.weights",
+    ]
+    assert _write(PackedOutputs.pack(outputs), tmpdir.join("packed")) == expected
+
+
+def test_preprocess_write_in_workers(tmpdir):
+    corpus_dir = tmpdir.join("corpus")
+    corpus_dir.mkdir()
+    generate_pseudo_corpus(corpus_dir, 100, "small", "en")
+    generate_pseudo_corpus(corpus_dir, 100, "small", "de")
+    generate_pseudo_corpus(corpus_dir, 250, "large", "en")
+    generate_pseudo_corpus(corpus_dir, 250, "large", "de")
+    config = {
+        "source": "en",
+        "target": "de",
+        "data": {
+            "sample": 350,
+            "sample_dist": [
+                {"path": str(corpus_dir), "distribution": [["small", 2], ["large", 5]]}
+            ],
+            "batch_size": 30,
+            "ordered_output": True,
+        },
+        "preprocess": [
+            {
+                "op": "tokenization",
+                "source": {"mode": "aggressive", "joiner_annotate": True},
+                "target": {"mode": "aggressive", "joiner_annotate": True},
+            },
+        ],
+    }
+
+    def _generate(num_cpus, data_dir, write_in_workers=False):
+        os.environ["NB_CPU"] = str(num_cpus)
+        config["data"]["write_in_workers"] = write_in_workers
+        data_dir.mkdir()
+        preprocessor = TrainingProcessor(config, "", str(data_dir))
+        (
+            data_path,
+            _,
+            num_samples,
+            summary,
+            _,
+        ) = preprocessor.generate_preprocessed_data()
+        del os.environ["NB_CPU"]
+        assert num_samples == 350
+        assert summary["small"]["linefiltered"] == 100
+        contents = {}
+        for filename in os.listdir(data_path):
+            with open(os.path.join(data_path, filename)) as f:
+                contents[filename] = f.read()
+        return contents
+
+    expected = _generate(1, tmpdir.join("sequential"))
+    assert sorted(expected) == ["large.de", "large.en", "small.de", "small.en"]
+    assert expected["small.en"].startswith("small 0\nsmall 1\n")
+    assert _generate(2, tmpdir.join("sharded"), write_in_workers=True) == expected
+
+
 def test_preprocess_empty_line(tmpdir):
     processor = InferenceProcessor(config_base)
     source, _, _ = processor.process_input("")
@@ -869,6 +1090,124 @@ def test_preprocess_empty_line(tmpdir):
         assert output_file.readlines() == ["\n"]
 
 
+@pytest.mark.parametrize("pool_size", [0, 2])
+def test_inference_process_inputs(pool_size):
+    config = {
+        "source": "en",
+        "target": "de",
+        "preprocess": [
+            {
+                "op": "tokenization",
+                "source": {"mode": "aggressive", "joiner_annotate": True},
+                "target": {"mode": "aggressive", "joiner_annotate": True},
+            },
+        ],
+    }
+
+    inputs = [
+        {"source": "Hello world!"},
+        {"source": "This is a test.", "target": "Das ist"},
+        {"source": "Goodbye."},
+    ]
+    preprocessor = InferenceProcessor(config, pool_size=pool_size, pool_min_inputs=2)
+    postprocessor = InferenceProcessor(
+        config, postprocess=True, pool_size=pool_size, pool_min_inputs=2
+    )
+    try:
+        results = preprocessor.process_inputs(inputs)
+        assert results == [preprocessor.process_input(**x) for x in inputs]
+        assert results[1][1] == [["Das", "ist"]]
+
+        post_inputs = [{"source": source, "target": source} for source, _, _ in results]
+        assert postprocessor.process_inputs(post_inputs) == [
+            "Hello world!",
+            "This is a test.",
+            "Goodbye.",
+        ]
+    finally:
+        preprocessor.close()
+        postprocessor.close()
+
+
+def test_inference_process_inputs_close():
+    config = {
+        "source": "en",
+        "target": "de",
+        "preprocess": [
+            {
+                "op": "tokenization",
+                "source": {"mode": "aggressive"},
+                "target": {"mode": "aggressive"},
+            },
+        ],
+    }
+    inputs = [{"source": "Hello world %d!" % i} for i in range(1000)]
+    preprocessor = InferenceProcessor(config, pool_size=2, pool_min_inputs=2)
+    expected = [preprocessor.process_input(**x) for x in inputs]
+
+    # The processor is closed while the worker processes are used.
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(preprocessor.process_inputs(inputs))
+    )
+    thread.start()
+    deadline = time.time() + 10
+    while preprocessor._pool is None and thread.is_alive():
+        assert time.time() < deadline
+        time.sleep(0.01)
+    preprocessor.close()
+    thread.join()
+    assert results == [expected]
+
+    # The inputs are processed in the current process once closed.
+    assert preprocessor.process_inputs(inputs) == expected
+    assert preprocessor._pool is None
+
+
+def test_inference_pipeline_cache():
+    tok_config = {"mode": "aggressive", "joiner_annotate": True}
+    config = config_util.old_to_new_config(
+        {
+            "source": "en",
+            "target": "de",
+            "tokenization": {"source": tok_config, "target": tok_config},
+        }
+    )
+
+    def _override(mode):
+        return {
+            "preprocess": [
+                {"op": "tokenization", "source": {"mode": mode}, "target": tok_config}
+            ]
+        }
+
+    processor = InferenceProcessor(config, pipeline_cache_size=1)
+    source, _, _ = processor.process_input("Hello world!", config=_override("space"))
+    assert source == [["Hello", "world!"]]
+    processor.process_input("Hello world!", config=_override("space"))
+    assert processor.pipeline_cache_stats() == {
+        "entries": 1,
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+    }
+
+    source, _, _ = processor.process_input("Hello world!", config=_override("char"))
+    assert source[0][0] == "H"
+    processor.process_input("Hello world!", config=_override("space"))
+    assert processor.pipeline_cache_stats() == {
+        "entries": 1,
+        "hits": 1,
+        "misses": 3,
+        "evictions": 2,
+    }
+
+    # Inputs without override do not use the cache.
+    source, _, _ = processor.process_input("Hello world!")
+    assert source == [["Hello", "world", "￭!"]]
+    assert processor.pipeline_cache_stats()["hits"] == 1
+
+
 def test_postprocess_multipart_file_loader(tmpdir):
     src_num_lines = 8
     src_input_path = generate_pseudo_corpus(tmpdir, src_num_lines, "input", "en")
@@ -1211,6 +1550,46 @@ def test_shared_state_with_overrides(num_workers):
     processor.process(loader, consumer)
 
 
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_process_ordered_output(num_workers):
+    class CustomLoader(Loader):
+        def __call__(self):
+            for i in range(8):
+                yield [TranslationUnit(str(i))], {}
+
+    class CustomConsumer(Consumer):
+        def __init__(self):
+            super().__init__()
+            self.sources = []
+
+        def _consume(self, outputs):
+            self.sources.extend(output.src for output in outputs[0])
+
+    op_name = "slow_first_batches_%d" % num_workers
+
+    @prepoperator.register_operator(op_name)
+    class SlowFirstBatches(prepoperator.TUOperator):
+        def _preprocess_tu(self, tu, *args):
+            # The first batches are slower so that they complete last.
+            time.sleep(0.05 * (8 - int(tu.src_detok)))
+            return [tu]
+
+    config = {
+        "source": "en",
+        "target": "fr",
+        "data": {"ordered_output": True, "reorder_buffer_size": 3},
+        "preprocess": [{"op": op_name}],
+    }
+
+    processor = Processor(
+        config, prepoperator.ProcessType(utils.Task.TRAINING), num_workers=num_workers
+    )
+    consumer = CustomConsumer()
+    processor.process(CustomLoader(batch_size=1), consumer)
+    assert consumer.sources == [str(i) for i in range(8)]
+    assert consumer.num_samples == 8
+
+
 def test_preprocess_inference_config_with_options():
     @prepoperator.register_operator("politeness")
     class DummyPoliteness(prepoperator.TUOperator):
@@ -0,0 +1,49 @@
+import gzip
+import zlib
+
+import pytest
+
+from nmtwizard import serialization
+
+
+@pytest.mark.parametrize("name", ["json", "orjson"])
+def test_serializer(name):
+    pytest.importorskip(name)
+    serializer = serialization.get_serializer(name)
+    assert serializer.name == name
+    data = {"tgt": [[{"text": "Phrase cible ü", "score": -2.5, "align": [0, 1]}]]}
+    encoded = serializer.dumps(data)
+    assert isinstance(encoded, bytes)
+    assert serializer.loads(encoded) == data
+
+
+def test_get_serializer():
+    assert serialization.get_serializer("auto").name in ("json", "orjson")
+    with pytest.raises(ValueError):
+        serialization.get_serializer("xml")
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,expected",
+    [
+        (None, False),
+        ("", False),
+        ("identity", False),
+        ("gzip", True),
+        ("deflate, gzip;q=1.0, *;q=0.5", True),
+        ("GZIP", True),
+        ("gzip;q=0", False),
+    ],
+)
+def test_accepts_gzip(accept_encoding, expected):
+    assert serialization.accepts_gzip(accept_encoding) == expected
+
+
+def test_gzip_compress_stream():
+    chunks = [b'{"index": 0}\n', b'{"index": 1}\n']
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    compressed = serialization.gzip_compress_stream(iter(chunks))
+    # Each chunk can be decompressed as soon as it is received.
+    for chunk in chunks:
+        assert decompressor.decompress(next(compressed)) == chunk
+    assert gzip.decompress(serialization.gzip_compress(b"abc")) == b"abc"
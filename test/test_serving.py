@@ -1,3 +1,7 @@
+import json
+import threading
+import time
+
 import pytest
 
 from nmtwizard import serving
@@ -7,12 +11,12 @@ def _make_output(tokens, score=None, attention=None):
     return serving.TranslationOutput(tokens, score=score, attention=attention)
 
 
-def _make_example(tokens, index=0, metadata=None, mode="default"):
+def _make_example(tokens, index=0, metadata=None, mode="default", config=None):
     if metadata is None:
         metadata = [None]
     return serving.TranslationExample(
         index=index,
-        config=None,
+        config=config,
         options=None,
         source_tokens=tokens,
         target_tokens=[None] * len(tokens),
@@ -54,6 +58,42 @@ def test_batch_iterator():
     ]
 
 
+def test_batch_iterator_sort_by_length():
+    examples = [
+        _make_example([["a"] * 5], index=0),
+        _make_example([["b"] * 1, ["c"] * 4], index=1),
+        _make_example([["d"] * 2], index=2),
+    ]
+
+    batches = list(
+        serving.batch_iterator(examples, max_batch_size=2, sort_by_length=True)
+    )
+    assert [batch.indices for batch in batches] == [[1, 2], [1, 0]]
+    assert [batch.parts for batch in batches] == [[0, 0], [1, 0]]
+    assert [list(map(len, batch.source_tokens)) for batch in batches] == [
+        [1, 2],
+        [4, 5],
+    ]
+
+
+def test_batch_iterator_max_batch_tokens():
+    examples = [
+        _make_example([["a"] * 2], index=0),
+        _make_example([["b"] * 3], index=1),
+        _make_example([["c"] * 8], index=2),
+        _make_example([["d"] * 1], index=3),
+    ]
+
+    batches = list(serving.batch_iterator(examples, max_batch_tokens=6))
+    assert [batch.indices for batch in batches] == [[0, 1], [2], [3]]
+    assert all(batch.parts is None for batch in batches)
+
+    batches = list(
+        serving.batch_iterator(examples, max_batch_tokens=6, sort_by_length=True)
+    )
+    assert [batch.indices for batch in batches] == [[3, 0], [1], [2]]
+
+
 def test_preprocess_example():
     class Processor:
         def process_input(self, source, **kwargs):
@@ -257,6 +297,30 @@ def test_preprocess_examples():
     assert examples[1].metadata == [3, 1]
 
 
+def test_preprocess_examples_batched():
+    class Processor:
+        def __init__(self):
+            self.calls = []
+
+        def process_inputs(self, inputs, config=None, options=None):
+            self.calls.append((len(inputs), config))
+            return [(x["source"].split(), None, None) for x in inputs]
+
+    raw_examples = [
+        {"text": "a b c"},
+        {"text": "d e", "config": {"a": 42}},
+        {"text": "f"},
+    ]
+    processor = Processor()
+    examples = serving.preprocess_examples(raw_examples, processor, config={})
+    assert processor.calls == [(2, None), (1, {"a": 42})]
+    assert [example.index for example in examples] == [0, 1, 2]
+    assert examples[0].source_tokens == [["a", "b", "c"]]
+    assert examples[1].source_tokens == [["d", "e"]]
+    assert examples[1].config == {"a": 42}
+    assert examples[2].source_tokens == [["f"]]
+
+
 def test_postprocess_output():
     output = _make_output([["a", "b", "c"]], score=[2], attention=[None])
     example = _make_example([["x", "y"]], metadata=[None])
@@ -273,6 +337,42 @@ def test_postprocess_output():
     assert result["score"] == 2
 
 
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_postprocess_output_with_alignment(monkeypatch, use_numpy):
+    if use_numpy:
+        np = pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(serving, "np", None)
+    attention = [[0.2, 0.8], [0.7, 0.3], [0.6, 0.4]]
+    if use_numpy:
+        attention = np.array(attention, dtype=np.float32)
+    output = _make_output([["1", "234", "56"]], score=[2], attention=[attention])
+    example = _make_example([["ab", "c"]])
+
+    class Processor:
+        def process_input(self, source, target=None, **kwargs):
+            return " ".join(target[0])
+
+    result = serving.postprocess_output(output, example, Processor())
+    assert result["text"] == "1 234 56"
+    assert result["align"] == [
+        {"src": [{"range": (3, 4), "id": 1}], "tgt": [{"range": (0, 1), "id": 0}]},
+        {"src": [{"range": (0, 2), "id": 0}], "tgt": [{"range": (2, 5), "id": 1}]},
+        {"src": [{"range": (0, 2), "id": 0}], "tgt": [{"range": (6, 8), "id": 2}]},
+    ]
+
+    result = serving.postprocess_outputs(
+        [[output]], [example], Processor(), align_format="flat", align_threshold=0.3
+    )
+    assert result[0][0]["align"] == [
+        *[0, 1, 0, 3, 4, 1],
+        *[2, 5, 1, 0, 2, 0],
+        *[2, 5, 1, 3, 4, 1],
+        *[6, 8, 2, 0, 2, 0],
+        *[6, 8, 2, 3, 4, 1],
+    ]
+
+
 def test_postprocess_output_with_metadata():
     output = _make_output([["a", "b", "c"]], score=[2], attention=[None])
     example = _make_example([["x", "y"]], metadata=[3])
@@ -335,6 +435,36 @@ def test_postprocess_outputs():
     assert results[1][1] == {"text": "e e", "score": 4}
 
 
+def test_postprocess_outputs_batched():
+    outputs = [
+        [
+            _make_output([["a", "b"]], score=[1], attention=[None]),
+            _make_output([["b", "a"]], score=[2], attention=[None]),
+        ],
+        [_make_output([["c"]], score=[3], attention=[None])],
+    ]
+    examples = [
+        _make_example([["x", "y"]]),
+        _make_example([["z"]], config={"a": 42}),
+    ]
+
+    class Processor:
+        def __init__(self):
+            self.calls = []
+
+        def process_inputs(self, inputs, config=None, options=None):
+            self.calls.append((len(inputs), config))
+            return [" ".join(x["target"][0]) for x in inputs]
+
+    processor = Processor()
+    results = serving.postprocess_outputs(outputs, examples, processor)
+    assert processor.calls == [(2, None), (1, {"a": 42})]
+    assert results == [
+        [{"text": "a b", "score": 1}, {"text": "b a", "score": 2}],
+        [{"text": "c", "score": 3}],
+    ]
+
+
 def test_postprocess_outputs_multiparts():
     # 2 parts and 2 hypothesis.
     outputs = [
@@ -366,7 +496,12 @@ def test_postprocess_outputs_multiparts():
     assert results[0][1] == {"text": "a c b e e", "score": 2 + 4}
 
 
-def test_align_tokens():
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_align_tokens(monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(serving, "np", None)
     assert serving.align_tokens([], [], []) == []
     assert serving.align_tokens(["a"], [], []) == []
 
@@ -388,6 +523,38 @@ def test_align_tokens():
         "tgt": [{"range": (6, 8), "id": 2}],
     }
 
+    alignments = serving.align_tokens(src_tokens, tgt_tokens, attention, flat=True)
+    assert alignments == [0, 1, 0, 3, 4, 1, 2, 5, 1, 0, 2, 0, 6, 8, 2, 0, 2, 0]
+
+    alignments = serving.align_tokens(
+        src_tokens, tgt_tokens, attention, flat=True, threshold=0.3
+    )
+    assert alignments == [
+        *[0, 1, 0, 3, 4, 1],
+        *[2, 5, 1, 0, 2, 0],
+        *[2, 5, 1, 3, 4, 1],
+        *[6, 8, 2, 0, 2, 0],
+        *[6, 8, 2, 3, 4, 1],
+    ]
+    alignments = serving.align_tokens(src_tokens, tgt_tokens, attention, threshold=0.3)
+    assert len(alignments) == 3
+    assert alignments[1] == {
+        "src": [{"range": (0, 2), "id": 0}, {"range": (3, 4), "id": 1}],
+        "tgt": [{"range": (2, 5), "id": 1}],
+    }
+
+
+def test_align_tokens_with_array():
+    np = pytest.importorskip("numpy")
+    # The attention over the end of sentence token is ignored.
+    attention = np.array([[0.2, 0.3, 0.5], [0.7, 0.2, 0.1]], dtype=np.float32)
+    alignments = serving.align_tokens(["ab", "c"], ["1", "234"], attention)
+    assert alignments == [
+        {"tgt": [{"range": (0, 1), "id": 0}], "src": [{"range": (3, 4), "id": 1}]},
+        {"tgt": [{"range": (2, 5), "id": 1}], "src": [{"range": (0, 2), "id": 0}]},
+    ]
+    assert all(isinstance(value, int) for value in alignments[0]["src"][0]["range"])
+
 
 def test_translate_examples():
     def func(source_tokens, target_tokens, options=None):
@@ -410,6 +577,557 @@ def test_translate_examples():
     assert outputs[1][0].attention == [None]
 
 
+def test_translate_examples_sort_by_length():
+    def func(source_tokens, target_tokens, options=None):
+        return [[_make_output(list(reversed(element)))] for element in source_tokens]
+
+    examples = [
+        _make_example([["a", "b", "c"], ["d"]], index=0, metadata=[3, 1]),
+        _make_example([["e", "f"]], index=1, metadata=[2]),
+    ]
+
+    outputs = serving.translate_examples(
+        examples, func, max_batch_size=1, sort_by_length=True
+    )
+    assert len(outputs) == 2
+    assert outputs[0][0].output == [["c", "b", "a"], ["d"]]
+    assert outputs[1][0].output == [["f", "e"]]
+
+
+def test_translate_examples_with_deadline():
+    translated = []
+
+    def func(source_tokens, target_tokens, options=None):
+        translated.extend(source_tokens)
+        return [[_make_output(tokens)] for tokens in source_tokens]
+
+    examples = [
+        _make_example([["a"]], index=0),
+        _make_example([["b"]], index=1),
+    ]
+
+    # The remaining batches are skipped once the request is cancelled.
+    deadline = serving.Deadline(is_cancelled=lambda: bool(translated))
+    with pytest.raises(serving.TranslationTimeout):
+        serving.translate_examples(examples, func, max_batch_size=1, deadline=deadline)
+    assert translated == [["a"]]
+
+    del translated[:]
+    deadline = serving.Deadline(timeout=0)
+    assert deadline.remaining() == 0
+    with pytest.raises(serving.TranslationTimeout):
+        serving.translate_examples(examples, func, deadline=deadline)
+    assert translated == []
+
+    deadline = serving.Deadline(timeout=60)
+    assert 0 < deadline.remaining() <= 60
+    outputs = serving.translate_examples(examples, func, deadline=deadline)
+    assert len(outputs) == 2
+
+
+def test_translation_cache():
+    cache = serving.TranslationCache(1000000)
+    key = cache.make_key("model", "default", ["a", "b"], None, {"timeout": 10})
+    assert key == cache.make_key("model", "default", ["a", "b"], None, {})
+    assert key != cache.make_key("model", "default", ["a", "b"], None, {"beam": 2})
+    assert key != cache.make_key("model2", "default", ["a", "b"], None, {})
+    assert cache.get(key) is None
+
+    cache.put(key, [_make_output(["b", "a"], score=1)])
+    hypotheses = cache.get(key)
+    assert len(hypotheses) == 1
+    assert hypotheses[0].output == ["b", "a"]
+    assert hypotheses[0].score == 1
+    hypotheses[0].output.append("c")
+    assert cache.get(key)[0].output == ["b", "a"]
+
+    stats = cache.stats()
+    assert stats["entries"] == 1
+    assert stats["bytes"] > 0
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+
+    cache.clear()
+    assert cache.get(key) is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_translation_cache_copies_outputs():
+    cache = serving.TranslationCache(1000000)
+    key = cache.make_key("model", "default", [["a"], ["b", "c"]], None)
+    hypotheses = [_make_output([["a"], ["c", "b"]], score=[1, 2], attention=[[1.0]])]
+    cache.put(key, hypotheses)
+
+    # The cached outputs are not shared with the caller of put.
+    hypotheses[0].output[1].append("x")
+    hypotheses[0].score[0] = 0
+    assert cache.get(key)[0].output == [["a"], ["c", "b"]]
+
+    # Nor with the caller of get.
+    hypothesis = cache.get(key)[0]
+    hypothesis.output[0].append("y")
+    hypothesis.output.append(["z"])
+    hypothesis.score[1] = 0
+    hypothesis.attention[0][0] = 0.0
+    hypothesis = cache.get(key)[0]
+    assert hypothesis.output == [["a"], ["c", "b"]]
+    assert hypothesis.score == [1, 2]
+    assert hypothesis.attention == [[1.0]]
+
+
+def test_translation_cache_eviction():
+    def _key(i):
+        return serving.TranslationCache.make_key(None, "default", [str(i)], None)
+
+    value = [_make_output(["x"])]
+    entry_size = serving._approximate_size(_key(0)) + serving._approximate_size(value)
+    cache = serving.TranslationCache(entry_size * 2)
+    cache.put(_key(0), value)
+    cache.put(_key(1), value)
+    cache.get(_key(0))
+    cache.put(_key(2), value)
+
+    # The least recently used entry is evicted.
+    assert cache.get(_key(1)) is None
+    assert cache.get(_key(0)) is not None
+    assert cache.get(_key(2)) is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_translation_cache_ttl():
+    cache = serving.TranslationCache(1000000, ttl=0)
+    key = cache.make_key(None, "default", ["a"], None)
+    cache.put(key, [_make_output(["a"])])
+    assert cache.get(key) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_translate_examples_with_cache():
+    translated = []
+
+    def func(source_tokens, target_tokens, options=None):
+        translated.extend(source_tokens)
+        return [[_make_output(list(reversed(element)))] for element in source_tokens]
+
+    cache = serving.TranslationCache(1000000)
+    examples = [_make_example([["a", "b"], ["c", "d"]], index=0, metadata=[3, 2])]
+    serving.translate_examples(examples, func, cache=cache)
+    assert translated == [["a", "b"], ["c", "d"]]
+
+    del translated[:]
+    examples = [
+        _make_example([["e"]], index=0),
+        _make_example([["e", "f"], ["c", "d"]], index=1, metadata=[3, 2]),
+    ]
+    outputs = serving.translate_examples(examples, func, cache=cache)
+    assert translated == [["e"], ["e", "f"]]
+    assert outputs[0][0].output == [["e"]]
+    assert outputs[1][0].output == [["f", "e"], ["d", "c"]]
+
+    del translated[:]
+    outputs = serving.translate_examples(examples[1:], func, cache=cache)
+    assert translated == []
+    assert outputs[0][0].output == [["f", "e"], ["d", "c"]]
+
+
+def _translate_concurrently(scheduler, inputs):
+    results = [None] * len(inputs)
+
+    def _translate(i, source_tokens, options):
+        results[i] = scheduler(source_tokens, [None] * len(source_tokens), options)
+
+    threads = [
+        threading.Thread(target=_translate, args=(i, source_tokens, options))
+        for i, (source_tokens, options) in enumerate(inputs)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_batch_scheduler():
+    batch_sizes = []
+
+    def func(source_tokens, target_tokens, options=None):
+        batch_sizes.append(len(source_tokens))
+        return [[_make_output(list(reversed(tokens)))] for tokens in source_tokens]
+
+    scheduler = serving.BatchScheduler(func, max_batch_size=4, max_delay=10)
+    inputs = [([["a", str(i)]], {"mode": "default"}) for i in range(4)]
+    results = _translate_concurrently(scheduler, inputs)
+    scheduler.stop()
+
+    # The batch is full so the scheduler does not wait for max_delay.
+    assert batch_sizes == [4]
+    for i, hypotheses in enumerate(results):
+        assert len(hypotheses) == 1
+        assert hypotheses[0][0].output == [str(i), "a"]
+
+
+def test_batch_scheduler_incompatible_options():
+    batch_options = []
+
+    def func(source_tokens, target_tokens, options=None):
+        batch_options.append(options["mode"])
+        return [[_make_output(tokens)] for tokens in source_tokens]
+
+    scheduler = serving.BatchScheduler(func, max_delay=0.05)
+    inputs = [
+        ([["a"], ["b"]], {"mode": "default"}),
+        ([["c"]], {"mode": "alternatives"}),
+    ]
+    results = _translate_concurrently(scheduler, inputs)
+    scheduler.stop()
+
+    assert sorted(batch_options) == ["alternatives", "default"]
+    assert [hypotheses[0].output for hypotheses in results[0]] == [["a"], ["b"]]
+    assert [hypotheses[0].output for hypotheses in results[1]] == [["c"]]
+
+
+def test_batch_scheduler_error():
+    def func(source_tokens, target_tokens, options=None):
+        raise RuntimeError("backend error")
+
+    scheduler = serving.BatchScheduler(func, max_delay=0)
+    with pytest.raises(RuntimeError, match="backend error"):
+        scheduler([["a"]], [None], {})
+    scheduler.stop()
+
+
+def test_batch_scheduler_num_workers():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def func(source_tokens, target_tokens, options=None):
+        # Both batches must be translated concurrently to pass the barrier.
+        barrier.wait()
+        return [[_make_output(tokens)] for tokens in source_tokens]
+
+    scheduler = serving.BatchScheduler(
+        func, max_batch_size=1, max_delay=0, num_workers=2
+    )
+    inputs = [([["a"]], {"mode": "default"}), ([["b"]], {"mode": "default"})]
+    results = _translate_concurrently(scheduler, inputs)
+    scheduler.stop()
+    assert [hypotheses[0][0].output for hypotheses in results] == [["a"], ["b"]]
+
+
+def test_batch_size_tuner():
+    tuner = serving.BatchSizeTuner(
+        1.0, min_batch_size=2, max_batch_size=64, initial_batch_size=16, cooldown=2
+    )
+    assert tuner.batch_size == 16
+    # Fast batches increase the batch size.
+    assert tuner.observe(16, 160, 0.5) == 18
+    # The latency is extrapolated from smaller batches.
+    assert tuner.observe(4, 40, 0.2) == 18
+    # Slow batches reduce the batch size proportionally, at most by half.
+    assert tuner.observe(18, 180, 1.5) == 12
+    assert tuner.observe(12, 120, 10) == 6
+    # Errors halve the batch size and pause the increases.
+    assert tuner.observe_error() == 3
+    assert tuner.observe(3, 30, 0.1) == 3
+    assert tuner.observe(3, 30, 0.1) == 3
+    assert tuner.observe(3, 30, 0.1) == 4
+    assert tuner.observe_error() == 2
+    assert tuner.observe_error() == 2
+
+    stats = tuner.stats()
+    assert stats["batch_size"] == 2
+    assert stats["target_latency"] == 1.0
+    assert stats["increases"] == 2
+    assert stats["decreases"] == 4
+    assert stats["errors"] == 3
+
+
+def test_load_monitor():
+    monitor = serving.LoadMonitor(window=10)
+    stats = monitor.stats()
+    assert stats["pending_batches"] == 0
+    assert stats["estimated_wait"] == 0
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def _translate(source_tokens, target_tokens, options):
+        num_tokens = sum(len(tokens) for tokens in source_tokens)
+        with monitor.track_batch(num_tokens):
+            started.set()
+            release.wait()
+        return source_tokens
+
+    translate_fn = monitor.wrap(_translate)
+    thread = threading.Thread(
+        target=translate_fn, args=([["a", "b"], ["c"]], [None, None], {})
+    )
+    thread.start()
+    started.wait()
+    stats = monitor.stats()
+    assert stats["pending_batches"] == 1
+    assert stats["batches_in_flight"] == 1
+    assert stats["queued_tokens"] == 0
+    # The throughput is unknown before the first batch completes.
+    assert stats["estimated_wait"] is None
+    release.set()
+    thread.join()
+
+    stats = monitor.stats()
+    assert stats["pending_batches"] == 0
+    assert stats["batches_in_flight"] == 0
+    assert stats["tokens_per_second"] > 0
+    assert stats["estimated_wait"] == 0
+
+
+class _FakeProcess:
+    def __init__(self):
+        self.running = True
+
+    def poll(self):
+        return None if self.running else 0
+
+    def terminate(self):
+        self.running = False
+
+
+def test_backend_pool():
+    processes = []
+    closed = []
+
+    def backend_service_fn():
+        process = _FakeProcess()
+        processes.append(process)
+        index = len(processes)
+        return process, {"id": index, "close": lambda: closed.append(index)}
+
+    pool = serving.BackendPool(
+        backend_service_fn, num_replicas=2, health_check_interval=None
+    )
+    assert not pool.is_reachable()
+    pool.load()
+    assert pool.is_reachable()
+
+    # Batches are dispatched to the replica with the least outstanding tokens.
+    with pool.dispatch([["a", "b", "c"]]) as info_1:
+        with pool.dispatch([["a"]]) as info_2:
+            with pool.dispatch([["a"]]) as info_3:
+                assert info_1 != info_2
+                assert info_3 == info_2
+    assert [stats["outstanding_tokens"] for stats in pool.stats()] == [0, 0]
+
+    # Stopped replicas are not selected and are restarted by the health check.
+    processes[0].running = False
+    for _ in range(2):
+        with pool.dispatch([["a"]]) as info:
+            assert info["id"] == 2
+    pool.check_health()
+    assert len(processes) == 3
+    assert [stats["restarts"] for stats in pool.stats()] == [1, 0]
+    assert [(index, info["id"]) for index, info in pool.replicas_info()] == [
+        (0, 3),
+        (1, 2),
+    ]
+    # The client of the restarted replica is closed.
+    assert closed == [1]
+
+    pool.stop()
+    assert not pool.is_reachable()
+    assert all(not process.running for process in processes)
+    assert sorted(closed) == [1, 2, 3]
+    with pytest.raises(serving.BackendUnavailable):
+        with pool.dispatch([["a"]]):
+            pass
+
+
+def test_fair_queue():
+    blocked = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def func(source_tokens, target_tokens, options=None):
+        if source_tokens == [["block"]]:
+            blocked.set()
+            release.wait(5)
+        order.append(source_tokens[0][0])
+        return [[_make_output(tokens)] for tokens in source_tokens]
+
+    queue = serving.FairQueue({"interactive": 4, "bulk": 1}, num_workers=1)
+    with pytest.raises(serving.InvalidRequest):
+        queue.wrap(func, "unknown")
+
+    def _run(priority, tokens):
+        queue.wrap(func, priority)([tokens], [None], {})
+
+    def _wait_for(num_waiting):
+        for _ in range(500):
+            if sum(queue.num_waiting().values()) == num_waiting:
+                return
+            time.sleep(0.01)
+        raise RuntimeError("timeout")
+
+    threads = [threading.Thread(target=_run, args=("bulk", ["block"]))]
+    threads[0].start()
+    assert blocked.wait(5)
+    # A bulk unit is waiting before an interactive unit of the same size.
+    threads.append(threading.Thread(target=_run, args=("bulk", ["b"] * 8)))
+    threads[-1].start()
+    _wait_for(1)
+    threads.append(threading.Thread(target=_run, args=("interactive", ["i"] * 8)))
+    threads[-1].start()
+    _wait_for(2)
+    assert queue.num_waiting() == {"interactive": 1, "bulk": 1}
+
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert order == ["block", "i", "b"]
+
+
+def test_fair_queue_with_batch_scheduler():
+    blocked = threading.Event()
+    release = threading.Event()
+    batches = []
+
+    def func(source_tokens, target_tokens, options=None):
+        if source_tokens[0] == ["block"]:
+            blocked.set()
+            release.wait(5)
+        batches.append([tokens[0] for tokens in source_tokens])
+        return [[_make_output(tokens)] for tokens in source_tokens]
+
+    scheduler = serving.BatchScheduler(func, max_batch_size=8, max_delay=0)
+    queue = serving.FairQueue({"interactive": 4, "bulk": 1})
+
+    def _run(priority, source_tokens):
+        translate_fn = queue.wrap(scheduler, priority)
+        translate_fn(source_tokens, [None] * len(source_tokens), {})
+
+    def _wait_for(num_waiting):
+        for _ in range(500):
+            if sum(queue.num_waiting().values()) == num_waiting:
+                return
+            time.sleep(0.01)
+        raise RuntimeError("timeout")
+
+    try:
+        threads = [threading.Thread(target=_run, args=("bulk", [["block"]]))]
+        threads[0].start()
+        assert blocked.wait(5)
+        # Full batches are processed in fair order.
+        threads.append(threading.Thread(target=_run, args=("bulk", [["b"]] * 8)))
+        threads[-1].start()
+        _wait_for(1)
+        threads.append(threading.Thread(target=_run, args=("interactive", [["i"]] * 8)))
+        threads[-1].start()
+        _wait_for(2)
+        # Small units from different requests are merged in a single batch.
+        for _ in range(4):
+            threads.append(threading.Thread(target=_run, args=("bulk", [["s"]])))
+            threads[-1].start()
+        _wait_for(6)
+
+        release.set()
+        for thread in threads:
+            thread.join()
+        # The small units have the smallest finish tags.
+        assert batches == [["block"], ["s"] * 4, ["i"] * 8, ["b"] * 8]
+        assert sum(queue.num_waiting().values()) == 0
+    finally:
+        release.set()
+        scheduler.stop()
+
+
+def test_warmup():
+    requests = []
+
+    def run_fn(request):
+        requests.append(request)
+
+    timings = serving.warmup(run_fn, lengths=[16, 1, 4], batch_size=2)
+    assert [timing["length"] for timing in timings] == [1, 4, 16]
+    assert all(timing["batch_size"] == 2 for timing in timings)
+    assert all(timing["seconds"] >= 0 for timing in timings)
+    assert [len(request["src"]) for request in requests] == [2, 2, 2]
+    assert [len(request["src"][0]["text"].split()) for request in requests] == [
+        1,
+        4,
+        16,
+    ]
+
+
+class _FakeDeployment:
+    def __init__(self, name):
+        self.name = name
+        self.in_flight = 0
+        self.stopped = threading.Event()
+
+    def acquire(self):
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+
+    def drain(self, timeout=None):
+        return True
+
+    def stop(self, close_processors=False):
+        self.stopped.set()
+
+
+def test_model_manager():
+    sizes = {"a": 40, "b": 50, "c": 30}
+    loaded = []
+
+    def load_fn(name):
+        if name not in sizes:
+            raise serving.InvalidRequest("unknown model %s" % name)
+        deployment = _FakeDeployment(name)
+        loaded.append(deployment)
+        return deployment, sizes[name]
+
+    manager = serving.ModelManager(load_fn, memory_budget=100)
+    with pytest.raises(serving.InvalidRequest):
+        manager.acquire("d")
+
+    model_a = manager.acquire("a")
+    model_b = manager.acquire("b")
+    assert model_a.name == "a"
+    assert manager.acquire("a") is model_a
+    assert model_a.in_flight == 2
+    assert [deployment.name for deployment in loaded] == ["a", "b"]
+
+    # Loading c exceeds the budget: b is the least recently used model.
+    manager.acquire("c")
+    assert model_b.stopped.wait(5)
+    assert not model_a.stopped.is_set()
+    stats = manager.stats()
+    assert [model["name"] for model in stats["models"]] == ["a", "c"]
+    assert stats["size"] == 70
+    assert stats["loads"] == 3
+    assert stats["hits"] == 1
+    assert stats["evictions"] == 1
+
+    # A reloaded model replaces the current deployment once it is checked.
+    manager.reload("c")
+    model_c = loaded[2]
+    assert model_c.stopped.is_set()
+    assert manager.acquire("c") is loaded[3]
+
+    def check_fn(deployment):
+        raise RuntimeError("warm-up error")
+
+    with pytest.raises(RuntimeError, match="warm-up error"):
+        manager.reload("c", check_fn=check_fn)
+    assert loaded[4].stopped.is_set()
+    assert manager.acquire("c") is loaded[3]
+
+    assert manager.unload("a")
+    assert model_a.stopped.is_set()
+    assert not manager.unload("a")
+    manager.stop()
+    assert all(deployment.stopped.is_set() for deployment in loaded)
+
+
 def test_run_request():
     with pytest.raises(serving.InvalidRequest):
         serving.run_request(["abc"], None)
@@ -467,6 +1185,41 @@ def test_run_request():
     assert result == {"tgt": [[{"text": "1 2 c b a"}], [{"text": "z_y_x"}]]}
 
 
+def test_stream_request():
+    def translate(source_tokens, target_tokens, options=None):
+        return [[_make_output(list(reversed(source)))] for source in source_tokens]
+
+    class Preprocessor:
+        def process_input(self, source, **kwargs):
+            return source.split(), None, None
+
+    class Postprocessor:
+        def process_input(self, source, target=None, **kwargs):
+            return " ".join(target[0])
+
+    request = {"src": [{"text": "a b c"}, {"text": "d"}, {"text": "e f"}]}
+    results = serving.stream_request(
+        request,
+        translate,
+        Preprocessor(),
+        Postprocessor(),
+        max_batch_size=1,
+        sort_by_length=True,
+    )
+
+    # The examples are returned in completion order.
+    assert list(results) == [
+        {"index": 1, "tgt": [{"text": "d"}]},
+        {"index": 2, "tgt": [{"text": "f e"}]},
+        {"index": 0, "tgt": [{"text": "c b a"}]},
+    ]
+
+    # The request is validated before iterating on the results.
+    with pytest.raises(serving.InvalidRequest):
+        serving.stream_request({"src": [{"txt": "a"}]}, translate, Preprocessor())
+    assert list(serving.stream_request({"src": []}, translate)) == []
+
+
 def test_run_request_with_v2_config():
     class Preprocessor:
         def process_input(self, source, target=None, config=None, **kwargs):
@@ -513,3 +1266,500 @@ def test_run_request_with_v2_config():
     )
 
     assert result == {"tgt": [[{"text": "c b a"}]]}
+
+
+class _ServingBackends:
+    """Fake backends whose translation prefixes the tokens with the backend index."""
+
+    def __init__(self):
+        self.processes = []
+        self.start_error = None
+        self.failing = set()
+        self.blocked = {}
+        self.waiting = threading.Event()
+        # Number of the next calls that cannot reach the backend.
+        self.unreachable = 0
+
+    def service_fn(self):
+        if self.start_error is not None:
+            raise self.start_error
+        process = _FakeProcess()
+        self.processes.append(process)
+        return process, {"index": len(self.processes) - 1}
+
+    def translate_fn(self, info, source_tokens, target_tokens, options):
+        index = info["index"]
+        if self.unreachable > 0:
+            self.unreachable -= 1
+            raise serving.BackendUnavailable("connection refused")
+        if index in self.failing:
+            raise RuntimeError("translation error")
+        # Requests with a blocked token wait until the event is set.
+        for tokens in source_tokens:
+            event = self.blocked.get(tokens[0] if tokens else None)
+            if event is not None:
+                self.waiting.set()
+                event.wait()
+        return [[_make_output([str(index)] + tokens)] for tokens in source_tokens]
+
+
+class _SplitPreprocessor:
+    def process_input(self, source, **kwargs):
+        return source.split(), None, None
+
+
+class _JoinPostprocessor:
+    def process_input(self, source, target=None, **kwargs):
+        return " ".join(target[0])
+
+
+def _make_serving_handler(backends, serving_config=None, **kwargs):
+    serving_config = dict(serving_config or {})
+    serving_config.setdefault("health_check_interval", None)
+    return serving.make_serving_handler(
+        {"serving": serving_config},
+        backends.service_fn,
+        backends.translate_fn,
+        preprocessor=_SplitPreprocessor(),
+        postprocessor=_JoinPostprocessor(),
+        **kwargs
+    )
+
+
+def _send_request(handler, method, path, data=None):
+    body = json.dumps(data).encode("utf-8") if data is not None else b""
+    status, headers, body = handler.handle_request(method, path, {}, body)
+    return status, headers, json.loads(body.decode("utf-8"))
+
+
+def _translate_text(handler, text):
+    status, _, result = _send_request(
+        handler, "POST", "/translate", {"src": [{"text": text}]}
+    )
+    assert status == 200
+    return result["tgt"][0][0]["text"]
+
+
+def test_serving_handler_replicas_stopped():
+    backends = _ServingBackends()
+
+    class _StoppingPreprocessor(_SplitPreprocessor):
+        def process_input(self, source, **kwargs):
+            # The replicas stop after the reachability check of the request.
+            for process in backends.processes:
+                process.running = False
+            return super().process_input(source, **kwargs)
+
+    handler = serving.make_serving_handler(
+        {"serving": {"num_replicas": 2, "health_check_interval": None}},
+        backends.service_fn,
+        backends.translate_fn,
+        preprocessor=_StoppingPreprocessor(),
+        postprocessor=_JoinPostprocessor(),
+    )
+    try:
+        status, _, result = _send_request(
+            handler, "POST", "/translate", {"src": [{"text": "a"}]}
+        )
+        assert status == 503
+        assert result["message"] == "backend service is unavailable"
+    finally:
+        handler.stop()
+
+
+def test_serving_handler_reload_additional_model():
+    backends = _ServingBackends()
+    backends.blocked["slow"] = threading.Event()
+
+    def models_fn(name):
+        if name != "m":
+            raise serving.InvalidRequest("unknown model %s" % name)
+        return backends.service_fn, _SplitPreprocessor(), _JoinPostprocessor(), 1
+
+    def translate_model(text):
+        status, _, result = _send_request(
+            handler,
+            "POST",
+            "/translate",
+            {"src": [{"text": text}], "options": {"model": "m"}},
+        )
+        assert status == 200
+        return result["tgt"][0][0]["text"]
+
+    handler = _make_serving_handler(backends, models_fn=models_fn)
+    try:
+        assert translate_model("a") == "1 a"
+
+        # A request is in progress on the model when it is reloaded.
+        slow_result = []
+        slow_thread = threading.Thread(
+            target=lambda: slow_result.append(translate_model("slow"))
+        )
+        slow_thread.start()
+        assert backends.waiting.wait(5)
+        reload_result = []
+        reload_thread = threading.Thread(
+            target=lambda: reload_result.append(
+                _send_request(handler, "POST", "/reload_model", {"model": "m"})[0]
+            )
+        )
+        reload_thread.start()
+
+        # The model keeps serving requests during the reload, then switches to
+        # the new backend while the previous one is drained.
+        deadline = time.time() + 5
+        result = translate_model("a")
+        while result != "2 a":
+            assert result == "1 a"
+            assert time.time() < deadline
+            time.sleep(0.01)
+            result = translate_model("a")
+        assert backends.processes[1].running
+        assert not reload_result
+
+        backends.blocked["slow"].set()
+        slow_thread.join()
+        reload_thread.join()
+        assert slow_result == ["1 slow"]
+        assert reload_result == [200]
+        assert not backends.processes[1].running
+
+        # A failed reload keeps the current backend.
+        backends.failing.add(3)
+        status, _, result = _send_request(
+            handler, "POST", "/reload_model", {"model": "m"}
+        )
+        assert status == 500
+        assert not backends.processes[3].running
+        assert translate_model("a") == "2 a"
+    finally:
+        handler.stop()
+
+
+def test_serving_handler_reload_model():
+    backends = _ServingBackends()
+    handler = _make_serving_handler(backends)
+    try:
+        assert _translate_text(handler, "a b") == "0 a b"
+        status, _, result = _send_request(handler, "POST", "/reload_model")
+        assert status == 200
+        assert result == {"status": "ready"}
+        # New requests are translated by the new backend and the previous one is
+        # terminated.
+        assert _translate_text(handler, "a b") == "1 a b"
+        assert [process.running for process in backends.processes] == [False, True]
+    finally:
+        handler.stop()
+    assert not backends.processes[1].running
+
+
+def test_serving_handler_reload_model_drain():
+    backends = _ServingBackends()
+    backends.blocked["slow"] = threading.Event()
+    handler = _make_serving_handler(backends)
+    try:
+        results = []
+        in_flight = threading.Thread(
+            target=lambda: results.append(_translate_text(handler, "slow"))
+        )
+        in_flight.start()
+        assert backends.waiting.wait(5)
+        reload_thread = threading.Thread(
+            target=lambda: _send_request(handler, "POST", "/reload_model")
+        )
+        reload_thread.start()
+
+        # New requests are switched to the new backend while the previous one
+        # completes the request in progress.
+        for _ in range(100):
+            if _translate_text(handler, "b") == "1 b":
+                break
+            time.sleep(0.01)
+        assert _translate_text(handler, "b") == "1 b"
+        time.sleep(0.05)
+        assert reload_thread.is_alive()
+        assert backends.processes[0].running
+
+        backends.blocked["slow"].set()
+        in_flight.join()
+        reload_thread.join()
+        assert results == ["0 slow"]
+        assert not backends.processes[0].running
+    finally:
+        backends.blocked["slow"].set()
+        handler.stop()
+
+
+def test_serving_handler_reload_model_rollback():
+    backends = _ServingBackends()
+    handler = _make_serving_handler(backends)
+    try:
+        # The new backend fails to start.
+        backends.start_error = RuntimeError("start error")
+        status, _, result = _send_request(handler, "POST", "/reload_model")
+        assert status == 500
+        assert "start error" in result["message"]
+        backends.start_error = None
+        assert _translate_text(handler, "a") == "0 a"
+
+        # The warm-up request fails on the new backend.
+        backends.failing.add(1)
+        status, _, result = _send_request(handler, "POST", "/reload_model")
+        assert status == 500
+        assert "warm-up request failed" in result["message"]
+        assert [process.running for process in backends.processes] == [True, False]
+        assert _translate_text(handler, "a") == "0 a"
+    finally:
+        handler.stop()
+
+
+@pytest.mark.parametrize("warmup_fails", [False, True])
+def test_serving_handler_warmup(warmup_fails):
+    backends = _ServingBackends()
+    if warmup_fails:
+        backends.failing.add(0)
+    handler = _make_serving_handler(
+        backends, {"warmup": {"lengths": [1, 4], "batch_size": 2}}
+    )
+    try:
+        # The server is not ready before the warm-up is completed.
+        assert not handler.is_ready()
+        status, _, result = _send_request(handler, "GET", "/status")
+        assert status == 503
+        assert result == {"status": "warming_up"}
+        assert _send_request(handler, "GET", "/health")[0] == 503
+        status, _, _ = _send_request(
+            handler, "POST", "/translate", {"src": [{"text": "a"}]}
+        )
+        assert status == 503
+
+        handler.warmup()
+        if warmup_fails:
+            # The server is not ready after a failed warm-up, until a reload
+            # completes its own warm-up.
+            assert not handler.is_ready()
+            assert _send_request(handler, "GET", "/health")[0] == 503
+            backends.failing.clear()
+            assert _send_request(handler, "POST", "/reload_model")[0] == 200
+        assert handler.is_ready()
+        status, _, result = _send_request(handler, "GET", "/status")
+        assert status == 200
+        assert result == {"status": "ready"}
+        status, _, result = _send_request(handler, "GET", "/health")
+        assert status == 200
+        assert [timing["length"] for timing in result["warmup"]] == [1, 4]
+        assert _translate_text(handler, "a") == ("1 a" if warmup_fails else "0 a")
+    finally:
+        handler.stop()
+
+
+def test_serving_handler_warmup_backend_starting():
+    backends = _ServingBackends()
+    # The backend refuses the connections while it is starting.
+    backends.unreachable = 3
+    handler = _make_serving_handler(
+        backends, {"warmup": {"lengths": [1, 4], "batch_size": 2}}
+    )
+    try:
+        handler.warmup()
+        assert backends.unreachable == 0
+        assert handler.is_ready()
+        status, _, result = _send_request(handler, "GET", "/health")
+        assert status == 200
+        assert [timing["length"] for timing in result["warmup"]] == [1, 4]
+    finally:
+        handler.stop()
+
+
+def test_serving_handler_warmup_startup_timeout():
+    backends = _ServingBackends()
+    backends.unreachable = 1000
+    handler = _make_serving_handler(
+        backends,
+        {"warmup": {"lengths": [1], "batch_size": 1, "startup_timeout": 0.5}},
+    )
+    try:
+        start = time.time()
+        handler.warmup()
+        assert time.time() - start < 1
+        assert backends.unreachable < 1000
+        # The server does not report that it is ready when the warm-up gave up.
+        assert not handler.is_ready()
+        assert _send_request(handler, "GET", "/health")[0] == 503
+    finally:
+        handler.stop()
+
+
+def test_serving_handler_without_warmup():
+    handler = _make_serving_handler(_ServingBackends())
+    try:
+        assert handler.is_ready()
+        assert _send_request(handler, "GET", "/status")[0] == 200
+    finally:
+        handler.stop()
+
+
+@pytest.mark.parametrize("num_pending,saturated", [(1, False), (2, False), (3, True)])
+def test_serving_handler_saturation_pending_batches(num_pending, saturated):
+    backends = _ServingBackends()
+    backends.blocked["slow"] = threading.Event()
+    handler = _make_serving_handler(
+        backends, {"saturation": {"max_pending_batches": 2}}
+    )
+    threads = [
+        threading.Thread(target=_translate_text, args=(handler, "slow"))
+        for _ in range(num_pending)
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for _ in range(100):
+            status, headers, result = _send_request(handler, "GET", "/health")
+            if result["load"]["pending_batches"] == num_pending:
+                break
+            time.sleep(0.01)
+        assert result["load"]["pending_batches"] == num_pending
+        if saturated:
+            assert status == 503
+            assert result["saturated"]
+            assert int(headers["Retry-After"]) >= 1
+        else:
+            assert status == 200
+            assert "saturated" not in result
+            assert "Retry-After" not in headers
+    finally:
+        backends.blocked["slow"].set()
+        for thread in threads:
+            thread.join()
+        handler.stop()
+
+
+@pytest.mark.parametrize(
+    "estimated_wait,retry_after",
+    [(None, None), (1.5, None), (2, None), (2.5, "3")],
+)
+def test_serving_handler_saturation_estimated_wait(
+    monkeypatch, estimated_wait, retry_after
+):
+    load = {
+        "pending_batches": 10,
+        "queued_tokens": 100,
+        "batches_in_flight": 1,
+        "tokens_per_second": 50,
+        "estimated_wait": estimated_wait,
+    }
+    monkeypatch.setattr(serving.LoadMonitor, "stats", lambda self: load)
+    handler = _make_serving_handler(
+        _ServingBackends(), {"saturation": {"max_estimated_wait": 2}}
+    )
+    try:
+        status, headers, result = _send_request(handler, "GET", "/health")
+        assert result["load"] == load
+        if retry_after is None:
+            assert status == 200
+            assert "Retry-After" not in headers
+        else:
+            assert status == 503
+            assert result["saturated"]
+            assert headers["Retry-After"] == retry_after
+    finally:
+        handler.stop()
+
+
+def test_serving_handler_priorities_with_dynamic_batching():
+    backends = _ServingBackends()
+    backends.blocked["slow"] = threading.Event()
+    batch_sizes = []
+    translate_fn = backends.translate_fn
+
+    def _translate_fn(info, source_tokens, target_tokens, options):
+        batch_sizes.append(len(source_tokens))
+        return translate_fn(info, source_tokens, target_tokens, options)
+
+    backends.translate_fn = _translate_fn
+    handler = _make_serving_handler(
+        backends,
+        {
+            "dynamic_batching": True,
+            "max_batch_delay": 0,
+            "priorities": {"interactive": 4, "bulk": 1},
+        },
+    )
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda text: results.append(_translate_text(handler, text)),
+            args=(text,),
+        )
+        for text in ["slow"] + ["x"] * 16
+    ]
+    try:
+        threads[0].start()
+        assert backends.waiting.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # Wait for the requests to be queued in the scheduler.
+        for _ in range(500):
+            _, _, result = _send_request(handler, "GET", "/health")
+            if sum(result["waiting_batches"].values()) == 16:
+                break
+            time.sleep(0.01)
+        assert result["waiting_batches"] == {"interactive": 16, "bulk": 0}
+    finally:
+        backends.blocked["slow"].set()
+        for thread in threads:
+            thread.join()
+        handler.stop()
+    # The queued requests are merged in a single backend batch.
+    assert batch_sizes == [1, 16]
+    assert sorted(results) == ["0 slow"] + ["0 x"] * 16
+
+
+def test_serving_handler_batch_size_tuner():
+    backends = _ServingBackends()
+    errors = []
+
+    def _translate_fn(info, source_tokens, target_tokens, options):
+        error = errors.pop(0)
+        if error == "timeout":
+            return None
+        raise error
+
+    backends.translate_fn = _translate_fn
+    handler = _make_serving_handler(
+        backends,
+        {
+            "max_batch_size": 16,
+            "autotune": {"target_latency": 10, "max_batch_size": 64},
+        },
+    )
+
+    def _get_batch_size(error):
+        errors.append(error)
+        _send_request(handler, "POST", "/translate", {"src": [{"text": "a"}]})
+        _, _, result = _send_request(handler, "GET", "/health")
+        return result["batch_size_tuner"]["batch_size"]
+
+    try:
+        # Failures that do not depend on the batch size keep the batch size.
+        assert _get_batch_size(serving.BackendUnavailable("no replica")) == 16
+        assert _get_batch_size(RuntimeError("invalid input")) == 16
+        # Timeouts and out of memory errors reduce the batch size.
+        assert _get_batch_size("timeout") == 8
+        assert _get_batch_size(RuntimeError("CUDA out of memory")) == 4
+        assert _get_batch_size(MemoryError()) == 2
+    finally:
+        handler.stop()
+
+
+def test_is_out_of_memory_error():
+    class ResourceExhaustedError(Exception):
+        pass
+
+    assert serving._is_out_of_memory_error(MemoryError())
+    assert serving._is_out_of_memory_error(ResourceExhaustedError("OOM"))
+    assert serving._is_out_of_memory_error(
+        RuntimeError("the server failed: CUDA out of memory. Tried to allocate 2 GiB")
+    )
+    assert not serving._is_out_of_memory_error(RuntimeError("invalid input"))
+    assert not serving._is_out_of_memory_error(serving.BackendUnavailable("no replica"))
@@ -17,3 +17,23 @@ def test_vocabulary_iterator(tmpdir):
 
     tokens = list(tokenizer.vocabulary_iterator(vocab_path))
     assert tokens == ["", "hello", "world", "toto", "titi", "hello world"]
+
+
+def test_build_shared_tokenizer(tmpdir):
+    vocab_paths = []
+    for name in ("model_a", "model_b", "model_c"):
+        vocab_path = str(tmpdir.join("%s.txt" % name))
+        with open(vocab_path, "w") as vocab_file:
+            vocab_file.write("hello\n" if name != "model_c" else "world\n")
+        vocab_paths.append(vocab_path)
+
+    def _build(vocab_path, shared=True):
+        return tokenizer.build_tokenizer(
+            {"mode": "conservative", "vocabulary_path": vocab_path}, shared=shared
+        )
+
+    tokenizer_a = _build(vocab_paths[0])
+    # Files with the same content share the tokenizer.
+    assert _build(vocab_paths[1]) is tokenizer_a
+    assert _build(vocab_paths[2]) is not tokenizer_a
+    assert _build(vocab_paths[0], shared=False) is not tokenizer_a
@@ -26,6 +26,20 @@ def test_resolve_env_no_training():
     assert config["b"] == "${A_TRAIN_DIR}/a"
 
 
+def test_resolve_env_variables():
+    config = {"a": "${MODEL_DIR}/a", "b": "${B_DIR}/b"}
+    os.environ["MODEL_DIR"] = "foo"
+    os.environ["B_DIR"] = "bar"
+    config = utility.resolve_environment_variables(
+        config, variables={"MODEL_DIR": "baz"}
+    )
+    assert config["a"] == "baz/a"
+    assert config["b"] == "bar/b"
+    assert os.environ["MODEL_DIR"] == "foo"
+    del os.environ["MODEL_DIR"]
+    del os.environ["B_DIR"]
+
+
 def test_resolve_remote_files(tmpdir):
     tmpdir.join("remote").join("dir").join("a.txt").write("toto", ensure=True)
     tmpdir.join("local").ensure_dir()